@@ -7,4 +7,5 @@ cd /backend
 
 cp -r /pacman/usr/lib/* /backend/out
 
-cp -r /psutil /backend/out/
\ No newline at end of file
+cp -r /psutil /backend/out/
+cp -r /pulsectl /backend/out/
\ No newline at end of file
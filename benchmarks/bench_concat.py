@@ -0,0 +1,115 @@
+"""Compares stitching rolling-buffer fragments in-process against the ffmpeg
+concat demuxer.
+
+Each method runs in a child process so its peak RSS can be read back from
+getrusage. Fragments are recorded with gst-launch (videotestsrc into
+splitmuxsink) unless --dir points at existing Decky-Recorder-Rolling_*.mkv files.
+
+    python benchmarks/bench_concat.py [--dir PATH] [--seconds 30] [--runs 5]
+"""
+
+import argparse
+import glob
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "py_modules"))
+
+from decky_recorder import matroska  # noqa: E402
+
+
+def record_fragments(directory: str, seconds: int):
+    cmd = (
+        f"gst-launch-1.0 -e videotestsrc num-buffers={seconds * 30} ! video/x-raw,width=1280,height=800,framerate=30/1"
+        f" ! x264enc tune=zerolatency key-int-max=30 ! h264parse ! sink.video"
+        f" audiotestsrc num-buffers={seconds * 47} ! audioconvert ! avenc_aac ! sink.audio_0"
+        f" splitmuxsink name=sink muxer=matroskamux max-size-time=1000000000"
+        f" location={directory}/Decky-Recorder-Rolling_%02d.mkv"
+    )
+    subprocess.run(cmd.split(), check=True, stdout=subprocess.DEVNULL)
+
+
+def run_native(paths, output):
+    matroska.concat(paths, output)
+
+
+def run_ffmpeg(paths, output):
+    list_path = output + ".txt"
+    with open(list_path, "w") as f:
+        f.writelines(f"file '{p}'\n" for p in paths)
+    subprocess.run(
+        ["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", output],
+        check=True,
+    )
+
+
+def measure(method: str, paths, output) -> dict:
+    """Runs one export in a forked child and returns its wall time and peak RSS."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            start = time.perf_counter()
+            {"native": run_native, "ffmpeg": run_ffmpeg}[method](paths, output)
+            elapsed = time.perf_counter() - start
+            # ffmpeg runs as a grandchild, so its peak shows up under RUSAGE_CHILDREN
+            rss = max(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            )
+            os.write(write_fd, json.dumps({"seconds": elapsed, "peak_rss_kib": rss}).encode())
+            os._exit(0)
+        except BaseException as e:
+            print(f"{method}: {e!r}", file=sys.stderr)
+            os._exit(1)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        data = f.read()
+    _, status = os.waitpid(pid, 0)
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"{method} export failed")
+    return json.loads(data)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", help="directory with existing rolling fragments")
+    parser.add_argument("--seconds", type=int, default=30)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.dir:
+            source = args.dir
+        else:
+            source = tmp
+            record_fragments(source, args.seconds)
+        paths = sorted(glob.glob(os.path.join(source, "Decky-Recorder-Rolling_*.mkv")))
+        if not paths:
+            sys.exit(f"no fragments found in {source}")
+
+        methods = ["native"] + (["ffmpeg"] if shutil.which("ffmpeg") else [])
+        report = {"fragments": len(paths), "input_bytes": sum(os.path.getsize(p) for p in paths)}
+        for method in methods:
+            output = os.path.join(tmp, f"clip-{method}.mkv")
+            runs = [measure(method, paths, output) for _ in range(args.runs)]
+            report[method] = {
+                "median_seconds": statistics.median(r["seconds"] for r in runs),
+                "max_seconds": max(r["seconds"] for r in runs),
+                "peak_rss_kib": max(r["peak_rss_kib"] for r in runs),
+                "output_bytes": os.path.getsize(output),
+            }
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Replays an hour of gst-launch -m -vvv output through GstOutput.
+
+Reports throughput, the ring buffer footprint and peak Python heap use while
+replaying. Pass --log to replay a recorded decky-recorder-std-out.log instead of
+the synthetic one.
+
+    python benchmarks/bench_gst_output.py [--log PATH] [--seconds 3600]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "py_modules"))
+
+from decky_recorder import gst_output  # noqa: E402
+
+CAPS = (
+    "/GstPipeline:pipeline0/GstVaapiEncodeH264:vaapiencodeh264-0.GstPad:src: caps = video/x-h264, "
+    "stream-format=(string)avc, alignment=(string)au, profile=(string)main, width=(int)1280, "
+    "height=(int)800, framerate=(fraction)0/1, pixel-aspect-ratio=(fraction)1/1, interlace-mode=(string)progressive"
+)
+
+
+def synthetic_log(seconds: int, noise_per_second: int = 20):
+    yield "Setting pipeline to PAUSED ..."
+    for i in range(500):
+        yield CAPS
+    yield "Setting pipeline to PLAYING ..."
+    location = "/dev/shm/Decky-Recorder-Rolling_{:02d}.mkv"
+    for second in range(seconds):
+        path = location.format(second % 480)
+        running_time = second * 1_000_000_000
+        yield (
+            f'Got message #{second * 2} from element "sink" (element): splitmuxsink-fragment-opened, '
+            f"location=(string){path}, running-time=(guint64){running_time};"
+        )
+        for _ in range(noise_per_second):
+            yield CAPS
+        yield (
+            f'Got message #{second * 2 + 1} from element "sink" (element): splitmuxsink-fragment-closed, '
+            f"location=(string){path}, running-time=(guint64){running_time + 1_000_000_000};"
+        )
+    yield 'Got EOS from element "pipeline0".'
+    yield "Freeing pipeline ..."
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log", help="recorded gst-launch output to replay")
+    parser.add_argument("--seconds", type=int, default=3600)
+    parser.add_argument("--ring-bytes", type=int, default=256 * 1024)
+    args = parser.parse_args()
+
+    if args.log:
+        with open(args.log, errors="replace") as f:
+            lines = f.read().splitlines()
+    else:
+        lines = list(synthetic_log(args.seconds))
+
+    counts = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        output = gst_output.GstOutput(
+            os.path.join(tmp, "std-out.log"), ring=gst_output.LineRing(max_bytes=args.ring_bytes)
+        )
+        for kind in (gst_output.FRAGMENT_OPENED, gst_output.FRAGMENT_CLOSED, gst_output.EOS, gst_output.FREEING):
+            output.events.subscribe(kind, lambda e: counts.__setitem__(e.kind, counts.get(e.kind, 0) + 1))
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        for line in lines:
+            output.feed(line)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        log_bytes = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp))
+
+    print(
+        json.dumps(
+            {
+                "lines": len(lines),
+                "seconds": elapsed,
+                "lines_per_second": len(lines) / elapsed if elapsed else 0,
+                "ring_bytes": output.ring.bytes,
+                "ring_ceiling": args.ring_bytes,
+                "peak_heap_bytes": peak,
+                "log_dir_bytes": log_bytes,
+                "events": counts,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
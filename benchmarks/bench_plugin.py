@@ -0,0 +1,761 @@
+"""Headless benchmarks of the plugin backend.
+
+Loads `main.Plugin` the way Decky does, with a stand-in for the `decky_plugin`
+module, and puts the fake pactl, gst-launch-1.0, gst-inspect-1.0
+ffmpeg and pw-dump from benchmarks/fakes first on PATH, along with gdbus and systemd-inhibit
+for logind's sleep signals. Nothing touches the real audio
+server or GPU, so it runs on any Linux box with psutil installed.
+
+Measures:
+  startup     plugin load with the replay buffer enabled until its first segment
+  start       start_capturing until the pipeline is playing, and until the
+              replay buffer's first fragment opens
+  stop        stop_capturing of the replay buffer and of a manual recording
+  clip_save   save_rolling_recording against buffer fill, until the clip is written
+  watchdog    watchdog CPU time, scaled to an hour
+  rpc         latency of a polled RPC call, idle, while capturing and while
+              a slow ffmpeg export runs
+  suspend     logind suspend and resume, until the buffer records again, and
+              a clip across the suspend
+  settings    settings file writes while a slider is dragged
+  catalog     clip library reconcile, cold and incremental, and list/prune
+              queries against a few thousand clips
+  tracks      audio modules loaded and audio tracks in a clip, game and mic
+              mixed into one track and kept as separate tracks
+  compress    background re-encode of a saved clip, paused while a fake game
+              runs, and picked up again after the pool is reloaded
+  crash       standalone recordings SIGKILLed partway through, chunked and as
+              one .temp file, recovered as on the next start; and a chunked
+              recording stopped normally, until its chunks are joined
+
+    python benchmarks/bench_plugin.py [--output results.json] [--baseline old.json [--tolerance 0.2]]
+
+With --baseline, timings that got slower by more than the tolerance are listed
+and the exit status is 1.
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+FAKES = os.path.join(ROOT, "benchmarks", "fakes")
+
+FILL_SEGMENTS = (10, 30, 60, 120, 240, 480)
+
+
+def load_plugin(home: str, settings: dict):
+    dirs = {name: os.path.join(home, name) for name in ("settings", "logs", "runtime", "Videos", "buffer")}
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+    with open(os.path.join(dirs["settings"], "decky-loader-settings.json"), "w") as f:
+        json.dump({"output_folder": dirs["Videos"], **settings}, f)
+
+    decky_plugin = types.ModuleType("decky_plugin")
+    decky_plugin.HOME = home
+    decky_plugin.DECKY_HOME = home
+    decky_plugin.DECKY_PLUGIN_DIR = ROOT
+    decky_plugin.DECKY_PLUGIN_SETTINGS_DIR = dirs["settings"]
+    decky_plugin.DECKY_PLUGIN_RUNTIME_DIR = dirs["runtime"]
+    decky_plugin.DECKY_PLUGIN_LOG_DIR = dirs["logs"]
+    decky_plugin.logger = logging.getLogger("decky-recorder-bench")
+    sys.modules["decky_plugin"] = decky_plugin
+    # Keeps the audio server on the pactl path, which the fake answers
+    sys.modules["pulsectl"] = None
+
+    os.environ["DECKY_PLUGIN_SETTINGS_DIR"] = dirs["settings"]
+    os.environ["PATH"] = FAKES + os.pathsep + os.environ["PATH"]
+    os.environ["FAKE_PACTL_STATE"] = os.path.join(home, "pactl.json")
+    sys.path.insert(0, ROOT)
+    main = importlib.import_module("main")
+    plugin = main.Plugin
+    # Decky passes the class itself as `self`
+    plugin._rollingRecordingFolder = dirs["buffer"]
+    plugin._runtimeDir = dirs["runtime"]
+    open(os.path.join(dirs["runtime"], "pipewire-0"), "w").close()
+    return main, plugin
+
+
+def summary(samples):
+    samples = sorted(samples)
+    return {
+        "runs": len(samples),
+        "median_ms": statistics.median(samples) * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+class Bench:
+    def __init__(self, main, plugin):
+        self.main = main
+        self.plugin = plugin
+        self._playing = asyncio.Event()
+        self._opened = asyncio.Event()
+        events = plugin._gst_output.events
+        events.subscribe(main.gst_output.STATE_CHANGED, self._state_changed)
+        events.subscribe(main.gst_output.FRAGMENT_OPENED, lambda e: self._opened.set())
+
+    def _state_changed(self, event):
+        if event.source == "pipeline0" and event.fields.get("new-state") == "playing":
+            self._playing.set()
+
+    async def start(self, fragment: bool = True, app_name: str = ""):
+        """Seconds from start_capturing until the pipeline plays and, for the
+        replay buffer, until its first fragment opens."""
+        self._playing.clear()
+        self._opened.clear()
+        started = time.perf_counter()
+        await self.plugin.start_capturing(self.plugin, app_name)
+        await asyncio.wait_for(self._playing.wait(), 30)
+        playing = time.perf_counter() - started
+        if not fragment:
+            return playing, None
+        await asyncio.wait_for(self._opened.wait(), 30)
+        return playing, time.perf_counter() - started
+
+    async def stop(self) -> float:
+        started = time.perf_counter()
+        await self.plugin.stop_capturing(self.plugin)
+        return time.perf_counter() - started
+
+    async def closed_segments(self, count: int, timeout: float = 120):
+        deadline = time.monotonic() + timeout
+        while sum(1 for s in self.plugin._segment_index if s.closed) < count:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"buffer did not reach {count} segments")
+            await asyncio.sleep(0.01)
+
+    async def wait_export(self, timeout: float = 120) -> dict:
+        deadline = time.monotonic() + timeout
+        while True:
+            jobs = await self.plugin.get_export_jobs(self.plugin)
+            if jobs and jobs[-1]["state"] not in ("queued", "running"):
+                return jobs[-1]
+            if time.monotonic() > deadline:
+                raise TimeoutError("export did not finish")
+            await asyncio.sleep(0.005)
+
+
+async def bench_start_stop(bench: Bench, runs: int) -> dict:
+    plugin = bench.plugin
+    # The first start also spawns the pactl subscription and probes the encoders
+    await plugin.enable_rolling(plugin)
+    await asyncio.wait_for(bench._opened.wait(), 30)
+    await bench.stop()
+    playing, fragment, stops = [], [], []
+    for _ in range(runs):
+        p, f = await bench.start()
+        playing.append(p)
+        fragment.append(f)
+        # Lets at least one fragment close, as it would in use
+        await bench.closed_segments(1)
+        stops.append(await bench.stop())
+    await plugin.disable_rolling(plugin)
+
+    manual_playing, manual_stops = [], []
+    for _ in range(runs):
+        p, _ = await bench.start(fragment=False)
+        manual_playing.append(p)
+        await asyncio.sleep(0.5)
+        manual_stops.append(await bench.stop())
+    return {
+        "start": {
+            "rolling_playing": summary(playing),
+            "rolling_first_fragment": summary(fragment),
+            "manual_playing": summary(manual_playing),
+        },
+        "stop": {"rolling": summary(stops), "manual": summary(manual_stops)},
+    }
+
+
+async def bench_clip_save(bench: Bench, fills) -> dict:
+    plugin = bench.plugin
+    await plugin.set_buffer_limits(plugin, 4096, max(fills))
+    await plugin.enable_rolling(plugin)
+    results = {}
+    for fill in fills:
+        await bench.closed_segments(fill)
+        seconds = sum(s.duration for s in plugin._segment_index if s.closed) / 1e9
+        started = time.perf_counter()
+        await plugin.save_rolling_recording(plugin, seconds)
+        returned = time.perf_counter() - started
+        job = await bench.wait_export()
+        ready = time.perf_counter() - started
+        results[str(fill)] = {
+            "segments": job["segments"],
+            "clip_seconds": job["exported"],
+            "state": job["state"],
+            "rpc_ms": returned * 1000,
+            "ready_ms": ready * 1000,
+        }
+    await plugin.disable_rolling(plugin)
+    return results
+
+
+async def bench_watchdog(bench: Bench, seconds: float) -> dict:
+    plugin = bench.plugin
+    # Real time, so the gst-launch output the plugin reads arrives at its usual rate
+    speed = os.environ["FAKE_GST_SPEED"]
+    os.environ["FAKE_GST_SPEED"] = "1"
+    await plugin.enable_rolling(plugin)
+    os.environ["FAKE_GST_SPEED"] = speed
+    stats = plugin._watchdog_stats
+    ticks, cpu = stats.ticks, stats.cpu_total
+    process_cpu = time.process_time()
+    started = time.perf_counter()
+    await asyncio.sleep(seconds)
+    elapsed = time.perf_counter() - started
+    per_hour = 3600 / elapsed
+    result = {
+        "measured_seconds": elapsed,
+        "ticks_per_hour": (stats.ticks - ticks) * per_hour,
+        "watchdog_cpu_seconds_per_hour": (stats.cpu_total - cpu) * per_hour,
+        # Everything in the plugin process, including pumping gst-launch output
+        "process_cpu_seconds_per_hour": (time.process_time() - process_cpu) * per_hour,
+    }
+    await plugin.disable_rolling(plugin)
+    return result
+
+
+async def bench_startup(plugin, timeout: float = 60) -> dict:
+    """_main with the replay buffer enabled, as after a boot, until its first segment."""
+    loaded = time.perf_counter()
+    await plugin._main(plugin)
+    deadline = time.monotonic() + timeout
+    status = await plugin.get_startup_status(plugin)
+    while status["first_segment_after"] is None:
+        if time.monotonic() > deadline:
+            raise TimeoutError("no segment after startup")
+        await asyncio.sleep(0.005)
+        status = await plugin.get_startup_status(plugin)
+    first_segment = time.perf_counter() - loaded
+    # Back to idle for the other benchmarks
+    await plugin.disable_rolling(plugin)
+    return {
+        "ready_ms": status["ready_after"] * 1000 if status["ready_after"] is not None else None,
+        "first_segment_ms": first_segment * 1000,
+        "probe_attempts": status["attempts"],
+    }
+
+
+async def bench_settings(bench: Bench, steps: int = 60, interval: float = 1 / 60) -> dict:
+    """Drags the mic gain slider, one update per frame, and counts the file writes."""
+    plugin = bench.plugin
+    store = plugin._settings
+    await store.flush()
+    writes = store.writes
+    samples = []
+    for step in range(steps):
+        started = time.perf_counter()
+        await plugin.update_mic_gain(plugin, 5.0 + step * 0.25)
+        samples.append(time.perf_counter() - started)
+        await asyncio.sleep(interval)
+    # Past the debounce, so the drag has been written
+    await asyncio.sleep(store._debounce * 2)
+    return {"updates": steps, "file_writes": store.writes - writes, "update": summary(samples)}
+
+
+async def bench_rpc(bench: Bench, seconds: float = 2, interval: float = 0.01, segments: int = 20) -> dict:
+    """Latency of an RPC call polled the way the frontend does, idle, while the
+    replay buffer records, and while a throttled ffmpeg export of it runs."""
+    from decky_recorder.exports import ExportJob, ffmpeg_concat
+
+    plugin = bench.plugin
+
+    async def poll(until) -> list:
+        # From when the call was due until it returned, so event loop stalls count
+        samples = []
+        while not until():
+            due = time.perf_counter() + interval
+            await asyncio.sleep(interval)
+            await plugin.get_export_jobs(plugin)
+            samples.append(time.perf_counter() - due)
+        return samples
+
+    def elapsed(limit: float):
+        deadline = time.monotonic() + limit
+        return lambda: time.monotonic() > deadline
+
+    idle = await poll(elapsed(seconds))
+    await plugin.enable_rolling(plugin)
+    await bench.closed_segments(segments)
+    capturing = await poll(elapsed(seconds))
+
+    closed = [s for s in plugin._segment_index if s.closed][-segments:]
+    job = ExportJob(id=0, segments=closed, output=os.path.join(plugin._localFilePath, "rpc-bench.mkv"), requested=0)
+    # Long enough to span several seconds of polling
+    os.environ["FAKE_FFMPEG_BYTES_PER_SECOND"] = str(max(1, sum(s.size for s in closed) // (2 * seconds)))
+    export = asyncio.ensure_future(ffmpeg_concat(job, plugin._localFilePath))
+    exporting = await poll(export.done)
+    await export
+    del os.environ["FAKE_FFMPEG_BYTES_PER_SECOND"]
+    os.remove(job.output)
+    await plugin.disable_rolling(plugin)
+    return {"idle": summary(idle), "capturing": summary(capturing), "ffmpeg_export": summary(exporting)}
+
+
+async def bench_suspend(bench: Bench, before: int = 20, after: int = 10) -> dict:
+    """Sends PrepareForSleep through the fake gdbus and checks the buffer
+    continues across the suspend."""
+    plugin = bench.plugin
+    monitor = plugin._sleep_monitor
+    await plugin.set_buffer_limits(plugin, 4096, 480)
+    await plugin.enable_rolling(plugin)
+    await bench.closed_segments(before)
+
+    suspends = monitor.suspends
+    os.kill(monitor.pid, signal.SIGUSR1)
+    while monitor.suspends == suspends:
+        await asyncio.sleep(0.001)
+    last = plugin._segment_index.latest_closed()
+    kept = sum(1 for s in plugin._segment_index if s.closed)
+
+    bench._opened.clear()
+    os.kill(monitor.pid, signal.SIGUSR2)
+    await asyncio.wait_for(bench._opened.wait(), 30)
+    await bench.closed_segments(kept + after)
+    status = await plugin.get_sleep_status(plugin)
+
+    segments = list(plugin._segment_index)
+    resumed = segments[segments.index(last) + 1] if last in segments else None
+    seconds = sum(s.duration for s in segments if s.closed) / 1e9
+    await plugin.save_rolling_recording(plugin, seconds)
+    job = await bench.wait_export()
+    await plugin.disable_rolling(plugin)
+    return {
+        "suspend_ms": status["suspend_seconds"] * 1000,
+        "resume_to_capture_ms": status["resume_to_capture_seconds"] * 1000,
+        "resume_to_segment_ms": status["resume_to_segment_seconds"] * 1000,
+        "segments_kept": kept >= before,
+        "timeline_continues": resumed is not None and resumed.start == last.end,
+        "last_file_before": os.path.basename(last.path),
+        "first_file_after": os.path.basename(resumed.path) if resumed is not None else None,
+        "clip_segments": job["segments"],
+        "clip_state": job["state"],
+    }
+
+
+async def bench_catalog(bench: Bench, home: str, clips: int, page_runs: int = 50) -> dict:
+    """Fills a clip folder with copies of a saved clip and times the catalog."""
+    plugin = bench.plugin
+    catalog = plugin._clip_catalog
+    await plugin.enable_rolling(plugin)
+    await bench.closed_segments(2)
+    await plugin.save_rolling_recording(plugin, 2)
+    job = await bench.wait_export()
+    await plugin.disable_rolling(plugin)
+    # The finished export was added on its own
+    deadline = time.monotonic() + 30
+    while not [c for c in (await plugin.list_clips(plugin))["clips"] if c["path"] == job["output"]]:
+        if time.monotonic() > deadline:
+            raise TimeoutError("export was not cataloged")
+        await asyncio.sleep(0.01)
+
+    library = os.path.join(home, "library")
+    os.makedirs(library)
+    for i in range(clips):
+        minute, second = divmod(i, 60)
+        stamp = f"2026-01-{1 + minute // 1440:02d}_{minute // 60 % 24:02d}-{minute % 60:02d}-{second:02d}"
+        shutil.copyfile(job["output"], os.path.join(library, f"Game {i % 25}-30.0s-{stamp}.mkv"))
+
+    async def reconcile() -> float:
+        started = time.perf_counter()
+        await plugin.set_local_filepath(plugin, library)
+        await plugin._catalog_task
+        return time.perf_counter() - started
+
+    cold = await reconcile()
+    warm = await reconcile()
+    names = sorted(os.listdir(library))
+    for name in names[:10]:
+        os.utime(os.path.join(library, name), (time.time(), time.time() + 5))
+    for name in names[10:15]:
+        os.rename(os.path.join(library, name), os.path.join(library, "renamed " + name))
+    for name in names[15:20]:
+        os.remove(os.path.join(library, name))
+    incremental = await reconcile()
+    counts = plugin._catalog_task.result()
+
+    async def timed(call):
+        samples = []
+        for _ in range(page_runs):
+            started = time.perf_counter()
+            result = await call()
+            samples.append(time.perf_counter() - started)
+        return summary(samples), result
+
+    first_page, page = await timed(lambda: plugin.list_clips(plugin, 0, 50))
+    deep_page, _ = await timed(lambda: plugin.list_clips(plugin, clips - 50, 50))
+    by_app, _ = await timed(lambda: plugin.list_clips(plugin, 0, 50, "Game 7"))
+    total = sum(c["size"] for c in (await plugin.list_clips(plugin, 0, 500))["clips"]) * page["total"] / 500
+    prune_plan, plan = await timed(lambda: plugin.prune_clips(plugin, int(total / 2), None, True))
+    started = time.perf_counter()
+    pruned = await plugin.prune_clips(plugin, int(total / 2))
+    prune = time.perf_counter() - started
+    await plugin.set_local_filepath(plugin, os.path.join(home, "Videos"))
+    return {
+        "clips": page["total"],
+        "cold_reconcile_ms": cold * 1000,
+        "warm_reconcile_ms": warm * 1000,
+        "incremental_reconcile_ms": incremental * 1000,
+        "incremental": {k: counts[k] for k in ("probed", "renamed", "removed", "unchanged")},
+        "list_first_page": first_page,
+        "list_deep_page": deep_page,
+        "list_by_app": by_app,
+        "prune_dry_run": prune_plan,
+        "prune_ms": prune * 1000,
+        "pruned": len(pruned["removed"]),
+        "planned": len(plan["removed"]),
+        "files_left": len(os.listdir(library)),
+    }
+
+
+async def bench_audio_tracks(bench: Bench, segments: int = 10) -> dict:
+    """Saves a clip with the mic mixed in and with the mic as its own track."""
+    plugin = bench.plugin
+    matroska = bench.main.matroska
+
+    def loaded_modules():
+        with open(os.environ["FAKE_PACTL_STATE"]) as f:
+            return [name for name, _ in json.load(f)["modules"].values()]
+
+    def audio_tracks(path: str) -> int:
+        return sum(1 for track in matroska.read_fragment(path).tracks if track.type == matroska.TRACK_TYPE_AUDIO)
+
+    results = {}
+    await plugin.enable_microphone(plugin)
+    for separate in (False, True):
+        await plugin.set_separate_audio_tracks(plugin, separate)
+        await plugin.enable_rolling(plugin)
+        await bench.closed_segments(segments)
+        modules = loaded_modules()
+        await plugin.save_rolling_recording(plugin, segments)
+        job = await bench.wait_export()
+        results["separate" if separate else "mixed"] = {
+            "modules": len(modules),
+            "loopbacks": modules.count("module-loopback"),
+            "clip_audio_tracks": audio_tracks(job["output"]),
+            "clip_state": job["state"],
+        }
+
+    # The mic track goes away with the mic, which restarts the buffer
+    started = time.perf_counter()
+    await plugin.disable_microphone(plugin)
+    restart = time.perf_counter() - started
+    await bench.closed_segments(1)
+    results["mic_disabled"] = {
+        "restart_ms": restart * 1000,
+        "segment_audio_tracks": audio_tracks(plugin._segment_index.latest_closed().path),
+    }
+    await plugin.disable_rolling(plugin)
+    await plugin.set_separate_audio_tracks(plugin, False)
+    return results
+
+
+async def bench_compress(bench: Bench, home: str, segments: int = 60) -> dict:
+    """Re-encodes a clip through the fake ffmpeg, with a fake Steam game started
+    and stopped around it."""
+    import psutil
+
+    compress = bench.main.compress
+    plugin = bench.plugin
+    # Notices the fake game right away instead of on the next rescan
+    plugin._game_tracker._rescan_interval = 0.02
+
+    def pool():
+        return plugin._compression
+
+    async def job_state(job_id: int, states, timeout: float = 60) -> dict:
+        deadline = time.monotonic() + timeout
+        while True:
+            job = next(j for j in pool().status()["jobs"] if j["id"] == job_id)
+            if job["state"] in states:
+                return job
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"compression {job_id} stuck in {job['state']}")
+            await asyncio.sleep(0.01)
+
+    async def save_clip() -> str:
+        await plugin.enable_rolling(plugin)
+        await bench.closed_segments(segments)
+        await plugin.save_rolling_recording(plugin, segments)
+        job = await bench.wait_export()
+        await plugin.disable_rolling(plugin)
+        return job["output"]
+
+    def game():
+        return subprocess.Popen([sys.executable, "-c", "import time; time.sleep(600)", "SteamLaunch", "AppId=1"])
+
+    await plugin.set_compression(plugin, True, "balanced", 1, 0)
+    os.environ["FAKE_FFMPEG_ENCODE_SPEED"] = "20"
+    clip = await save_clip()
+    original = os.path.getsize(clip)
+    job = next(j for j in pool().status()["jobs"] if j["path"] == clip)
+    started = time.perf_counter()
+    done = await job_state(job["id"], ("done", "failed", "skipped"))
+    compressed = time.perf_counter() - started
+
+    # A game running when the job comes in holds it back, and stops it midway
+    os.environ["FAKE_FFMPEG_ENCODE_SPEED"] = "5"
+    running_game = game()
+    clip = await save_clip()
+    job = next(j for j in pool().status()["jobs"] if j["path"] == clip)
+    await asyncio.sleep(0.5)
+    held = (await job_state(job["id"], ("queued", "running", "paused")))["state"] == "queued"
+    running_game.terminate()
+    running_game.wait()
+    await job_state(job["id"], ("running",))
+    await asyncio.sleep(0.5)
+    running_game = game()
+    started = time.perf_counter()
+    await job_state(job["id"], ("paused",))
+    paused_after = time.perf_counter() - started
+    await asyncio.sleep(0.05)
+    ffmpeg = psutil.Process(plugin._compression._running[job["id"]].pid)
+    stopped = ffmpeg.status() == psutil.STATUS_STOPPED
+    progress = (await job_state(job["id"], ("paused",)))["progress"]
+    await asyncio.sleep(0.5)
+    frozen = (await job_state(job["id"], ("paused",)))["progress"] == progress
+    running_game.terminate()
+    running_game.wait()
+    paused_done = await job_state(job["id"], ("done", "failed", "skipped"))
+
+    # Interrupted by a reload after its first part, the job continues from the journal
+    pool()._chunk_seconds = 10
+    clip = await save_clip()
+    job = next(j for j in pool().status()["jobs"] if j["path"] == clip)
+    deadline = time.monotonic() + 60
+    while not next(j for j in pool().status()["jobs"] if j["id"] == job["id"])["parts"]:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"compression {job['id']} finished no part")
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.3)
+    unfinished = compress.CompressJob(**{k: v for k, v in job.items() if k != "saved"})
+    unfinished.parts = list(pool()._jobs[job["id"]].parts)
+    await plugin._compression.close()
+    left_partial = os.path.exists(unfinished.part(len(unfinished.parts)))
+    with open(os.path.join(home, "settings", "compress-jobs.json")) as f:
+        journaled = next(j for j in json.load(f)["jobs"] if j["id"] == job["id"])
+    plugin._compression = compress.CompressionPool(
+        plugin._compression._journal,
+        busy=plugin._game_tracker.active,
+        on_replaced=plugin._compression._on_replaced,
+        wait_change=plugin._game_tracker.wait_change,
+    )
+    await plugin._compression.start(True, "balanced", 1)
+    resumed = await job_state(job["id"], ("done", "failed", "skipped"))
+    await plugin.set_compression(plugin, False)
+    os.environ.pop("FAKE_FFMPEG_ENCODE_SPEED")
+    return {
+        "clip_bytes": original,
+        "compress_ms": compressed * 1000,
+        "state": done["state"],
+        "saved_bytes": done["saved"],
+        "held_while_game_runs": held,
+        "pause_ms": paused_after * 1000,
+        "ffmpeg_stopped": stopped,
+        "progress_frozen": frozen,
+        "paused_job_state": paused_done["state"],
+        "journal_state_after_unload": journaled["state"],
+        "parts_kept_across_reload": len(journaled["parts"]),
+        "seconds_kept_across_reload": sum(journaled["parts"]),
+        "unfinished_part_removed": not left_partial,
+        "resumed_job_state": resumed["state"],
+        "saved_total": pool().status()["saved_total"],
+    }
+
+
+# Spaces, a quote and non-ASCII, all of which GStreamer escapes in its messages
+CRASH_APP_NAME = "Baldur's Gate 3 – Édition"
+
+
+async def bench_crash(bench: Bench, seconds: float = 120, chunk_seconds: int = 10) -> dict:
+    """SIGKILLs standalone recordings partway through, chunked and as a single
+    .temp file, and recovers them the way the next plugin start does."""
+    plugin = bench.plugin
+    matroska = bench.main.matroska
+    speed = float(os.environ["FAKE_GST_SPEED"])
+    if plugin._rolling:
+        await plugin.disable_rolling(plugin)
+
+    def orphans() -> int:
+        return sum(len(found) for found in bench.main.chunked_recording.find_orphans(plugin._localFilePath))
+
+    def duration(path: str) -> float:
+        # The fake ffmpeg joins other formats byte for byte, only Matroska has a real duration
+        if not path.endswith(".mkv"):
+            return None
+        fragment = matroska.read_fragment(path)
+        return (fragment.duration or 0) * fragment.timecode_scale / 1e9
+
+    async def record(chunked: bool):
+        await plugin.set_chunked_recording(plugin, chunked, chunk_seconds)
+        await bench.start(fragment=chunked, app_name=CRASH_APP_NAME)
+        started = time.perf_counter()
+        await asyncio.sleep(seconds / speed)
+        return plugin._filepath, (time.perf_counter() - started) * speed
+
+    results = {}
+    for chunked in (True, False):
+        output, recorded = await record(chunked)
+        # Killed along with the plugin: nothing is stopped, flushed or joined
+        proc, plugin._recording_process = plugin._recording_process, None
+        proc.send_signal(signal.SIGKILL)
+        await proc.wait()
+        plugin._chunked_recording = None
+        left = orphans()
+        started = time.perf_counter()
+        plugin.recover_recordings(plugin)
+        await plugin._recovery_task
+        if chunked:
+            await bench.wait_export()
+        recovered = time.perf_counter() - started
+        fragment = matroska.read_fragment(output) if output.endswith(".mkv") else None
+        results["chunked" if chunked else "single_file"] = {
+            "orphans": left,
+            "recover_ms": recovered * 1000,
+            "recorded_seconds": recorded,
+            "recovered_seconds": duration(output),
+            "saved": os.path.exists(output),
+            "finalized": None if fragment is None else fragment.duration is not None and not fragment.truncated,
+            "orphans_left": orphans(),
+        }
+
+    # The chunks of a recording that stops normally are joined in the background
+    output, recorded = await record(True)
+    stop = await bench.stop()
+    started = time.perf_counter()
+    job = await bench.wait_export()
+    results["stopped"] = {
+        "stop_ms": stop * 1000,
+        "join_ms": (time.perf_counter() - started) * 1000,
+        "state": job["state"],
+        "recorded_seconds": recorded,
+        "saved_seconds": duration(output),
+        "chunks_removed": not os.path.exists(bench.main.chunked_recording.chunk_directory(output)),
+    }
+    await plugin.set_chunked_recording(plugin, False)
+    return results
+
+
+async def run(args, home: str) -> dict:
+    main, plugin = load_plugin(home, {"rolling": True, "format": args.format})
+    report = {"format": args.format, "speed": args.speed}
+    report["startup"] = await bench_startup(plugin)
+    bench = Bench(main, plugin)
+    try:
+        if "start" in args.only or "stop" in args.only:
+            report.update(await bench_start_stop(bench, args.runs))
+        if "clip_save" in args.only:
+            report["clip_save"] = await bench_clip_save(bench, [int(f) for f in args.fills.split(",")])
+        if "watchdog" in args.only:
+            report["watchdog"] = await bench_watchdog(bench, args.watchdog_seconds)
+        if "rpc" in args.only:
+            report["rpc"] = await bench_rpc(bench)
+        if "suspend" in args.only:
+            report["suspend"] = await bench_suspend(bench)
+        if "settings" in args.only:
+            report["settings"] = await bench_settings(bench)
+        if "catalog" in args.only:
+            report["catalog"] = await bench_catalog(bench, home, args.catalog_clips)
+        if "tracks" in args.only:
+            report["tracks"] = await bench_audio_tracks(bench)
+        if "compress" in args.only:
+            report["compress"] = await bench_compress(bench, home)
+        if "crash" in args.only:
+            report["crash"] = await bench_crash(bench)
+    finally:
+        await plugin._unload(plugin)
+        # Lets the pipes of subprocesses killed on unload close before the loop does
+        await asyncio.sleep(0.1)
+    return report
+
+
+def timings(report: dict, prefix: str = ""):
+    """Flattens the numbers that count as latency or cost, keyed by their path."""
+    for key, value in report.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from timings(value, path + ".")
+        elif isinstance(value, (int, float)) and (key.endswith("_ms") or key.endswith("_per_hour")):
+            yield path, value
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> dict:
+    old = dict(timings(baseline))
+    changes, regressions = {}, []
+    for path, value in timings(report):
+        if path not in old or path.endswith("ticks_per_hour"):
+            continue
+        ratio = value / old[path] if old[path] else float("inf") if value else 1.0
+        changes[path] = {"baseline": old[path], "current": value, "ratio": ratio}
+        if ratio > 1 + tolerance:
+            regressions.append(path)
+    return {"tolerance": tolerance, "changes": changes, "regressions": regressions}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--fills", default=",".join(str(f) for f in FILL_SEGMENTS), help="buffer fills in segments")
+    parser.add_argument("--watchdog-seconds", type=float, default=30)
+    parser.add_argument("--speed", type=float, default=50, help="fake pipeline timeline seconds per wall second")
+    parser.add_argument("--format", default="mkv")
+    parser.add_argument(
+        "--only", default="start,stop,clip_save,watchdog,rpc,suspend,settings,catalog,tracks,compress,crash"
+    )
+    parser.add_argument("--catalog-clips", type=int, default=2000, help="clips in the catalog benchmark's folder")
+    parser.add_argument("--output", help="write the JSON report here as well")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before it counts as regression")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    args.only = set(args.only.split(","))
+
+    try:
+        import psutil  # noqa: F401
+    except ImportError:
+        sys.exit("psutil is required")
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.getLogger().addHandler(logging.NullHandler())
+        logging.getLogger("decky_recorder").propagate = False
+    # Real capture runs in real time; the fake pipeline is sped up so a full buffer fills quickly
+    os.environ["FAKE_GST_SPEED"] = str(args.speed)
+
+    # The watchdog stops capturing when it finds no game mode session
+    session = subprocess.Popen([os.path.join(FAKES, "gamescope-session")])
+    try:
+        with tempfile.TemporaryDirectory(prefix="decky-recorder-bench-") as home:
+            report = asyncio.run(run(args, home))
+    finally:
+        session.terminate()
+        session.wait()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["comparison"] = compare(report, json.load(f), args.tolerance)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+    if args.baseline and report["comparison"]["regressions"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
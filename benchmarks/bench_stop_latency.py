@@ -0,0 +1,85 @@
+"""Measures how long a manual recording takes from stop to a ready file.
+
+Records --seconds of test video with each direct muxer setup used by the plugin,
+sends SIGINT the way stop_capturing does and times until the final file is in
+place. The old path (matroskamux followed by an ffmpeg remux) is included for
+comparison when ffmpeg is installed.
+
+    python benchmarks/bench_stop_latency.py [--seconds 1800] [--formats mp4,mkv]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "py_modules"))
+
+from decky_recorder import pipeline  # noqa: E402
+
+
+def record(output, seconds: int) -> subprocess.Popen:
+    # Test sources are live, so they are paced in real time like pipewiresrc
+    video = pipeline.video_source(test=True) + pipeline.video_encode(
+        pipeline.VideoEncoder("x264enc", False), pipeline.PRESETS["performance"]
+    )
+    audio = pipeline.audio_source(test=True) + pipeline.audio_encode(128000)
+    argv = pipeline.recording_pipeline(video, [audio], output).launch_argv(("-e",))
+    proc = subprocess.Popen(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(seconds)
+    return proc
+
+
+def stop(proc: subprocess.Popen) -> float:
+    started = time.perf_counter()
+    proc.send_signal(signal.SIGINT)
+    proc.wait(timeout=60)
+    return started
+
+
+def direct(tmp: str, fileformat: str, seconds: int) -> dict:
+    final = os.path.join(tmp, f"direct.{fileformat}")
+    proc = record(pipeline.file_output(fileformat, final + ".temp"), seconds)
+    started = stop(proc)
+    os.replace(final + ".temp", final)
+    return {"stop_to_ready_seconds": time.perf_counter() - started, "bytes": os.path.getsize(final)}
+
+
+def remux(tmp: str, fileformat: str, seconds: int) -> dict:
+    final = os.path.join(tmp, f"remux.{fileformat}")
+    proc = record(pipeline.file_output("mkv", final + ".temp"), seconds)
+    started = stop(proc)
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-i", final + ".temp", "-c", "copy", final], check=True)
+    os.remove(final + ".temp")
+    return {"stop_to_ready_seconds": time.perf_counter() - started, "bytes": os.path.getsize(final)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=int, default=1800)
+    parser.add_argument("--formats", default="mp4,mkv,mov")
+    parser.add_argument("--dir", help="where to record, defaults to a temporary directory")
+    args = parser.parse_args()
+
+    if not shutil.which("gst-launch-1.0"):
+        sys.exit("gst-launch-1.0 is required")
+
+    report = {"recorded_seconds": args.seconds}
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for fileformat in args.formats.split(","):
+            report[fileformat] = {"direct": direct(tmp, fileformat, args.seconds)}
+            if shutil.which("ffmpeg"):
+                report[fileformat]["remux"] = remux(tmp, fileformat, args.seconds)
+            for name in os.listdir(tmp):
+                os.remove(os.path.join(tmp, name))
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,15 @@
 import os
 import sys
 import traceback
-import subprocess
 import signal
 import time
 from datetime import datetime
 from pathlib import Path
-from settings import SettingsManager
 import decky_plugin
 import logging
 import shutil
 import json
+import base64
 
 # Get environment variable
 settingsDir = os.environ["DECKY_PLUGIN_SETTINGS_DIR"]
@@ -22,83 +21,178 @@ if not DEPSPATH.exists():
     DEPSPATH = Path(decky_plugin.DECKY_PLUGIN_DIR) / "backend/out"
 GSTPLUGINSPATH = DEPSPATH / "gstreamer-1.0"
 
+PYMODULESPATH = Path(decky_plugin.DECKY_PLUGIN_DIR) / "py_modules"
+if str(PYMODULESPATH) not in sys.path:
+    sys.path.append(str(PYMODULESPATH))
+
+from decky_recorder import chunked_recording, compress, gst_output, matroska, metrics, pipeline, process, startup
+from decky_recorder.audio import AudioServer
+from decky_recorder.exports import ExportQueue
+from decky_recorder.live_recording import LiveRecording
+from decky_recorder.audio_graph import AudioGraph, AudioGraphReconciler, recording_graph
+from decky_recorder.buffer import BufferManager, MiB
+from decky_recorder.catalog import ClipCatalog
+from decky_recorder.chunked_recording import ChunkedRecording
+from decky_recorder.compress import CompressionPool
+from decky_recorder.segment_index import NS_PER_SECOND, SegmentIndex
+from decky_recorder.settings_store import Setting, SettingsStore
+from decky_recorder.sleep import SleepMonitor
+from decky_recorder.supervisor import WAKEUP_COUNT_PATH, SessionTracker, TickStats, read_sysfs_int
+
 std_out_file_path = Path(decky_plugin.DECKY_PLUGIN_LOG_DIR) / "decky-recorder-std-out.log"
-std_out_file = open(std_out_file_path, "w")
-std_err_file = open(Path(decky_plugin.DECKY_PLUGIN_LOG_DIR) / "decky-recorder-std-err.log", "w")
 
 logger = decky_plugin.logger
 
 from logging.handlers import TimedRotatingFileHandler
 
 log_file = Path(decky_plugin.DECKY_PLUGIN_LOG_DIR) / "decky-recorder.log"
-log_file_handler = TimedRotatingFileHandler(log_file, when="midnight", backupCount=2)
+log_file_handler = TimedRotatingFileHandler(log_file, when="midnight", backupCount=2, delay=True)
 log_file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
 logger.handlers.clear()
 logger.addHandler(log_file_handler)
 
-try:
-    sys.path = [str(DEPSPATH / "psutil")] + sys.path
-    import psutil
+package_logger = logging.getLogger("decky_recorder")
+package_logger.setLevel(logging.INFO)
+package_logger.addHandler(log_file_handler)
 
-    logger.info("Successfully loaded psutil")
-except Exception:
-    logger.info(traceback.format_exc())
+# psutil and pulsectl are imported where they are first used, off the load path
+sys.path = [str(DEPSPATH / "psutil"), str(DEPSPATH / "pulsectl")] + sys.path
 
 
 def find_gst_processes():
-    pids = []
-    for child in psutil.process_iter():
-        try:
-            if "Decky-Recorder" in " ".join(child.cmdline()):
-                pids.append(child.pid)
-        except psutil.NoSuchProcess:
-            pass
-    return pids
-
-
-def in_gamemode():
-    for child in psutil.process_iter():
-        try:
-            if "gamescope-session" in " ".join(child.cmdline()):
-                return True
-        except psutil.NoSuchProcess:
-            pass
-    return False
-
-def get_cmd_output(cmd, log = True):
-    if log:
-        logger.info(f"Command: {cmd}")
+    import psutil
 
-    return subprocess.getoutput(cmd).strip()
+    # Attributes that cannot be read come back as None instead of raising
+    return [
+        child.pid
+        for child in psutil.process_iter(["name", "cmdline"])
+        if pipeline.is_capture_process(child.info["name"], child.info["cmdline"])
+    ]
+
+
+SETTINGS = (
+    Setting("_localFilePath", "output_folder", str, decky_plugin.DECKY_HOME + "/Videos"),
+    Setting("_fileformat", "format", str, "mkv"),
+    Setting("_rolling", "rolling", bool, False),
+    Setting("_chunkedRecording", "chunked_recording", bool, False),
+    Setting("_recordingChunkSeconds", "recording_chunk_seconds", int, 60),
+    Setting("_micEnabled", "mic_enabled", bool, False),
+    Setting("_micGain", "mic_gain", float, 13.0),
+    Setting("_micSource", "mic_source", str, "NA"),
+    Setting("_noiseReductionPercent", "noise_reduction_percent", int, 50),
+    Setting("_separateAudioTracks", "separate_audio_tracks", bool, False),
+    Setting("_audioBitrate", "audio_bitrate", int, 192000),
+    Setting("_bufferRamBudgetMiB", "buffer_ram_budget_mib", int, 512),
+    Setting("_bufferTargetSeconds", "buffer_target_seconds", int, 480),
+    Setting("_encodingPreset", "encoding_preset", str, pipeline.DEFAULT_PRESET),
+    Setting("_videoEncoder", "video_encoder", str, "vaapih264enc"),
+    Setting("_metricsEnabled", "metrics_enabled", bool, False),
+    Setting("_metricsFile", "metrics_file", str, ""),
+    Setting("_compressEnabled", "compress_enabled", bool, False),
+    Setting("_compressPreset", "compress_preset", str, compress.DEFAULT_PRESET),
+    Setting("_compressWorkers", "compress_workers", int, 1),
+    Setting("_compressMinMiB", "compress_min_mib", int, 100),
+)
+
+
+def clean_app_name(app_name) -> str:
+    app_name = str(app_name).replace(":", " ").replace("/", " ")
+    if app_name == "" or app_name == "null":
+        app_name = "Decky-Recorder"
+    return app_name
+
+
+def gst_env():
+    return process.make_env(
+        {"GST_VAAPI_ALL_DRIVERS": "1", "GST_PLUGIN_PATH": str(GSTPLUGINSPATH), "LD_LIBRARY_PATH": str(DEPSPATH)}
+    )
+
+
+async def pump_gst_output(plugin, proc):
+    # Feeds gst-launch output to the pipeline event stream and wakes the
+    # watchdog when the pipeline ends
+    await asyncio.gather(plugin._gst_output.pump(proc.stdout), plugin._gst_output.pump(proc.stderr))
+    await proc.wait()
+    if proc is plugin._recording_process:
+        logger.warn(f"gst-launch exited with {proc.returncode}")
+        if plugin._watchdog_wakeup is not None:
+            plugin._watchdog_wakeup.set()
 
-def unload_pa_modules(search_string):
-    module_list = get_cmd_output(f"pactl list short modules | grep '{search_string}' | awk '{{print $1}}'").split("\n")
-    for module_id in module_list:
-        get_cmd_output(f"pactl unload-module {module_id}")
 
 class Plugin:
     _recording_process = None
+    _output_task = None
     _filepath: str = None
     _mode: str = "localFile"
     _audioBitrate: int = 128
     _localFilePath: str = decky_plugin.HOME + "/Videos"
+    _runtimeDir: str = "/run/user/1000"
     _rollingRecordingFolder: str = "/dev/shm"
     _rollingRecordingPrefix: str = "Decky-Recorder-Rolling"
     _fileformat: str = "mkv"
     _rolling: bool = False
+    # Whether the running pipeline is the replay buffer, _rolling can change while it runs
+    _capturingRolling: bool = False
+    _live_recording: LiveRecording = None
+    # Standalone recordings as Matroska chunks joined on stop, so a crash loses at most one chunk
+    _chunkedRecording: bool = False
+    _recordingChunkSeconds: int = 60
+    _chunked_recording: ChunkedRecording = None
+    # Export job id -> chunk folder it joins, removed once the export is done
+    _chunk_exports: dict = {}
+    _recovery_task = None
     _micEnabled: bool = False
     _micGain: float = 13.0
     _noiseReductionPercent: int = 50
     _micSource: str = "NA"
+    # Game and mic as their own tracks instead of mixed into the recording sink
+    _separateAudioTracks: bool = False
+    # Sources of the audio tracks, from the last audio graph applied
+    _audio_tracks: list = []
     _deckySinkModuleName: str = "Decky-Recording-Sink"
     _echoCancelledAudioName: str = "Echo-Cancelled-Audio"
     _echoCancelledMicName: str = "Echo-Cancelled-Mic"
-    _optional_denoise_binary_path= decky_plugin.HOME + "/homebrew/data/decky-recorder/librnnoise_ladspa.so"
-    _last_clip_time: float = time.time()
+    _optional_denoise_binary_path = decky_plugin.HOME + "/homebrew/data/decky-recorder/librnnoise_ladspa.so"
     _watchdog_task = None
-    _muxer_map = {"mp4": "matroskamux", "mkv": "matroskamux", "mov": "qtmux"}
+    _watchdog_wakeup: asyncio.Event = None
+    _watchdog_stats: TickStats = TickStats()
+    _session_tracker: SessionTracker = None
+    _pipeline_freed: bool = False
+    _gst_output: gst_output.GstOutput = None
+    _audio: AudioServer = None
+    _audio_reconciler: AudioGraphReconciler = None
+    _export_queue: ExportQueue = None
+    _buffer: BufferManager = None
+    _bufferRamBudgetMiB: int = 512
+    _bufferTargetSeconds: int = 480
+    _bufferSpillFolderName: str = ".decky-recorder-buffer"
+    _encoder_probe: pipeline.EncoderProbe = None
+    _encodingPreset: str = pipeline.DEFAULT_PRESET
+    _videoEncoder: str = "vaapih264enc"
+    _metricsEnabled: bool = False
+    # Prometheus text dump, written periodically while metrics are enabled
+    _metricsFile: str = ""
+    _metrics_task = None
+    _startup: startup.StartupSequencer = None
+    _sleep_monitor: SleepMonitor = None
+    # Set between PrepareForSleep and resume, keeps the watchdog from restarting the capture
+    _sleeping: bool = False
+    _resumeCapture: bool = False
+    # time.perf_counter() when a resumed capture was started, cleared by its first fragment
+    _resume_started: float = None
+    _sleep_stats: dict = {"suspends": 0, "resume_to_capture_seconds": None, "resume_to_segment_seconds": None}
     _wakeup_count = 1
-    _settings = None
+    _settings: SettingsStore = None
+    _clip_catalog: ClipCatalog = None
+    _catalog_task = None
+    _compressEnabled: bool = False
+    _compressPreset: str = compress.DEFAULT_PRESET
+    _compressWorkers: int = 1
+    # Smaller clips are not worth the CPU time
+    _compressMinMiB: int = 100
+    _compression: CompressionPool = None
+    _game_tracker: SessionTracker = None
+    _segment_index: SegmentIndex = SegmentIndex()
 
     async def get_wakeup_count(self):
         return self._wakeup_count
@@ -114,25 +208,41 @@ class Plugin:
                 logger.info(f"Killing rogue process {pid}")
                 os.kill(pid, signal.SIGKILL)
 
+    def pipeline_alive(self):
+        proc = self._recording_process
+        return proc is not None and proc.returncode is None and not self._pipeline_freed
+
+    async def get_watchdog_stats(self):
+        return self._watchdog_stats.as_dict()
+
     async def watchdog(self):
         logger.info("Watchdog started")
+        self._watchdog_wakeup = asyncio.Event()
+        self._session_tracker = SessionTracker("gamescope-session", on_change=self._watchdog_wakeup.set)
+        self._wakeup_count = read_sysfs_int(WAKEUP_COUNT_PATH, self._wakeup_count)
         while True:
+            # Sleeps until the pipeline or the gamescope session exits, or the next tick
+            try:
+                await asyncio.wait_for(self._watchdog_wakeup.wait(), 2)
+            except asyncio.TimeoutError:
+                pass
+            self._watchdog_wakeup.clear()
+
             # Try to remediate black screen when recording turned on
             # and attempting to go into desktop mode
+            wakeup_count = self._wakeup_count
             try:
-                in_gm = in_gamemode()
-                is_cap = await Plugin.is_capturing(self, verbose=False)
-                if not in_gm and is_cap:
-                    await Plugin.stop_capturing(self)
-                    await Plugin.clear_rogue_gst_processes(self)
-                std_out_lines = open(std_out_file_path, "r").readlines()
-                if std_out_lines:
-                    is_cap = is_cap and ("Freeing" not in std_out_lines[-1])
+                with self._watchdog_stats:
+                    in_gm = self._session_tracker.active()
+                    is_cap = await Plugin.is_capturing(self, verbose=False)
+                    alive = Plugin.pipeline_alive(self)
+                    wakeup_count = read_sysfs_int(WAKEUP_COUNT_PATH, self._wakeup_count)
                 if not in_gm and is_cap:
                     logger.warn("Left gamemode but recording was still running, killing capture")
                     await Plugin.stop_capturing(self)
+                    await Plugin.clear_rogue_gst_processes(self)
                 # This can be buggy due to race condition between disabling rolling and the watchdog seeing that rolling is disabled
-                elif in_gm and not is_cap and self._rolling:
+                elif in_gm and not alive and self._rolling and not self._sleeping:
                     # Add another 2 second wait to ensure that the state is still consistent...
                     await asyncio.sleep(2)
                     if self._rolling:
@@ -140,60 +250,49 @@ class Plugin:
                         await Plugin.stop_capturing(self)
                         await Plugin.start_capturing(self)
             except Exception:
-                logger.exception(f"watchdog exception! {Exception.message}")
+                logger.exception("watchdog exception!")
 
             # Restart recording on sleep wake up to resolve issues
-            wakeup_count = int(get_cmd_output("cat /sys/power/wakeup_count", log=False))
             prev_wakeup_count = await Plugin.get_wakeup_count(self)
             # The wakeup buffer increments twice before system is fully started
             # up, so only update the buffer when wakeup count is greater than
             # old + 1
             if wakeup_count > prev_wakeup_count + 1:
-                    if self._rolling:
-                        # Give it a bit of buffer time to allow system to ready up
-                        await asyncio.sleep(1)
-                        logger.warn("Wakeup from sleep detected, restarting capture")
-                        await Plugin.stop_capturing(self)
-                        await Plugin.start_capturing(self)
-                    await Plugin.set_wakeup_count(self, wakeup_count)
-
-            await asyncio.sleep(2)
+                # logind already told the sleep monitor, which finished the capture before the suspend
+                if self._rolling and not (self._sleep_monitor is not None and self._sleep_monitor.active):
+                    # Give it a bit of buffer time to allow system to ready up
+                    await asyncio.sleep(1)
+                    logger.warn("Wakeup from sleep detected, restarting capture")
+                    await Plugin.stop_capturing(self)
+                    await Plugin.start_capturing(self, resume=True)
+                await Plugin.set_wakeup_count(self, wakeup_count)
 
     # Starts the capturing process
-    async def start_capturing(self, app_name: str = ""):
+    async def start_capturing(self, app_name: str = "", resume: bool = False):
         try:
             logger.info("Starting recording")
 
-            app_name = str(app_name).replace(":", " ").replace("/", " ")
-            if app_name == "" or app_name == "null":
-                app_name = "Decky-Recorder"
+            app_name = clean_app_name(app_name)
 
-            muxer = Plugin._muxer_map.get(self._fileformat, "matroskamux")
-            logger.info(f"Starting recording for {self._fileformat} with mux {muxer}")
+            logger.info(f"Starting recording for {self._fileformat} with mux {pipeline.muxer_for(self._fileformat)}")
             if await Plugin.is_capturing(self) == True:
                 logger.info("Error: Already recording")
                 return
 
             await Plugin.clear_rogue_gst_processes(self)
 
-            os.environ["XDG_RUNTIME_DIR"] = "/run/user/1000"
+            os.environ["XDG_RUNTIME_DIR"] = self._runtimeDir
             os.environ["XDG_SESSION_TYPE"] = "wayland"
             os.environ["HOME"] = decky_plugin.DECKY_HOME
 
             # Start command including plugin path and ld_lib path
-            start_command = (
-                "GST_VAAPI_ALL_DRIVERS=1 GST_PLUGIN_PATH={} LD_LIBRARY_PATH={} gst-launch-1.0 -e -vvv".format(
-                    str(GSTPLUGINSPATH), str(DEPSPATH)
-                )
-            )
+            start_env = gst_env()
 
             # Video Pipeline
-            if not self._rolling:
-                videoPipeline = f"pipewiresrc do-timestamp=true ! vaapipostproc ! queue ! vaapih264enc ! h264parse ! {muxer} name=sink !"
-            else:
-                videoPipeline = "pipewiresrc do-timestamp=true ! vaapipostproc ! queue ! vaapih264enc ! h264parse !"
-
-            cmd = "{} {}".format(start_command, videoPipeline)
+            preset = pipeline.PRESETS.get(self._encodingPreset, pipeline.PRESETS[pipeline.DEFAULT_PRESET])
+            encoder = await self._encoder_probe.select(self._videoEncoder)
+            logger.info(f"Encoding with {encoder.factory}, preset {preset.name}")
+            video = pipeline.video_source() + pipeline.video_encode(encoder, preset)
 
             # If mode is localFile
             if self._mode == "localFile":
@@ -201,40 +300,55 @@ class Plugin:
                 dateTime = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
                 if self._rolling:
                     logger.info("Setting tmp filepath")
-                    self._filepath = (
-                        f"{self._rollingRecordingFolder}/{self._rollingRecordingPrefix}_%02d.{self._fileformat}"
+                    self._buffer.configure(
+                        self._bufferRamBudgetMiB * MiB,
+                        self._bufferTargetSeconds,
+                        f"{self._localFilePath}/{self._bufferSpillFolderName}",
                     )
+                    # Unless resuming the previous buffer is dropped, except what a queued export still needs
+                    plan = self._buffer.begin(resume=resume)
+                    start_index = self._buffer.next_file_index()
+                    self._filepath = self._buffer.location(self._fileformat)
                 if not self._rolling:
                     logger.info("Setting local filepath no rolling")
                     self._filepath = f"{self._localFilePath}/{app_name}_{dateTime}.{self._fileformat}"
-                    fileSinkPipeline = f' filesink location="{self._filepath}.temp" '
+                    if self._chunkedRecording:
+                        # Matroska whatever the format, the chunks are joined into it on stop
+                        self._chunked_recording = ChunkedRecording(self._filepath, self._fileformat)
+                        chunk_ns = max(1, self._recordingChunkSeconds) * NS_PER_SECOND
+                        output = pipeline.split_output("mkv", self._chunked_recording.begin(), chunk_ns, 0)
+                    else:
+                        output = pipeline.file_output(self._fileformat, f"{self._filepath}.temp")
                 else:
                     logger.info("Setting local filepath")
-                    fileSinkPipeline = f" splitmuxsink name=sink muxer={muxer} muxer-pad-map=x-pad-map,audio=vid location={self._filepath} max-size-time=1000000000 max-files=480"
-                cmd = cmd + fileSinkPipeline
+                    output = pipeline.split_output(
+                        self._fileformat, self._filepath, plan.segment_ns, plan.max_files, start_index
+                    )
             else:
                 logger.info(f"Mode {self._mode} does not exist")
                 return
 
-            deckyRecordingSinkExists = subprocess.run(f"pactl list sinks | grep '{self._deckySinkModuleName}'", shell=True).returncode == 0
-
-            if deckyRecordingSinkExists:
-                logger.info(f"{self._deckySinkModuleName} already exists, rebuilding sink for safety")
-                await Plugin.cleanup_decky_pa_sink(self)
-
+            # Brings an existing sink in line with the settings instead of rebuilding it
             await Plugin.create_decky_pa_sink(self)
 
-            cmd = (
-                cmd
-                + f' pulsesrc device="{self._deckySinkModuleName}.monitor" ! audio/x-raw, channels=2 ! audioconvert ! avenc_aac bitrate={self._audioBitrate} ! sink.audio_0'
-            )
+            # Game audio first, then the mic when it is a track of its own, in mono at half the bitrate
+            audio = [pipeline.audio_source(self._audio_tracks[0]) + pipeline.audio_encode(self._audioBitrate)]
+            for source in self._audio_tracks[1:]:
+                audio.append(pipeline.audio_source(source) + pipeline.audio_encode(self._audioBitrate // 2, 1))
 
             # Starts the capture process
-            logger.info("Command: " + cmd)
-            self._recording_process = subprocess.Popen(cmd, shell=True, stdout=std_out_file, stderr=std_err_file)
+            argv = pipeline.recording_pipeline(video, audio, output).launch_argv()
+            self._pipeline_freed = False
+            self._capturingRolling = self._rolling
+            self._recording_process = await process.spawn(argv, env=start_env)
+            metrics.inc("pipeline_starts_total", labels={"encoder": encoder.factory, "preset": preset.name})
+            self._output_task = asyncio.get_event_loop().create_task(pump_gst_output(self, self._recording_process))
             logger.info("Recording started!")
         except Exception:
             await Plugin.stop_capturing(self)
+            if self._recording_process is None and self._chunked_recording is not None:
+                chunked_recording.remove_chunks(self._chunked_recording.directory)
+                self._chunked_recording = None
             logger.info(traceback.format_exc())
         return
 
@@ -244,27 +358,90 @@ class Plugin:
         if await Plugin.is_capturing(self) == False:
             logger.info("Error: No recording process to stop")
             return
+        if self._live_recording is not None:
+            await Plugin.stop_manual_recording(self)
         logger.info("Sending sigin")
         proc = self._recording_process
         self._recording_process = None
-        proc.send_signal(signal.SIGINT)
-        logger.info("Sigin sent. Waiting...")
+        stop_started = time.perf_counter()
+        stopped = False
         try:
-            proc.wait(timeout=10)
-            if not self._rolling:
-                # process the gstreamer output with ffmpeg again so that it can be uploaded to Twitter/X
-                logger.info("Process manual recording file with ffmpeg")
-                get_cmd_output(f'ffmpeg -i "{self._filepath}.temp" -c copy "{self._filepath}"')
-                get_cmd_output(f'rm "{self._filepath}.temp"')
-                logger.info("Process manual recording file with ffmpeg finished.")
+            if not await process.stop(proc, signal.SIGINT, timeout=10):
+                raise TimeoutError("gst-launch did not exit after SIGINT")
+            stopped = True
+            if not self._capturingRolling and self._chunked_recording is None:
+                # The muxer finalized the file on EOS, so it only has to be moved into place
+                os.replace(f"{self._filepath}.temp", self._filepath)
+                ready = time.perf_counter() - stop_started
+                logger.info(f"Recording saved to {self._filepath}, {ready:.2f}s after stop")
+                Plugin.clip_saved(self, self._filepath)
+                if self._metricsEnabled:
+                    metrics.inc("bytes_written_total", os.path.getsize(self._filepath), {"kind": "recording"})
         except Exception:
             logger.warn("Could not interrupt gstreamer, killing instead")
             await Plugin.clear_rogue_gst_processes(self)
         logger.info("Waiting finished. Recording stopped!")
+        if self._output_task is not None:
+            # Lets the messages about the last fragment reach the index
+            try:
+                await asyncio.wait_for(asyncio.shield(self._output_task), 2)
+            except Exception:
+                pass
 
+        if self._chunked_recording is not None:
+            await Plugin.join_chunks(self, complete=stopped)
+        elif not self._capturingRolling and not stopped and os.path.exists(f"{self._filepath}.temp"):
+            # Killed before EOS, what reached the disk can still be saved
+            Plugin.recover_recordings(self, [], [f"{self._filepath}.temp"])
         await Plugin.cleanup_decky_pa_sink(self)
+        # Replay mode was turned on during a standalone recording. Not when the watchdog
+        # stopped it because gamescope exited, the buffer only records in game mode.
+        in_gm = self._session_tracker is not None and self._session_tracker.active()
+        if not self._capturingRolling and self._rolling and not self._sleeping and in_gm:
+            await Plugin.start_capturing(self)
         return
 
+    # In replay mode a manual recording is cut from the running buffer instead of
+    # starting a second pipeline, so the buffer and its history keep going
+    async def start_manual_recording(self, app_name: str = ""):
+        if not self._rolling:
+            return await Plugin.start_capturing(self, app_name)
+        if self._live_recording is not None:
+            logger.info("Error: Already recording")
+            return
+        if not await Plugin.is_capturing(self):
+            await Plugin.start_capturing(self)
+        dateTime = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        output = f"{self._localFilePath}/{clean_app_name(app_name)}_{dateTime}.{self._fileformat}"
+        self._live_recording = LiveRecording(output, self._fileformat, self._segment_index.now())
+        logger.info(f"Recording {output} from the replay buffer")
+
+    async def stop_manual_recording(self):
+        live = self._live_recording
+        if live is None:
+            if not self._capturingRolling:
+                await Plugin.stop_capturing(self)
+            return
+        complete = await live.stop(self._segment_index.now())
+        self._live_recording = None
+        if complete:
+            logger.info(f"Recording saved to {live.output}")
+            Plugin.clip_saved(self, live.output)
+        elif live.segments:
+            job = self._export_queue.submit(
+                live.segments, live.output, live.duration, live.start, live.end, coalesce=False
+            )
+            logger.info(f"Joining recording {live.output} in export {job.id}")
+        else:
+            logger.warning(f"Recording {live.output} has no fragment of the buffer, nothing was saved")
+            return 0
+        return live.duration
+
+    async def is_manual_recording(self):
+        if self._live_recording is not None:
+            return True
+        return await Plugin.is_capturing(self, verbose=False) and not self._capturingRolling
+
     # Returns true if the plugin is currently capturing
     async def is_capturing(self, verbose=True):
         if verbose:
@@ -278,11 +455,10 @@ class Plugin:
 
     async def enable_rolling(self):
         logger.info("Enable rolling was called begin")
-        # if capturing, stop that capture, then re-enable with rolling
-        if await Plugin.is_capturing(self):
-            await Plugin.stop_capturing(self)
         self._rolling = True
-        await Plugin.start_capturing(self)
+        # A standalone recording keeps going, the buffer starts once it is stopped
+        if not await Plugin.is_capturing(self):
+            await Plugin.start_capturing(self)
         await Plugin.saveConfig(self)
         logger.info("Enable rolling was called end")
 
@@ -290,107 +466,131 @@ class Plugin:
         logger.info("Disable rolling was called begin")
         # turn rolling off ASAP to avoid race condition with watchdog
         self._rolling = False
-        if await Plugin.is_capturing(self):
+        if await Plugin.is_capturing(self) and self._capturingRolling:
             await Plugin.stop_capturing(self)
         await Plugin.saveConfig(self)
         try:
-            for path in list(Path(self._rollingRecordingFolder).glob(f"{self._rollingRecordingPrefix}*")):
-                os.remove(str(path))
+            # Both tiers, except fragments a queued export is still waiting to join. The disk
+            # tier is only known to the buffer once a pipeline started since the plugin loaded.
+            self._buffer.configure(disk_folder=f"{self._localFilePath}/{self._bufferSpillFolderName}")
+            self._buffer.discard()
             logger.info("Deleted all files in rolling buffer")
         except Exception:
             logger.exception("Failed to delete rolling recording buffer files")
         logger.info("Disable rolling was called end")
 
-    async def create_decky_pa_sink(self):
-        logger.info("Making audio pipeline")
-        # Creates audio pipeline
-        audio_device_output = get_cmd_output("pactl get-default-sink")
+    async def reconcile_audio(self, mic_enabled: bool = None):
+        if mic_enabled is None:
+            mic_enabled = self._micEnabled
+        default_sink = await self._audio.default_sink()
         # expected output: alsa_output.pci-0000_04_00.5-platform-acp5x_mach.0.HiFi__hw_acp5x_1__sink when using internal speaker
         # bluez_output.20_74_CF_F1_C0_1E.1 when using bluetooth
-        logger.info(f"Creating {self._deckySinkModuleName}")
-
-        get_cmd_output(f"pactl load-module module-null-sink sink_name={self._deckySinkModuleName}")
-
-        get_cmd_output(f"pactl load-module module-loopback source={audio_device_output}.monitor sink={self._deckySinkModuleName}")
+        if mic_enabled and self._micSource == "NA":
+            self._micSource = await Plugin.get_default_mic(self)
+        denoise = await Plugin.enhanced_noise_binary_exists(self)
+        graph = recording_graph(
+            self._deckySinkModuleName,
+            default_sink,
+            mic_enabled=mic_enabled,
+            mic_source=self._micSource,
+            mic_gain=self._micGain,
+            mic_name=self._echoCancelledMicName,
+            echo_cancelled_audio_name=self._echoCancelledAudioName,
+            denoise_plugin=self._optional_denoise_binary_path if denoise else None,
+            noise_reduction_percent=self._noiseReductionPercent,
+            separate=self._separateAudioTracks,
+        )
+        result = await self._audio_reconciler.apply(graph)
+        self._audio_tracks = graph.tracks
+        return result
 
-        if await Plugin.is_mic_enabled(self):
-            await Plugin.attach_mic(self)
+    async def create_decky_pa_sink(self):
+        logger.info("Making audio pipeline")
+        try:
+            await Plugin.reconcile_audio(self)
+        except Exception:
+            # Record game audio even if the mic chain could not be built
+            logger.exception("Could not build audio graph with microphone")
+            await Plugin.reconcile_audio(self, mic_enabled=False)
 
     async def cleanup_decky_pa_sink(self):
-        unload_pa_modules("Echo-Cancelled")
-        unload_pa_modules(f"{self._deckySinkModuleName}")
+        await self._audio_reconciler.apply(AudioGraph())
 
     async def get_default_mic(self):
-        return get_cmd_output("pactl get-default-source")
+        return await self._audio.default_source()
 
     async def is_mic_enabled(self):
         logger.info(f"Is mic enabled? {self._micEnabled}")
         return self._micEnabled
 
     async def is_mic_attached(self):
-        is_attached = subprocess.run("pactl list modules | grep 'Echo-Cancelled'",shell=True).returncode == 0
+        is_attached = len(await self._audio.modules_matching("Echo-Cancelled")) > 0
         logger.info(f"Is mic attached? {is_attached}")
         return is_attached
 
     async def attach_mic(self):
         logger.info(f"Attaching Microphone {self._echoCancelledMicName}")
-
-        if self._micSource == "NA":
-            self._micSource = await Plugin.get_default_mic(self)
-
-        # check if the user has downloaded the optional noise cancellation binary
-        if await Plugin.enhanced_noise_binary_exists(self):
-            # attached echo cancelled mic
-
-            get_cmd_output(f"pactl load-module module-null-sink sink_name={self._echoCancelledMicName} rate=48000")
-
-            get_cmd_output(f"pactl load-module module-ladspa-sink sink_name={self._echoCancelledMicName}_raw_in sink_master={self._echoCancelledMicName} label=noise_suppressor_mono plugin={self._optional_denoise_binary_path} control={self._noiseReductionPercent},20,0,0,0")
-
-            # This module cannot use @DEFAULT_SOURCE@, don't know why
-            get_cmd_output(f"pactl load-module module-loopback source={self._micSource} sink={self._echoCancelledMicName}_raw_in channels=1 source_dont_move=true sink_dont_move=true")
-
-            get_cmd_output(f"pactl set-source-volume {self._echoCancelledMicName}.monitor {self._micGain}db")
-
-            get_cmd_output(f"pactl load-module module-loopback source={self._echoCancelledMicName}.monitor sink={self._deckySinkModuleName}")
-        else:
-            audio_device_output = get_cmd_output("pactl get-default-sink")
-
-            get_cmd_output(f"pactl load-module module-echo-cancel use_master_format=1 source_master={self._micSource} sink_master={audio_device_output} source_name={self._echoCancelledMicName} sink_name={self._echoCancelledAudioName} aec_method='webrtc' aec_args='analog_gain_control=0 digital_gain_control=1'")
-            get_cmd_output(f"pactl set-source-volume Echo-Cancelled-Mic {self._micGain}db")
-            get_cmd_output(f"pactl load-module module-loopback source={self._echoCancelledMicName} sink={self._deckySinkModuleName}")
-            get_cmd_output(f"pactl load-module module-loopback source={self._echoCancelledAudioName}.monitor sink={self._deckySinkModuleName}")
+        await Plugin.reconcile_audio(self, mic_enabled=True)
 
     async def detach_mic(self):
         logger.info(f"Detaching Microphone {self._echoCancelledMicName}")
-        unload_pa_modules("Echo-Cancelled")
+        await Plugin.reconcile_audio(self, mic_enabled=False)
 
     async def enable_microphone(self):
         logger.info("Enable microphone")
+        self._micEnabled = True
         if await Plugin.is_capturing(self):
-            if not await Plugin.is_mic_attached(self):
+            if self._separateAudioTracks:
+                await Plugin.restart_for_audio_tracks(self)
+            elif not await Plugin.is_mic_attached(self):
                 await Plugin.attach_mic(self)
-        self._micEnabled = True
         await Plugin.saveConfig(self)
         logger.info("Enable mic was called end")
 
     async def disable_microphone(self):
         logger.info("Disable microphone")
+        self._micEnabled = False
         # if capturing, stop that capture, then re-enable with rolling
         if await Plugin.is_capturing(self):
-            if await Plugin.is_mic_attached(self):
+            if self._separateAudioTracks:
+                await Plugin.restart_for_audio_tracks(self)
+            elif await Plugin.is_mic_attached(self):
                 await Plugin.detach_mic(self)
-        self._micEnabled = False   
         await Plugin.saveConfig(self)
         logger.info("Disable mic was called end")
-    
+
+    async def restart_for_audio_tracks(self):
+        """The track layout is fixed when the pipeline starts, so the replay buffer
+        starts over with the new one. A manual recording keeps its tracks until
+        it is stopped."""
+        if not self._capturingRolling:
+            return
+        logger.info("Audio tracks changed, restarting the replay buffer")
+        await Plugin.stop_capturing(self)
+        await Plugin.start_capturing(self)
+
+    async def get_separate_audio_tracks(self):
+        return self._separateAudioTracks
+
+    async def set_separate_audio_tracks(self, separate: bool):
+        separate = bool(separate)
+        if separate == self._separateAudioTracks:
+            return separate
+        logger.info(f"Audio tracks {'separate' if separate else 'mixed'}")
+        self._separateAudioTracks = separate
+        await Plugin.saveConfig(self)
+        if await Plugin.is_capturing(self, verbose=False):
+            await Plugin.restart_for_audio_tracks(self)
+        return separate
+
     async def get_mic_gain(self):
         return self._micGain
 
     async def update_mic_gain(self, new_gain: float):
         self._micGain = float(new_gain)
         if await Plugin.is_capturing(self):
-            if await Plugin.is_mic_attached(self):
-                get_cmd_output(f"pactl set-source-volume Echo-Cancelled-Mic {self._micGain}db")
+            if await Plugin.is_mic_enabled(self):
+                await Plugin.reconcile_audio(self)
         await Plugin.saveConfig(self)
 
     async def enhanced_noise_binary_exists(self):
@@ -404,8 +604,7 @@ class Plugin:
         self._noiseReductionPercent = int(new_percent)
         if await Plugin.is_capturing(self):
             if await Plugin.is_mic_enabled(self):
-                await Plugin.detach_mic(self)
-                await Plugin.attach_mic(self)
+                await Plugin.reconcile_audio(self)
         await Plugin.saveConfig(self)
 
     async def get_mic_source(self):
@@ -413,7 +612,7 @@ class Plugin:
 
     async def get_mic_sources(self):
         logger.info(f"Getting available mic sources")
-        raw_sources = get_cmd_output("pactl list short sources | awk '{print $2}'").split("\n")
+        raw_sources = await self._audio.source_names()
         default_source = await Plugin.get_default_mic(self)
         sources_json = [{"data": f"{default_source}", "label": "Default Mic"}]
         for source in raw_sources:
@@ -429,8 +628,8 @@ class Plugin:
         self._micSource = new_mic_source
         if await Plugin.is_capturing(self):
             if await Plugin.is_mic_enabled(self):
-                await Plugin.detach_mic(self)
-                await Plugin.attach_mic(self)
+                await Plugin.reconcile_audio(self)
+        await Plugin.saveConfig(self)
 
     # Sets the current mode, supported modes are: localFile
     async def set_current_mode(self, mode: str):
@@ -445,11 +644,12 @@ class Plugin:
     # Sets audio bitrate
     async def set_audio_bitrate(self, audioBitrate: int):
         logger.info(f"New audio bitrate: {audioBitrate}")
-        self._audioBitrate = audioBitrate
+        self._audioBitrate = int(audioBitrate)
+        await Plugin.saveConfig(self)
 
     # Gets the audio bitrate
     async def get_audio_bitrate(self):
-        logger.info("Current audio bitrate: " + self._audioBitrate)
+        logger.info(f"Current audio bitrate: {self._audioBitrate}")
         return self._audioBitrate
 
     # Sets local FilePath
@@ -457,6 +657,7 @@ class Plugin:
         logger.info("New local filepath: " + localFilePath)
         self._localFilePath = localFilePath
         await Plugin.saveConfig(self)
+        Plugin.reconcile_clips(self)
 
     # Gets the local FilePath
     async def get_local_filepath(self):
@@ -475,58 +676,461 @@ class Plugin:
         return self._fileformat
 
     async def loadConfig(self):
-        logger.info("Loading settings from: {}".format(os.path.join(settingsDir, "decky-loader-settings.json")))
-        ### TODO: IMPLEMENT ###
-        self._settings = SettingsManager(name="decky-loader-settings", settings_directory=settingsDir)
-        self._settings.read()
+        path = os.path.join(settingsDir, "decky-loader-settings.json")
+        logger.info(f"Loading settings from: {path}")
+        self._settings = SettingsStore(path, SETTINGS)
+        await self._settings.load()
         self._mode = "localFile"
-        self._audioBitrate = 192000
-
-        self._localFilePath = self._settings.getSetting("output_folder", decky_plugin.DECKY_HOME + "/Videos")
-        self._fileformat = self._settings.getSetting("format", "mkv")
-        self._rolling = self._settings.getSetting("rolling", False)
-        self._micEnabled = self._settings.getSetting("mic_enabled", False)
-        self._micGain = self._settings.getSetting("mic_gain", 13.0)
-        self._noiseReductionPercent = self._settings.getSetting("noise_reduction_percent", 50.0)
-
-        # Need this for initialization only honestly
-        await Plugin.saveConfig(self)
-        return
+        for setting in SETTINGS:
+            setattr(self, setting.attr, self._settings.get(setting.attr))
+        Plugin.apply_metrics_settings(self)
 
     async def saveConfig(self):
-        logger.info("Saving config")
-        self._settings.setSetting("format", self._fileformat)
-        self._settings.setSetting("output_folder", self._localFilePath)
-        self._settings.setSetting("rolling", self._rolling)
-        self._settings.setSetting("mic_enabled", self._micEnabled)
-        self._settings.setSetting("mic_gain", self._micGain)
-        self._settings.setSetting("noise_reduction_percent", self._noiseReductionPercent )
-
-        return
+        # Only marks what changed, the store writes it out shortly after in one go
+        for setting in SETTINGS:
+            self._settings.set(setting.attr, getattr(self, setting.attr))
+
+    def setup_pipeline_events(self):
+        self._gst_output = gst_output.GstOutput(str(std_out_file_path))
+        events = self._gst_output.events
+
+        def index():
+            # A standalone recording's chunks are kept apart from the replay buffer
+            chunks = self._chunked_recording
+            return chunks.index if chunks is not None else self._segment_index
+
+        def fragment_opened(e):
+            index().fragment_opened(e.fields["location"], int(e.fields["running-time"]))
+            if self._resume_started is not None:
+                latency = time.perf_counter() - self._resume_started
+                self._resume_started = None
+                self._sleep_stats["resume_to_segment_seconds"] = latency
+                metrics.set_gauge("resume_first_segment_seconds", latency)
+                logger.info(f"Replay buffer recording again {latency:.2f}s after resume")
+            if self._startup is not None and self._startup.report.first_segment_after is None:
+                self._startup.first_segment()
+                metrics.set_gauge("startup_first_segment_seconds", self._startup.report.first_segment_after)
+
+        events.subscribe(gst_output.FRAGMENT_OPENED, fragment_opened)
+
+        async def index_fragment(segment):
+            if segment.path.endswith(".mkv"):
+                try:
+                    segment.keyframes = (
+                        await asyncio.get_event_loop().run_in_executor(None, matroska.keyframe_offsets, segment.path)
+                    ) or [0]
+                except (OSError, matroska.MatroskaError) as e:
+                    logger.warning(f"Could not index keyframes of {segment.path}: {e}")
+            self._export_queue.segment_closed()
+            if self._live_recording is not None:
+                await self._live_recording.on_fragment_closed(segment)
+            await self._buffer.on_fragment_closed(segment)
+
+        def fragment_closed(e):
+            chunks = self._chunked_recording
+            segment = index().fragment_closed(e.fields["location"], int(e.fields["running-time"]))
+            if segment is not None and chunks is not None:
+                asyncio.get_event_loop().create_task(chunks.on_fragment_closed(segment))
+                return
+            if segment is not None:
+                metrics.inc("segments_written_total")
+                metrics.inc("bytes_written_total", segment.size, {"kind": "fragment"})
+                if segment.duration > 0:
+                    metrics.set_gauge("segment_write_bytes_per_second", segment.size * 1e9 / segment.duration)
+            if segment is not None and self._buffer is not None:
+                asyncio.get_event_loop().create_task(index_fragment(segment))
+
+        def property_changed(e):
+            # videorate notifies its running drop count
+            if "drop" in e.fields:
+                metrics.set_gauge("pipeline_dropped_frames", int(e.fields["drop"]), {"element": "videorate"})
+
+        def qos(e):
+            # Elements that fall behind post QoS messages with their running drop count
+            if "dropped" in e.fields:
+                metrics.set_gauge("pipeline_dropped_frames", int(e.fields["dropped"]), {"element": e.source})
+
+        def error(e):
+            metrics.inc("pipeline_errors_total")
+            logger.error(f"gstreamer: {e.line}")
+
+        events.subscribe(gst_output.FRAGMENT_CLOSED, fragment_closed)
+        events.subscribe(gst_output.PROPERTY, property_changed)
+        events.subscribe("qos", qos)
+        events.subscribe(gst_output.FREEING, lambda e: setattr(self, "_pipeline_freed", True))
+        events.subscribe(gst_output.ERROR, error)
 
     async def _main(self):
-        loop = asyncio.get_event_loop()
-        self._watchdog_task = loop.create_task(Plugin.watchdog(self))
+        self._startup = startup.StartupSequencer()
+        Plugin.setup_pipeline_events(self)
+        self._export_queue = ExportQueue(self._rollingRecordingFolder, is_current=self._segment_index.contains)
+        self._export_queue.start()
+
+        def live():
+            return self._live_recording
+
+        self._encoder_probe = pipeline.EncoderProbe(gst_env())
+        self._buffer = BufferManager(
+            self._segment_index,
+            self._rollingRecordingFolder,
+            self._rollingRecordingPrefix,
+            in_use=lambda path: self._export_queue.in_use(path) or (live() is not None and live().in_use(path)),
+            retained=lambda path: live() is not None and live().retains(path),
+        )
+        self._audio = AudioServer()
+        self._audio_reconciler = AudioGraphReconciler(
+            self._audio, (self._deckySinkModuleName, self._echoCancelledMicName, self._echoCancelledAudioName)
+        )
         await Plugin.loadConfig(self)
-        if await Plugin.is_rolling(self):
-            # Prevent bug where pulseaudio is not yet ready on fresh restart
-            logger.info("Waiting 5 seconds before starting Decky Recorder")
-            await asyncio.sleep(5)
+        self._clip_catalog = ClipCatalog(
+            os.path.join(settingsDir, "clips.sqlite3"), os.path.join(settingsDir, "clip-thumbnails")
+        )
+        await self._clip_catalog.open()
+        # Steam starts every game under `reaper SteamLaunch AppId=...`
+        self._game_tracker = SessionTracker("SteamLaunch")
+        self._compression = CompressionPool(
+            os.path.join(settingsDir, "compress-jobs.json"),
+            busy=self._game_tracker.active,
+            on_replaced=lambda path: asyncio.get_event_loop().create_task(self._clip_catalog.add(path)),
+            # A paused encode resumes the moment the game exits instead of on the next poll
+            wait_change=self._game_tracker.wait_change,
+        )
+        await self._compression.start(self._compressEnabled, self._compressPreset, self._compressWorkers)
+        self._export_queue.on_finished(lambda job: Plugin.export_finished(self, job))
+
+        async def audio_ready():
+            await self._audio.connect()
+            return bool(await self._audio.default_sink())
+
+        # On a fresh boot the audio server and the screencast node may not be up yet
+        probes = {"audio server": audio_ready}
+        rolling = await Plugin.is_rolling(self)
+        # Rogue pipelines are gone and nothing records yet, so whatever is half written was cut short
+        Plugin.recover_recordings(self)
+        if rolling:
+            probes["screencast"] = lambda: startup.pipewire_video_source(self._runtimeDir)
+        if not await self._startup.wait_ready(probes):
+            logger.warning(f"Still waiting on {self._startup.report.waiting_on}, starting anyway")
+        metrics.set_gauge("startup_ready_seconds", self._startup.elapsed())
+        # Started after the probes so it does not race them to start the capture
+        self._watchdog_task = asyncio.get_event_loop().create_task(Plugin.watchdog(self))
+        self._sleep_monitor = SleepMonitor(
+            lambda: Plugin.prepare_for_sleep(self), lambda: Plugin.resume_from_sleep(self)
+        )
+        await self._sleep_monitor.start()
+        if rolling:
             await Plugin.start_capturing(self)
+        # Catches up with clips added or deleted while the plugin was not running
+        Plugin.reconcile_clips(self)
         return
 
     async def _unload(self):
         logger.info("Unload was called")
+        if self._sleep_monitor is not None:
+            await self._sleep_monitor.close()
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+            self._metrics_task = None
+        if self._watchdog_task is not None:
+            # First, so it cannot restart the capture that is stopped next
+            self._watchdog_task.cancel()
+            self._watchdog_task = None
+        if self._session_tracker is not None:
+            self._session_tracker.close()
         if await Plugin.is_capturing(self) == True:
             logger.info("Cleaning up")
             await Plugin.stop_capturing(self)
             await Plugin.saveConfig(self)
+        if self._output_task is not None:
+            self._output_task.cancel()
+            self._output_task = None
+        if self._export_queue is not None:
+            # Interrupted chunk joins keep their chunks and run again on the next start
+            await self._export_queue.close()
+        if self._settings is not None:
+            # Writes out whatever is still waiting for the debounce
+            await self._settings.close()
+        if self._catalog_task is not None:
+            self._catalog_task.cancel()
+            self._catalog_task = None
+        if self._recovery_task is not None:
+            self._recovery_task.cancel()
+            self._recovery_task = None
+        if self._compression is not None:
+            await self._compression.close()
+        if self._game_tracker is not None:
+            self._game_tracker.close()
+        if self._clip_catalog is not None:
+            await self._clip_catalog.close()
+        if self._audio is not None:
+            await self._audio.close()
         return
 
+    async def prepare_for_sleep(self):
+        """Finishes the capture before a suspend, so the last fragment is complete."""
+        self._sleeping = True
+        self._sleep_stats["suspends"] += 1
+        self._resumeCapture = await Plugin.is_capturing(self, verbose=False) and self._capturingRolling
+        if await Plugin.is_capturing(self, verbose=False):
+            await Plugin.stop_capturing(self)
+
+    async def resume_from_sleep(self):
+        """Continues the replay buffer where it stopped before the suspend."""
+        self._sleeping = False
+        resumed = time.perf_counter()
+        # The wakeup count has moved on, the watchdog must not restart the capture for it
+        self._wakeup_count = read_sysfs_int(WAKEUP_COUNT_PATH, self._wakeup_count)
+        resume, self._resumeCapture = self._resumeCapture, False
+        if not self._rolling or await Plugin.is_capturing(self, verbose=False):
+            return
+        self._resume_started = resumed
+        # A buffer that was running continues, otherwise replay mode starts fresh
+        await Plugin.start_capturing(self, resume=resume)
+        self._sleep_stats["resume_to_capture_seconds"] = time.perf_counter() - resumed
+
+    async def get_sleep_status(self):
+        return {
+            "monitor": self._sleep_monitor is not None and self._sleep_monitor.active,
+            "suspend_seconds": self._sleep_monitor.suspend_seconds if self._sleep_monitor is not None else None,
+            "sleeping": self._sleeping,
+            **self._sleep_stats,
+        }
+
+    async def get_startup_status(self):
+        return self._startup.report.as_dict() if self._startup is not None else None
+
+    async def get_encoding_presets(self):
+        return [preset.as_dict() for preset in pipeline.PRESETS.values()]
+
+    async def get_encoding_preset(self):
+        return self._encodingPreset
+
+    async def set_encoding_preset(self, preset: str):
+        if preset not in pipeline.PRESETS:
+            logger.warn(f"Unknown encoding preset {preset}")
+            return False
+        logger.info("New encoding preset: " + preset)
+        self._encodingPreset = preset
+        await Plugin.saveConfig(self)
+        return True
+
+    async def get_encoders(self):
+        available = await self._encoder_probe.available()
+        return {"available": [e.factory for e in available], "preferred": self._videoEncoder}
+
+    async def set_video_encoder(self, encoder: str):
+        logger.info("New preferred encoder: " + encoder)
+        self._videoEncoder = encoder
+        await Plugin.saveConfig(self)
+        return True
+
+    async def get_buffer_status(self):
+        return self._buffer.status()
+
+    async def set_buffer_limits(self, ram_budget_mib: int, target_seconds: int):
+        logger.info(f"New rolling buffer limits: {ram_budget_mib} MiB, {target_seconds}s")
+        self._bufferRamBudgetMiB = int(ram_budget_mib)
+        self._bufferTargetSeconds = int(target_seconds)
+        self._buffer.configure(self._bufferRamBudgetMiB * MiB, self._bufferTargetSeconds)
+        await Plugin.saveConfig(self)
+        # Fragment length only changes with the next pipeline, the budget applies right away
+        await self._buffer.enforce()
+        return self._buffer.status()
+
+    def collect_metrics(self):
+        """Samples state that is cheaper to read on demand than to track."""
+        if self._buffer is not None:
+            status = self._buffer.status()
+            for tier in ("ram", "disk"):
+                metrics.set_gauge("buffer_seconds", status[tier]["seconds"], {"tier": tier})
+                metrics.set_gauge("buffer_bytes", status[tier]["bytes"], {"tier": tier})
+        if self._export_queue is not None:
+            states = [job["state"] for job in self._export_queue.jobs()]
+            for state in ("queued", "running"):
+                metrics.set_gauge("export_queue_jobs", states.count(state), {"state": state})
+        watchdog = self._watchdog_stats.as_dict()
+        metrics.set_gauge("watchdog_ticks", watchdog["ticks"])
+        metrics.set_gauge("watchdog_tick_cpu_avg_us", watchdog["cpu_avg_us"])
+        metrics.set_gauge("watchdog_tick_cpu_max_us", watchdog["cpu_max_us"])
+
+    def apply_metrics_settings(self):
+        metrics.REGISTRY.enabled = self._metricsEnabled
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+            self._metrics_task = None
+        if self._metricsEnabled and self._metricsFile:
+            self._metrics_task = asyncio.get_event_loop().create_task(
+                metrics.dump_periodically(self._metricsFile, collect=lambda: Plugin.collect_metrics(self))
+            )
+
+    async def get_metrics(self):
+        if self._metricsEnabled:
+            Plugin.collect_metrics(self)
+        return metrics.REGISTRY.snapshot()
+
+    async def set_metrics_enabled(self, enabled: bool, metrics_file: str = None):
+        logger.info(f"Metrics {'enabled' if enabled else 'disabled'}")
+        if enabled and not self._metricsEnabled:
+            metrics.REGISTRY.reset()
+        self._metricsEnabled = bool(enabled)
+        if metrics_file is not None:
+            self._metricsFile = metrics_file
+        Plugin.apply_metrics_settings(self)
+        await Plugin.saveConfig(self)
+        return self._metricsEnabled
+
+    def clip_saved(self, path: str):
+        """Adds a saved clip to the catalog and the compression queue, in the background."""
+        if self._clip_catalog is not None:
+            asyncio.get_event_loop().create_task(self._clip_catalog.add(path))
+        if self._compression is not None and self._compression.enabled:
+            try:
+                large = os.path.getsize(path) >= self._compressMinMiB * MiB
+            except OSError:
+                large = False
+            if large:
+                self._compression.submit(path)
+
+    def export_finished(self, job):
+        self._buffer.release(job.segments)
+        directory = self._chunk_exports.pop(job.id, None)
+        if job.state != "done":
+            if directory is not None:
+                logger.warning(f"Keeping the chunks in {directory}, they are joined again on the next start")
+            return
+        if directory is not None:
+            chunked_recording.remove_chunks(directory)
+        Plugin.clip_saved(self, job.output)
+
+    def export_chunks(self, directory: str, output: str, segments: list):
+        if output is None or not segments:
+            logger.warning(f"Nothing to save in {directory}")
+            chunked_recording.remove_chunks(directory)
+            return None
+        duration = sum(s.duration for s in segments) / NS_PER_SECOND
+        job = self._export_queue.submit(segments, output, duration, coalesce=False, buffered=False)
+        self._chunk_exports[job.id] = directory
+        logger.info(f"Joining {len(segments)} chunks into {output} in export {job.id}")
+        return job
+
+    async def join_chunks(self, complete: bool = True):
+        recording, self._chunked_recording = self._chunked_recording, None
+        segments = recording.segments()
+        if not complete or not all(os.path.exists(s.path) for s in segments):
+            # The last chunk never closed, so the chunks on disk say best what was captured
+            _, segments = await asyncio.get_event_loop().run_in_executor(
+                None, chunked_recording.recover_chunks, recording.directory
+            )
+        logger.info(f"Recorded {sum(s.duration for s in segments) / NS_PER_SECOND:.1f}s in {len(segments)} chunks")
+        Plugin.export_chunks(self, recording.directory, recording.output, segments)
+
+    def recover_recordings(self, chunk_dirs: list = None, temps: list = None):
+        """Saves what recordings cut short by a crash or a kill left behind, in the
+        background. Without arguments the output folder is searched, so it must
+        only be called while nothing records into it."""
+        if chunk_dirs is None and temps is None:
+            chunk_dirs, temps = chunked_recording.find_orphans(self._localFilePath)
+        if not chunk_dirs and not temps:
+            return
+        logger.info(f"Recovering {len(chunk_dirs)} chunked and {len(temps)} unfinished recordings")
+
+        async def recover():
+            for directory in chunk_dirs:
+                try:
+                    output, segments = await asyncio.get_event_loop().run_in_executor(
+                        None, chunked_recording.recover_chunks, directory
+                    )
+                except OSError as e:
+                    logger.warning(f"Cannot recover {directory}: {e}")
+                    continue
+                if Plugin.export_chunks(self, directory, output, segments) is not None:
+                    metrics.inc("recordings_recovered_total", labels={"kind": "chunks"})
+            for path in temps:
+                try:
+                    output = await chunked_recording.recover_temp(path)
+                except Exception:
+                    logger.exception(f"Cannot recover {path}")
+                    continue
+                if output is not None:
+                    logger.info(f"Recovered {path} as {output}")
+                    metrics.inc("recordings_recovered_total", labels={"kind": "temp"})
+                    Plugin.clip_saved(self, output)
+
+        self._recovery_task = asyncio.get_event_loop().create_task(recover())
+
+    async def get_chunked_recording(self):
+        return {"enabled": self._chunkedRecording, "chunk_seconds": self._recordingChunkSeconds}
+
+    async def set_chunked_recording(self, enabled: bool, chunk_seconds: int = None):
+        logger.info(f"Chunked recording {'enabled' if enabled else 'disabled'}")
+        # Takes effect with the next standalone recording
+        self._chunkedRecording = bool(enabled)
+        if chunk_seconds is not None:
+            self._recordingChunkSeconds = max(1, int(chunk_seconds))
+        await Plugin.saveConfig(self)
+        return await Plugin.get_chunked_recording(self)
+
+    def reconcile_clips(self):
+        if self._clip_catalog is None:
+            return
+        if self._catalog_task is not None:
+            self._catalog_task.cancel()
+        self._catalog_task = asyncio.get_event_loop().create_task(self._clip_catalog.reconcile(self._localFilePath))
+
+    async def list_clips(self, offset: int = 0, limit: int = 50, app_name: str = None):
+        return await self._clip_catalog.list_clips(offset, limit, app_name or None)
+
+    async def get_clip_thumbnail(self, clip_id: int):
+        """The clip's thumbnail as a data URL, or None until it is extracted."""
+        path = await self._clip_catalog.thumbnail(clip_id)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return "data:image/jpeg;base64," + base64.b64encode(f.read()).decode()
+        except OSError:
+            return None
+
+    async def prune_clips(self, max_bytes: int = None, max_age_days: float = None, dry_run: bool = False):
+        logger.info(f"Pruning clips to {max_bytes} bytes, {max_age_days} days")
+        return await self._clip_catalog.prune(
+            int(max_bytes) if max_bytes is not None else None,
+            float(max_age_days) if max_age_days is not None else None,
+            bool(dry_run),
+        )
+
+    async def get_compression_presets(self):
+        return [preset.as_dict() for preset in compress.PRESETS.values()]
+
+    async def get_compression_status(self):
+        return {**self._compression.status(), "min_mib": self._compressMinMiB}
+
+    async def set_compression(self, enabled: bool, preset: str = None, workers: int = None, min_mib: int = None):
+        logger.info(f"Compression {'enabled' if enabled else 'disabled'}")
+        self._compression.configure(bool(enabled), preset, workers)
+        self._compressEnabled = self._compression.enabled
+        self._compressPreset = self._compression.preset
+        self._compressWorkers = self._compression.workers
+        if min_mib is not None:
+            self._compressMinMiB = int(min_mib)
+        await Plugin.saveConfig(self)
+        return await Plugin.get_compression_status(self)
+
+    async def compress_clip(self, path: str):
+        job = self._compression.submit(path)
+        return job.as_dict() if job is not None else None
+
+    async def cancel_compression(self, job_id: int):
+        return self._compression.cancel(int(job_id))
+
+    async def get_export_jobs(self):
+        return self._export_queue.jobs()
+
+    async def cancel_export(self, job_id: int):
+        return self._export_queue.cancel(int(job_id))
+
     async def save_rolling_recording(self, clip_duration: float = 30.0, app_name: str = ""):
-        app_name = str(app_name).replace(":", " ").replace("/", " ")
-        if app_name == "" or app_name == "null":
-            app_name = "Decky-Recorder"
+        app_name = clean_app_name(app_name)
         clip_duration = int(clip_duration)
         logger.info("Called save rolling function")
 
@@ -535,37 +1139,29 @@ class Plugin:
             await Plugin.start_capturing(self)
             return -1
 
-        if time.time() - self._last_clip_time < 2:
-            logger.info("Too early to record another clip")
-            return 0
         try:
             clip_duration = float(clip_duration)
-            files = list(Path(self._rollingRecordingFolder).glob(f"{self._rollingRecordingPrefix}*.{self._fileformat}"))
-            times = [os.path.getctime(p) for p in files]
-            ft = sorted(zip(files, times), key=lambda x: -x[1])
-            max_time = time.time()
-            files_to_stitch = []
-            actual_dur = 0.0
-            for f, ftime in ft:
-                if max_time - ftime <= clip_duration:
-                    actual_dur = max_time - ftime
-                    files_to_stitch.append(f)
-            with open(self._rollingRecordingFolder + "/files", "w") as ff:
-                for f in reversed(files_to_stitch):
-                    ff.write(f"file {str(f)}\n")
+            # Snapshot the segments now, the export itself runs in the background
+            segments, start, end = self._segment_index.clip(clip_duration)
+            if not segments or end <= start:
+                logger.warn("Rolling buffer has no footage yet")
+                return 0
 
             dateTime = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-            ffmpeg = subprocess.Popen(
-                f'ffmpeg -hwaccel vaapi -hwaccel_output_format vaapi -vaapi_device /dev/dri/renderD128 -f concat -safe 0 -i {self._rollingRecordingFolder}/files -c copy "{self._localFilePath}/{app_name}-{clip_duration}s-{dateTime}.{self._fileformat}"',
-                shell=True,
-                stdout=std_out_file,
-                stderr=std_err_file,
+            job = self._export_queue.submit(
+                segments,
+                f"{self._localFilePath}/{app_name}-{clip_duration}s-{dateTime}.{self._fileformat}",
+                clip_duration,
+                start,
+                end,
             )
-            ffmpeg.wait()
-            os.remove(self._rollingRecordingFolder + "/files")
-            self._last_clip_time = time.time()
-            logger.info("finish save rolling function")
-            return int(actual_dur)
+            logger.info(f"finish save rolling function, export job {job.id} covers {job.duration:.2f}s")
+            # What the clip will cover, get_export_jobs has what was written once the job is done
+            return {"job": job.id, "duration": job.duration}
         except Exception:
             logger.info(traceback.format_exc())
         return -1
+
+
+# Records the latency of every RPC while metrics are enabled. The watchdog never returns.
+metrics.instrument_class(Plugin, exclude=("watchdog",))
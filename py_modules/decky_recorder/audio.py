@@ -0,0 +1,322 @@
+import asyncio
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence
+
+from decky_recorder import process
+
+logger = logging.getLogger(__name__)
+
+FACILITIES = ("module", "sink", "source", "server")
+EVENT_TYPES = ("new", "change", "remove")
+
+# Event 'new' on module #23
+_SUBSCRIBE_RE = re.compile(r"^Event '(?P<type>\w+)' on (?P<facility>[\w-]+)(?: #(?P<index>\d+))?")
+
+
+@dataclass
+class Module:
+    index: int
+    name: str
+    argument: str
+
+
+def db_to_volume(db: float) -> float:
+    """Converts a gain in dB to a pulse volume relative to PA_VOLUME_NORM (cubic mapping)."""
+    return (10 ** (db / 20.0)) ** (1.0 / 3.0)
+
+
+class PulsectlBackend:
+    """Native protocol client through libpulse. One connection for requests,
+    owned by a single worker thread, and one for the event subscription."""
+
+    def __init__(self, client_name: str):
+        import pulsectl
+
+        self._pulsectl = pulsectl
+        self._client_name = client_name
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pulse")
+        self._pulse = None
+        self._events = None
+        self._event_thread: Optional[threading.Thread] = None
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+
+    async def connect(self):
+        def _connect():
+            self._pulse = self._pulsectl.Pulse(self._client_name)
+
+        await self._call(_connect)
+
+    async def default_names(self):
+        info = await self._call(self._pulse.server_info)
+        return info.default_sink_name, info.default_source_name
+
+    async def list_modules(self) -> List[Module]:
+        modules = await self._call(self._pulse.module_list)
+        return [Module(m.index, m.name, m.argument or "") for m in modules]
+
+    async def list_sinks(self) -> Dict[int, str]:
+        return {s.index: s.name for s in await self._call(self._pulse.sink_list)}
+
+    async def list_sources(self) -> Dict[int, str]:
+        return {s.index: s.name for s in await self._call(self._pulse.source_list)}
+
+    async def load_module(self, name: str, args: Sequence[str]) -> int:
+        return await self._call(self._pulse.module_load, name, list(args))
+
+    async def unload_module(self, index: int):
+        await self._call(self._pulse.module_unload, index)
+
+    async def set_source_volume_db(self, source: str, db: float):
+        def _set():
+            self._pulse.volume_set_all_chans(self._pulse.get_source_by_name(source), db_to_volume(db))
+
+        await self._call(_set)
+
+    async def subscribe(self, on_event: Callable[[str, str, Optional[int]], None]):
+        loop = asyncio.get_event_loop()
+        self._events = self._pulsectl.Pulse(f"{self._client_name}-events")
+
+        def _callback(ev):
+            # pulsectl enum values compare equal to their names
+            facility = next((f for f in FACILITIES if ev.facility == f), str(ev.facility))
+            event_type = next((t for t in EVENT_TYPES if ev.t == t), str(ev.t))
+            loop.call_soon_threadsafe(on_event, facility, event_type, ev.index)
+
+        def _listen():
+            try:
+                self._events.event_mask_set(*FACILITIES)
+                self._events.event_callback_set(_callback)
+                self._events.event_listen()
+            except Exception:
+                logger.exception("Pulse event subscription ended")
+
+        self._event_thread = threading.Thread(target=_listen, name="pulse-events", daemon=True)
+        self._event_thread.start()
+
+    async def close(self):
+        if self._events is not None:
+            self._events.event_listen_stop()
+            if self._event_thread is not None:
+                # Lets the listener return before its connection goes away
+                await asyncio.get_event_loop().run_in_executor(None, self._event_thread.join, 1)
+                self._event_thread = None
+            self._events.close()
+            self._events = None
+        if self._pulse is not None:
+            await self._call(self._pulse.close)
+            self._pulse = None
+        self._executor.shutdown(wait=False)
+
+
+class PactlBackend:
+    """Fallback when libpulse bindings are unavailable: commands still go through
+    pactl, but the cache is kept current by one long-lived `pactl subscribe`."""
+
+    def __init__(self, client_name: str):
+        self._subscriber: Optional[asyncio.subprocess.Process] = None
+        self._subscriber_task: Optional[asyncio.Task] = None
+
+    async def _pactl(self, *args) -> str:
+        return await process.output(["pactl", *args], log=False)
+
+    async def _short(self, kind: str) -> List[List[str]]:
+        return [line.split("\t") for line in (await self._pactl("list", "short", kind)).split("\n") if line]
+
+    async def connect(self):
+        result = await process.run(["pactl", "info"], timeout=5, log=False)
+        if not result.ok:
+            raise ConnectionError(result.stderr.strip() or "pactl info failed")
+
+    async def default_names(self):
+        return await self._pactl("get-default-sink"), await self._pactl("get-default-source")
+
+    async def list_modules(self) -> List[Module]:
+        return [Module(int(row[0]), row[1], row[2] if len(row) > 2 else "") for row in await self._short("modules")]
+
+    async def list_sinks(self) -> Dict[int, str]:
+        return {int(row[0]): row[1] for row in await self._short("sinks") if len(row) > 1}
+
+    async def list_sources(self) -> Dict[int, str]:
+        return {int(row[0]): row[1] for row in await self._short("sources") if len(row) > 1}
+
+    async def load_module(self, name: str, args: Sequence[str]) -> int:
+        result = await process.run(["pactl", "load-module", name, *args], timeout=10)
+        if not result.ok:
+            raise RuntimeError(f"load-module {name} failed: {result.stderr.strip()}")
+        return int(result.stdout.strip())
+
+    async def unload_module(self, index: int):
+        await self._pactl("unload-module", str(index))
+
+    async def set_source_volume_db(self, source: str, db: float):
+        await self._pactl("set-source-volume", source, f"{db}db")
+
+    async def subscribe(self, on_event: Callable[[str, str, Optional[int]], None]):
+        self._subscriber = await process.spawn(["pactl", "subscribe"], stderr=process.DEVNULL)
+
+        async def _read():
+            async for line in self._subscriber.stdout:
+                match = _SUBSCRIBE_RE.match(line.decode(errors="replace"))
+                if match is not None:
+                    index = match.group("index")
+                    on_event(match.group("facility"), match.group("type"), int(index) if index else None)
+
+        self._subscriber_task = asyncio.get_event_loop().create_task(_read())
+
+    async def close(self):
+        if self._subscriber is not None:
+            self._subscriber.kill()
+            await self._subscriber.wait()
+            self._subscriber = None
+        if self._subscriber_task is not None:
+            self._subscriber_task.cancel()
+            self._subscriber_task = None
+
+
+class AudioServer:
+    """Cached view of the audio server's sinks, sources and modules.
+
+    Everything is fetched once and then kept current from server events, so
+    repeated queries do not round-trip to the server at all.
+    """
+
+    def __init__(self, client_name: str = "decky-recorder"):
+        self._client_name = client_name
+        self._backend = None
+        self._modules: Dict[int, Module] = {}
+        self._sinks: Dict[int, str] = {}
+        self._sources: Dict[int, str] = {}
+        self._default_sink = ""
+        self._default_source = ""
+        self._dirty = set(FACILITIES)
+        self._lock = asyncio.Lock()
+        self._connect_lock = asyncio.Lock()
+
+    @property
+    def backend_name(self) -> str:
+        return type(self._backend).__name__ if self._backend is not None else "disconnected"
+
+    @property
+    def connected(self) -> bool:
+        return self._backend is not None
+
+    async def connect(self):
+        # The startup probe and the first query after it timed out may both get here
+        async with self._connect_lock:
+            if self._backend is not None:
+                return
+            backend = None
+            try:
+                backend = PulsectlBackend(self._client_name)
+                await backend.connect()
+                await backend.subscribe(self._on_event)
+            except Exception as e:
+                logger.info(f"pulsectl unavailable ({e!r}), falling back to pactl")
+                if backend is not None:
+                    # The worker thread and any connection the probe got that far with
+                    await backend.close()
+                backend = PactlBackend(self._client_name)
+                await backend.connect()
+                await backend.subscribe(self._on_event)
+            self._backend = backend
+            self._dirty = set(FACILITIES)
+            logger.info(f"Connected to audio server through {self.backend_name}")
+
+    async def close(self):
+        if self._backend is not None:
+            await self._backend.close()
+            self._backend = None
+
+    async def _connected(self):
+        """The backend, connecting first if the startup probe gave up before the server was up."""
+        if self._backend is None:
+            await self.connect()
+        return self._backend
+
+    def _on_event(self, facility: str, event_type: str, index: Optional[int]):
+        if facility == "module":
+            if event_type == "remove":
+                self._modules.pop(index, None)
+            elif event_type == "new" and index not in self._modules:
+                self._dirty.add("module")
+        elif facility in ("sink", "source"):
+            cache = self._sinks if facility == "sink" else self._sources
+            if event_type == "remove":
+                cache.pop(index, None)
+            elif event_type == "new" and index not in cache:
+                self._dirty.add(facility)
+        elif facility == "server":
+            self._dirty.add("server")
+
+    async def _refresh(self, facility: str):
+        if facility not in self._dirty:
+            return
+        async with self._lock:
+            if facility not in self._dirty:
+                return
+            backend = await self._connected()
+            self._dirty.discard(facility)
+            if facility == "module":
+                self._modules = {m.index: m for m in await backend.list_modules()}
+            elif facility == "sink":
+                self._sinks = await backend.list_sinks()
+            elif facility == "source":
+                self._sources = await backend.list_sources()
+            else:
+                self._default_sink, self._default_source = await backend.default_names()
+
+    async def default_sink(self) -> str:
+        await self._refresh("server")
+        return self._default_sink
+
+    async def default_source(self) -> str:
+        await self._refresh("server")
+        return self._default_source
+
+    async def sink_names(self) -> List[str]:
+        await self._refresh("sink")
+        return list(self._sinks.values())
+
+    async def source_names(self) -> List[str]:
+        await self._refresh("source")
+        return list(self._sources.values())
+
+    async def modules(self) -> List[Module]:
+        await self._refresh("module")
+        return list(self._modules.values())
+
+    async def modules_matching(self, search_string: str) -> List[Module]:
+        return [m for m in await self.modules() if search_string in m.name or search_string in m.argument]
+
+    async def load_module(self, name: str, args: Sequence[str]) -> int:
+        logger.info(f"load-module {name} {' '.join(args)}")
+        backend = await self._connected()
+        index = await backend.load_module(name, args)
+        self._modules[index] = Module(index, name, " ".join(args))
+        # Loading a module usually creates a sink or source
+        self._dirty.update(("sink", "source"))
+        return index
+
+    async def unload_module(self, index: int):
+        logger.info(f"unload-module {index}")
+        backend = await self._connected()
+        try:
+            await backend.unload_module(index)
+        except Exception:
+            # Loopbacks unload themselves when their sink goes away
+            logger.info(f"Module {index} was already gone")
+        self._modules.pop(index, None)
+
+    async def unload_matching(self, search_string: str):
+        for module in await self.modules_matching(search_string):
+            await self.unload_module(module.index)
+
+    async def set_source_volume_db(self, source: str, db: float):
+        backend = await self._connected()
+        await backend.set_source_volume_db(source, db)
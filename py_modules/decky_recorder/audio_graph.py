@@ -0,0 +1,222 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from decky_recorder.audio import AudioServer, Module
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ModuleSpec:
+    # Stable identity of this node within the graph
+    key: str
+    name: str
+    args: Tuple[str, ...]
+    # Keys of the nodes whose sinks/sources this module binds to. A module bound to
+    # a node that gets reloaded goes away with it, so it is reloaded as well.
+    requires: Tuple[str, ...] = ()
+
+    @property
+    def argument(self) -> str:
+        return " ".join(self.args)
+
+    def matches(self, module: Module) -> bool:
+        return module.name == self.name and module.argument == self.argument
+
+
+@dataclass
+class AudioGraph:
+    modules: List[ModuleSpec] = field(default_factory=list)
+    # Source name -> gain in dB
+    volumes: Dict[str, float] = field(default_factory=dict)
+    # Sources the pipeline captures, one audio track each
+    tracks: List[str] = field(default_factory=list)
+
+
+@dataclass
+class ReconcileResult:
+    loaded: List[str] = field(default_factory=list)
+    unloaded: List[int] = field(default_factory=list)
+    volumes: List[str] = field(default_factory=list)
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.loaded or self.unloaded or self.volumes)
+
+
+def recording_graph(
+    recording_sink: str,
+    default_sink: str,
+    mic_enabled: bool = False,
+    mic_source: str = "",
+    mic_gain: float = 0.0,
+    mic_name: str = "Echo-Cancelled-Mic",
+    echo_cancelled_audio_name: str = "Echo-Cancelled-Audio",
+    denoise_plugin: Optional[str] = None,
+    noise_reduction_percent: int = 50,
+    separate: bool = False,
+) -> AudioGraph:
+    """Describes the sink the recorder captures from and the optional mic chain.
+
+    With `separate` nothing is mixed: the game track is the default sink's
+    monitor and the mic, after denoising or echo cancelling, is a track of its
+    own, so no loopback feeds a recording sink.
+    """
+    graph = AudioGraph()
+    if separate:
+        graph.tracks.append(f"{default_sink}.monitor")
+    else:
+        graph.modules.append(ModuleSpec("recording-sink", "module-null-sink", (f"sink_name={recording_sink}",)))
+        graph.modules.append(
+            ModuleSpec(
+                "game-loopback",
+                "module-loopback",
+                (f"source={default_sink}.monitor", f"sink={recording_sink}"),
+                requires=("recording-sink",),
+            )
+        )
+        graph.tracks.append(f"{recording_sink}.monitor")
+    if not mic_enabled:
+        return graph
+
+    if denoise_plugin:
+        graph.modules.append(ModuleSpec("mic-sink", "module-null-sink", (f"sink_name={mic_name}", "rate=48000")))
+        graph.modules.append(
+            ModuleSpec(
+                "mic-denoise",
+                "module-ladspa-sink",
+                (
+                    f"sink_name={mic_name}_raw_in",
+                    f"sink_master={mic_name}",
+                    "label=noise_suppressor_mono",
+                    f"plugin={denoise_plugin}",
+                    f"control={noise_reduction_percent},20,0,0,0",
+                ),
+                requires=("mic-sink",),
+            )
+        )
+        # This module cannot use @DEFAULT_SOURCE@, don't know why
+        graph.modules.append(
+            ModuleSpec(
+                "mic-input",
+                "module-loopback",
+                (
+                    f"source={mic_source}",
+                    f"sink={mic_name}_raw_in",
+                    "channels=1",
+                    "source_dont_move=true",
+                    "sink_dont_move=true",
+                ),
+                requires=("mic-denoise",),
+            )
+        )
+        if separate:
+            graph.tracks.append(f"{mic_name}.monitor")
+        else:
+            graph.modules.append(
+                ModuleSpec(
+                    "mic-loopback",
+                    "module-loopback",
+                    (f"source={mic_name}.monitor", f"sink={recording_sink}"),
+                    requires=("mic-sink", "recording-sink"),
+                )
+            )
+        graph.volumes[f"{mic_name}.monitor"] = mic_gain
+    else:
+        graph.modules.append(
+            ModuleSpec(
+                "echo-cancel",
+                "module-echo-cancel",
+                (
+                    "use_master_format=1",
+                    f"source_master={mic_source}",
+                    f"sink_master={default_sink}",
+                    f"source_name={mic_name}",
+                    f"sink_name={echo_cancelled_audio_name}",
+                    "aec_method=webrtc",
+                    "aec_args='analog_gain_control=0 digital_gain_control=1'",
+                ),
+            )
+        )
+        if separate:
+            graph.tracks.append(mic_name)
+        else:
+            graph.modules.append(
+                ModuleSpec(
+                    "mic-loopback",
+                    "module-loopback",
+                    (f"source={mic_name}", f"sink={recording_sink}"),
+                    requires=("echo-cancel", "recording-sink"),
+                )
+            )
+            graph.modules.append(
+                ModuleSpec(
+                    "echo-loopback",
+                    "module-loopback",
+                    (f"source={echo_cancelled_audio_name}.monitor", f"sink={recording_sink}"),
+                    requires=("echo-cancel", "recording-sink"),
+                )
+            )
+        graph.volumes[mic_name] = mic_gain
+    return graph
+
+
+class AudioGraphReconciler:
+    """Moves the live audio server state to a desired AudioGraph with the fewest
+    module loads and unloads.
+
+    Only modules whose arguments mention one of `owned_markers` are considered
+    ours; everything else on the server is left alone.
+    """
+
+    def __init__(self, audio: AudioServer, owned_markers: Sequence[str]):
+        self._audio = audio
+        self._owned_markers = tuple(owned_markers)
+        self._volumes: Dict[str, float] = {}
+
+    def _owned(self, module: Module) -> bool:
+        return any(marker in module.argument for marker in self._owned_markers)
+
+    async def apply(self, graph: AudioGraph) -> ReconcileResult:
+        result = ReconcileResult()
+        live = [m for m in await self._audio.modules() if self._owned(m)]
+
+        kept: Dict[str, Module] = {}
+        claimed = set()
+        for spec in graph.modules:
+            # Dependencies come first in the graph, so their fate is already known
+            if any(dep not in kept for dep in spec.requires):
+                continue
+            for module in live:
+                if module.index not in claimed and spec.matches(module):
+                    kept[spec.key] = module
+                    claimed.add(module.index)
+                    break
+
+        # Newest first, so loopbacks go before the sinks they feed
+        for module in sorted((m for m in live if m.index not in claimed), key=lambda m: -m.index):
+            await self._audio.unload_module(module.index)
+            result.unloaded.append(module.index)
+
+        for spec in graph.modules:
+            if spec.key not in kept:
+                await self._audio.load_module(spec.name, spec.args)
+                result.loaded.append(spec.key)
+
+        reloaded_sources = set()
+        for spec in graph.modules:
+            if spec.key in result.loaded:
+                reloaded_sources.update(a.split("=", 1)[1] for a in spec.args if "_name=" in a)
+        for source, db in graph.volumes.items():
+            owner = source[: -len(".monitor")] if source.endswith(".monitor") else source
+            if self._volumes.get(source) != db or owner in reloaded_sources:
+                await self._audio.set_source_volume_db(source, db)
+                result.volumes.append(source)
+        self._volumes = dict(graph.volumes)
+
+        if result.changed:
+            logger.info(
+                f"Audio graph reconciled: loaded {result.loaded}, unloaded {result.unloaded}, volumes {result.volumes}"
+            )
+        return result
@@ -0,0 +1,319 @@
+import asyncio
+import glob
+import logging
+import math
+import os
+import shutil
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+from decky_recorder import metrics
+from decky_recorder.segment_index import NS_PER_SECOND, Segment, SegmentIndex
+
+logger = logging.getLogger(__name__)
+
+MiB = 1024 * 1024
+
+# Longest fragment splitmuxsink is asked for, clips are cut on fragment boundaries
+MAX_SEGMENT_SECONDS = 10
+# Fragment count a full buffer should stay under
+MAX_SEGMENTS = 480
+# Fragments the RAM budget should hold at least, so a spill moves small pieces
+MIN_RAM_SEGMENTS = 16
+# Weight of the newest fragment in the bitrate estimate
+BITRATE_SMOOTHING = 0.2
+
+
+def disk_usage(path: str) -> Tuple[int, int]:
+    """Returns the free and total bytes of the filesystem holding `path`."""
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize, st.f_blocks * st.f_frsize
+
+
+@dataclass
+class BufferPlan:
+    segment_seconds: int
+    max_files: int
+    # Replay length the RAM budget holds at the bitrate the plan was made for
+    ram_seconds: float
+
+    @property
+    def segment_ns(self) -> int:
+        return self.segment_seconds * NS_PER_SECOND
+
+    def as_dict(self) -> dict:
+        return {"segment_seconds": self.segment_seconds, "max_files": self.max_files, "ram_seconds": self.ram_seconds}
+
+
+class BufferManager:
+    """Keeps the rolling buffer inside a RAM budget.
+
+    splitmuxsink writes fragments to tmpfs. When the fragments held there grow
+    past the budget, or tmpfs itself runs low, the oldest ones are moved to a
+    disk tier so the buffer still reaches `target_seconds` of history. Anything
+    older than that is deleted.
+
+    Fragment length and count are fixed when a pipeline starts, so they are
+    planned from the bitrate measured on the previous run.
+    """
+
+    def __init__(
+        self,
+        index: SegmentIndex,
+        ram_folder: str,
+        prefix: str,
+        disk_folder: Optional[str] = None,
+        ram_budget: int = 512 * MiB,
+        target_seconds: int = 480,
+        tmpfs_reserve: int = 256 * MiB,
+        disk_reserve: int = 1024 * MiB,
+        in_use: Callable[[str], bool] = lambda path: False,
+        retained: Callable[[str], bool] = lambda path: False,
+        initial_bitrate: float = 1 * MiB,
+    ):
+        self._index = index
+        self._ram_folder = ram_folder
+        self._prefix = prefix
+        self._disk_folder = disk_folder
+        self._ram_budget = ram_budget
+        self._target_seconds = target_seconds
+        self._tmpfs_reserve = tmpfs_reserve
+        self._disk_reserve = disk_reserve
+        self._in_use = in_use
+        # Fragments that may be moved to disk but not deleted yet
+        self._retained = retained
+        # Bytes per second
+        self._bitrate = float(initial_bitrate)
+        self._bitrate_samples = 0
+        self._plan: Optional[BufferPlan] = None
+        self._lock = asyncio.Lock()
+        self._spilled_total = 0
+        self._dropped_total = 0
+
+    @property
+    def bitrate(self) -> float:
+        return self._bitrate
+
+    def configure(
+        self, ram_budget: Optional[int] = None, target_seconds: Optional[int] = None, disk_folder: Optional[str] = None
+    ):
+        if ram_budget is not None:
+            self._ram_budget = max(int(ram_budget), 16 * MiB)
+        if target_seconds is not None:
+            self._target_seconds = max(int(target_seconds), 1)
+        if disk_folder is not None:
+            self._disk_folder = disk_folder
+
+    def plan(self) -> BufferPlan:
+        ram_seconds = self._ram_budget / max(self._bitrate, 1.0)
+        segment_seconds = max(1, math.ceil(self._target_seconds / MAX_SEGMENTS))
+        # A budget that only fits a few fragments would spill in big jumps
+        segment_seconds = min(segment_seconds, max(1, int(ram_seconds // MIN_RAM_SEGMENTS)), MAX_SEGMENT_SECONDS)
+        # Enough file names for what stays in RAM, plus the open fragment and one to spare.
+        # Older fragments are spilled or dropped before splitmuxsink wraps around to them.
+        max_files = math.ceil(min(self._target_seconds, ram_seconds) / segment_seconds) + 2
+        return BufferPlan(segment_seconds, max(max_files, 3), ram_seconds)
+
+    def location(self, fileformat: str) -> str:
+        return os.path.join(self._ram_folder, f"{self._prefix}_%05d.{fileformat}")
+
+    def next_file_index(self) -> int:
+        """splitmuxsink start-index that follows the newest fragment in RAM.
+        Right after a reset that is the newest one an export still holds, so
+        the new pipeline does not overwrite it."""
+        if self._plan is None:
+            return 0
+        segments = list(self._index) or sorted(self._index.detached(), key=lambda s: s.seq)
+        for segment in reversed(segments):
+            if segment.spilled:
+                continue
+            stem = os.path.splitext(os.path.basename(segment.path))[0]
+            number = stem[len(self._prefix) + 1 :]
+            if stem.startswith(self._prefix + "_") and number.isdigit():
+                return (int(number) + 1) % self._plan.max_files
+        return 0
+
+    def _stale_files(self) -> List[str]:
+        folders = [self._ram_folder] + ([self._disk_folder] if self._disk_folder else [])
+        return [path for folder in folders for path in glob.glob(os.path.join(folder, f"{self._prefix}_*"))]
+
+    def begin(self, resume: bool = False) -> BufferPlan:
+        """Clears out an earlier pipeline's fragments and fixes the plan for the next one.
+
+        With `resume` the fragments are kept and the next pipeline continues
+        the buffer, with the same plan so file names keep cycling the same way."""
+        if resume and self._plan is not None:
+            self._index.resume()
+            logger.info(f"Continuing the rolling buffer at file {self.next_file_index()}")
+            return self._plan
+        self._clear()
+        if self._disk_folder:
+            try:
+                os.makedirs(self._disk_folder, exist_ok=True)
+            except OSError as e:
+                logger.warning(f"Disk buffer tier unavailable: {e}")
+        self._plan = self.plan()
+        logger.info(
+            f"Rolling buffer plan: {self._plan.segment_seconds}s fragments, {self._plan.max_files} files in RAM, "
+            f"{self._plan.ram_seconds:.0f}s fit in {self._ram_budget // MiB} MiB at {self._bitrate / 1024:.0f} KiB/s"
+        )
+        return self._plan
+
+    def discard(self):
+        """Deletes the buffer from RAM and disk once rolling is turned off.
+        The next pipeline starts a fresh one."""
+        self._clear()
+        self._plan = None
+
+    def _clear(self):
+        # Fragments a queued export still needs leave the timeline but not the disk
+        self._index.reset(keep=lambda segment: self._in_use(segment.path))
+        for segment in self._index.detached():
+            if not self._in_use(segment.path):
+                self._index.drop(segment)
+        for path in self._stale_files():
+            if not self._in_use(path):
+                self._unlink(path)
+
+    async def on_fragment_closed(self, segment: Segment):
+        if segment.duration > 0 and segment.size > 0:
+            rate = segment.size * NS_PER_SECOND / segment.duration
+            if self._bitrate_samples == 0:
+                self._bitrate = rate
+            else:
+                self._bitrate += BITRATE_SMOOTHING * (rate - self._bitrate)
+            self._bitrate_samples += 1
+        await self.enforce()
+
+    async def enforce(self):
+        async with self._lock:
+            self._trim()
+            await self._spill()
+
+    def _trim(self):
+        """Deletes the oldest fragments that are not needed to reach the target length."""
+        excess = self._index.status()["seconds"] - self._target_seconds
+        for segment in self._index:
+            if not segment.closed or self._in_use(segment.path) or self._retained(segment.path):
+                continue
+            if excess < segment.duration / NS_PER_SECOND:
+                break
+            excess -= segment.duration / NS_PER_SECOND
+            self._drop(segment)
+
+    def _ram_pressure(self, count: int, ram_bytes: int) -> bool:
+        plan = self._plan or self.plan()
+        if ram_bytes > self._ram_budget or count > plan.max_files - 2:
+            return True
+        try:
+            free, _ = disk_usage(self._ram_folder)
+        except OSError:
+            return False
+        return free < self._tmpfs_reserve
+
+    async def _spill(self):
+        ram = [s for s in self._index if s.closed and not s.spilled]
+        count = len(ram)
+        ram_bytes = sum(s.size for s in ram)
+        for segment in ram:
+            if not self._ram_pressure(count, ram_bytes):
+                break
+            if self._in_use(segment.path):
+                continue
+            await self._spill_one(segment)
+            count -= 1
+            ram_bytes -= segment.size
+
+    async def _spill_one(self, segment: Segment):
+        target = await self._copy_to_disk(segment)
+        if not self._index.contains(segment):
+            # splitmuxsink reused the file name while the copy was running
+            if target is not None:
+                self._unlink(target)
+            return
+        if target is None:
+            if not self._retained(segment.path):
+                self._drop(segment)
+            return
+        source = segment.path
+        self._index.relocate(segment, target)
+        segment.spilled = True
+        self._unlink(source)
+        self._spilled_total += 1
+        metrics.inc("bytes_written_total", segment.size, {"kind": "spill"})
+
+    async def _copy_to_disk(self, segment: Segment) -> Optional[str]:
+        if not self._disk_folder:
+            return None
+        try:
+            free, _ = disk_usage(self._disk_folder)
+        except OSError:
+            return None
+        if free - segment.size < self._disk_reserve:
+            logger.warning("Not enough disk space to keep older buffer fragments")
+            return None
+        target = os.path.join(self._disk_folder, f"{self._prefix}_{segment.seq:06d}{os.path.splitext(segment.path)[1]}")
+
+        def _copy():
+            shutil.copyfile(segment.path, target + ".part")
+            os.replace(target + ".part", target)
+
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, _copy)
+        except OSError:
+            logger.exception(f"Could not move {segment.path} to the disk buffer")
+            self._unlink(target + ".part")
+            return None
+        return target
+
+    def release(self, segments: List[Segment]):
+        """Deletes the fragments a finished export held on to after the buffer
+        had moved past them."""
+        for segment in segments:
+            if self._index.is_detached(segment) and not self._in_use(segment.path):
+                self._drop(segment)
+
+    def _drop(self, segment: Segment):
+        self._index.drop(segment)
+        self._unlink(segment.path)
+        self._dropped_total += 1
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def status(self) -> dict:
+        tiers = {"ram": [0, 0, 0], "disk": [0, 0, 0]}
+        for segment in self._index:
+            if segment.closed:
+                tier = tiers["disk" if segment.spilled else "ram"]
+                tier[0] += 1
+                tier[1] += segment.duration
+                tier[2] += segment.size
+        try:
+            tmpfs_free, tmpfs_total = disk_usage(self._ram_folder)
+        except OSError:
+            tmpfs_free, tmpfs_total = 0, 0
+        status = self._index.status()
+        status.update(
+            {
+                name: {"segments": count, "seconds": duration / NS_PER_SECOND, "bytes": size}
+                for name, (count, duration, size) in tiers.items()
+            }
+        )
+        status["ram"]["budget"] = self._ram_budget
+        status["disk"]["folder"] = self._disk_folder
+        status.update(
+            {
+                "tmpfs": {"free": tmpfs_free, "total": tmpfs_total, "reserve": self._tmpfs_reserve},
+                "bitrate": self._bitrate,
+                "target_seconds": self._target_seconds,
+                "plan": self._plan.as_dict() if self._plan is not None else None,
+                "spilled": self._spilled_total,
+                "dropped": self._dropped_total,
+            }
+        )
+        return status
@@ -0,0 +1,378 @@
+"""Catalog of the saved clips, kept in SQLite next to the settings.
+
+Clips are added as they are written. On startup the clip folder is reconciled
+against the catalog by inode, mtime and size, so only new or changed files are
+probed. Duration and a thumbnail are extracted once and cached, which keeps
+listing and retention queries to an index lookup even with thousands of clips.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from decky_recorder import files, matroska, metrics, process
+from decky_recorder.exports import low_priority
+
+logger = logging.getLogger(__name__)
+
+CLIP_EXTENSIONS = (".mkv", ".mp4", ".mov")
+THUMBNAIL_WIDTH = 320
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS clips (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    folder TEXT NOT NULL,
+    inode INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    duration REAL,
+    app_name TEXT NOT NULL DEFAULT '',
+    created REAL NOT NULL,
+    -- NULL until extracted, '' when extraction failed and is not retried
+    thumbnail TEXT
+);
+CREATE INDEX IF NOT EXISTS clips_created ON clips (created);
+CREATE INDEX IF NOT EXISTS clips_app_created ON clips (app_name, created);
+CREATE INDEX IF NOT EXISTS clips_folder ON clips (folder);
+"""
+
+_COLUMNS = "id, path, size, duration, app_name, created, thumbnail"
+
+# {app}-{seconds}s-{date} for clips, {app}_{date} for recordings
+_NAME_RE = re.compile(r"^(?P<app>.*?)(?:-\d+(?:\.\d+)?s)?[-_]\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}$")
+
+
+def app_name_from_path(path: str) -> str:
+    stem = os.path.splitext(os.path.basename(path))[0]
+    match = _NAME_RE.match(stem)
+    return match.group("app") if match else ""
+
+
+def _matroska_duration(path: str) -> Optional[float]:
+    fragment = matroska.read_fragment(path)
+    if fragment.duration:
+        return fragment.duration * fragment.timecode_scale / 1e9
+    return (fragment.last_timecode - fragment.first_timecode) * fragment.timecode_scale / 1e9
+
+
+async def probe_duration(path: str) -> Optional[float]:
+    """Duration in seconds, from the Matroska headers or with ffprobe."""
+    if path.endswith(".mkv"):
+        try:
+            return await asyncio.get_event_loop().run_in_executor(None, _matroska_duration, path)
+        except (OSError, matroska.MatroskaError) as e:
+            logger.debug(f"Could not read the duration of {path}: {e}")
+    if not shutil.which("ffprobe"):
+        return None
+    argv = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path]
+    result = await process.run(argv, timeout=15, log=False)
+    try:
+        return float(result.stdout.strip()) if result.ok else None
+    except ValueError:
+        return None
+
+
+@dataclass
+class Clip:
+    id: int
+    path: str
+    size: int
+    duration: Optional[float]
+    app_name: str
+    created: float
+    thumbnail: Optional[str]
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "path": self.path,
+            "name": os.path.basename(self.path),
+            "size": self.size,
+            "duration": self.duration,
+            "app_name": self.app_name,
+            "created": self.created,
+            "thumbnail": self.thumbnail or None,
+        }
+
+
+class ClipCatalog:
+    def __init__(self, db_path: str, thumbnail_dir: str):
+        self.db_path = db_path
+        self.thumbnail_dir = thumbnail_dir
+        self._db: Optional[sqlite3.Connection] = None
+        # Every query runs on this one thread, so the connection is never shared
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="clip-catalog")
+        self._thumbnails: Optional[asyncio.Queue] = None
+        self._thumbnail_task: Optional[asyncio.Task] = None
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        db = sqlite3.connect(self.db_path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(_SCHEMA)
+        db.commit()
+        self._db = db
+        return [row[0] for row in db.execute("SELECT id FROM clips WHERE thumbnail IS NULL")]
+
+    async def open(self):
+        try:
+            pending = await self._call(self._open)
+        except sqlite3.Error as e:
+            logger.error(f"Could not open the clip catalog {self.db_path}: {e}")
+            return False
+        self._thumbnails = asyncio.Queue()
+        for clip_id in pending:
+            self._thumbnails.put_nowait(clip_id)
+        self._thumbnail_task = asyncio.get_event_loop().create_task(self._thumbnail_worker())
+        return True
+
+    @property
+    def ready(self) -> bool:
+        return self._db is not None
+
+    async def close(self):
+        if self._thumbnail_task is not None:
+            self._thumbnail_task.cancel()
+            self._thumbnail_task = None
+        if self._db is not None:
+            await self._call(self._db.close)
+            self._db = None
+        self._executor.shutdown(wait=False)
+
+    # Adding and reconciling
+
+    def _upsert(self, path: str, st: os.stat_result, duration: Optional[float], app_name: str) -> int:
+        self._db.execute(
+            """
+            INSERT INTO clips (path, folder, inode, mtime_ns, size, duration, app_name, created)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET
+                inode = excluded.inode, mtime_ns = excluded.mtime_ns, size = excluded.size,
+                duration = excluded.duration, thumbnail = NULL
+            """,
+            (path, os.path.dirname(path), st.st_ino, st.st_mtime_ns, st.st_size, duration, app_name, st.st_mtime),
+        )
+        self._db.commit()
+        return self._db.execute("SELECT id FROM clips WHERE path = ?", (path,)).fetchone()[0]
+
+    async def add(self, path: str, app_name: Optional[str] = None) -> Optional[int]:
+        """Catalogs a clip that was just written. Returns its id."""
+        if not self.ready:
+            return None
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            logger.warning(f"Not cataloging {path}: {e}")
+            return None
+        duration = await probe_duration(path)
+        app_name = app_name if app_name is not None else app_name_from_path(path)
+        clip_id = await self._call(self._upsert, path, st, duration, app_name)
+        self._thumbnails.put_nowait(clip_id)
+        return clip_id
+
+    def _scan(self, folder: str) -> Tuple[List[Tuple[str, os.stat_result]], Dict[str, int]]:
+        """Diffs the folder against its rows. Renamed files keep their row.
+        Returns the files that need probing and a count of what was done."""
+        known = {
+            path: (clip_id, inode, mtime_ns, size)
+            for clip_id, path, inode, mtime_ns, size in self._db.execute(
+                "SELECT id, path, inode, mtime_ns, size FROM clips WHERE folder = ?", (folder,)
+            )
+        }
+        found: Dict[str, os.stat_result] = {}
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.name.startswith(".") or not entry.name.endswith(CLIP_EXTENSIONS):
+                        continue
+                    try:
+                        if entry.is_file():
+                            found[entry.path] = entry.stat()
+                    except OSError:
+                        continue
+        except FileNotFoundError:
+            pass
+
+        counts = {"unchanged": 0, "renamed": 0, "removed": 0}
+        changed = []
+        missing = {path: row for path, row in known.items() if path not in found}
+        by_inode = {row[1]: path for path, row in missing.items()}
+        for path, st in found.items():
+            row = known.get(path)
+            if row is not None:
+                if (row[1], row[2], row[3]) == (st.st_ino, st.st_mtime_ns, st.st_size):
+                    counts["unchanged"] += 1
+                else:
+                    changed.append((path, st))
+                continue
+            old = by_inode.get(st.st_ino)
+            if old is not None and missing[old][3] == st.st_size:
+                # Moved within the folder, the cached metadata still holds
+                self._db.execute(
+                    "UPDATE clips SET path = ?, mtime_ns = ?, app_name = ? WHERE id = ?",
+                    (path, st.st_mtime_ns, app_name_from_path(path), missing.pop(old)[0]),
+                )
+                del by_inode[st.st_ino]
+                counts["renamed"] += 1
+            else:
+                changed.append((path, st))
+        thumbnails = []
+        for path, row in missing.items():
+            thumbnails += self._delete_row(row[0])
+        counts["removed"] = len(missing)
+        self._db.commit()
+        for thumbnail in thumbnails:
+            files.remove(thumbnail)
+        return changed, counts
+
+    def _delete_row(self, clip_id: int) -> List[str]:
+        row = self._db.execute("SELECT thumbnail FROM clips WHERE id = ?", (clip_id,)).fetchone()
+        self._db.execute("DELETE FROM clips WHERE id = ?", (clip_id,))
+        return [row[0]] if row and row[0] else []
+
+    async def reconcile(self, folder: str) -> dict:
+        """Brings the catalog in line with `folder` after changes made while
+        the plugin was not running. Unchanged files are not opened."""
+        if not self.ready:
+            return {}
+        started = time.perf_counter()
+        folder = os.path.abspath(folder)
+        changed, counts = await self._call(self._scan, folder)
+        for path, st in changed:
+            duration = await probe_duration(path)
+            clip_id = await self._call(self._upsert, path, st, duration, app_name_from_path(path))
+            self._thumbnails.put_nowait(clip_id)
+        counts["probed"] = len(changed)
+        counts["seconds"] = time.perf_counter() - started
+        metrics.set_gauge("catalog_reconcile_seconds", counts["seconds"])
+        logger.info(f"Clip catalog reconciled with {folder}: {counts}")
+        return counts
+
+    # Thumbnails
+
+    def _thumbnail_job(self, clip_id: int):
+        return self._db.execute("SELECT path, duration FROM clips WHERE id = ?", (clip_id,)).fetchone()
+
+    def _set_thumbnail(self, clip_id: int, thumbnail: str):
+        self._db.execute("UPDATE clips SET thumbnail = ? WHERE id = ?", (thumbnail, clip_id))
+        self._db.commit()
+
+    async def _extract_thumbnail(self, clip_id: int):
+        job = await self._call(self._thumbnail_job, clip_id)
+        if job is None:
+            return
+        path, duration = job
+        os.makedirs(self.thumbnail_dir, exist_ok=True)
+        thumbnail = os.path.join(self.thumbnail_dir, f"{clip_id}.jpg")
+        # A second in, past any black first frame, unless the clip is shorter
+        at = min(1.0, duration / 2) if duration else 0.0
+        # fmt: off
+        argv = low_priority(
+            [
+                "ffmpeg", "-nostdin", "-y", "-v", "error", "-ss", f"{at:.3f}", "-i", path,
+                "-frames:v", "1", "-vf", f"scale={THUMBNAIL_WIDTH}:-2", "-q:v", "5", thumbnail,
+            ]
+        )
+        # fmt: on
+        result = await process.run(argv, timeout=30, log=False)
+        if not result.ok or not os.path.exists(thumbnail):
+            logger.warning(f"Could not extract a thumbnail from {path}: {result.stderr.strip()[-200:]}")
+            thumbnail = ""
+        await self._call(self._set_thumbnail, clip_id, thumbnail)
+
+    async def _thumbnail_worker(self):
+        while True:
+            clip_id = await self._thumbnails.get()
+            if not shutil.which("ffmpeg"):
+                continue
+            try:
+                await self._extract_thumbnail(clip_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Thumbnail of clip {clip_id} failed")
+
+    # Queries
+
+    def _list(self, offset: int, limit: int, app_name: Optional[str]) -> dict:
+        where, args = ("WHERE app_name = ?", (app_name,)) if app_name else ("", ())
+        total = self._db.execute(f"SELECT COUNT(*) FROM clips {where}", args).fetchone()[0]
+        rows = self._db.execute(
+            f"SELECT {_COLUMNS} FROM clips {where} ORDER BY created DESC, id DESC LIMIT ? OFFSET ?",
+            (*args, limit, offset),
+        ).fetchall()
+        return {"total": total, "offset": offset, "clips": [Clip(*row).as_dict() for row in rows]}
+
+    async def list_clips(self, offset: int = 0, limit: int = 50, app_name: Optional[str] = None) -> dict:
+        """Newest first, one page at a time."""
+        if not self.ready:
+            return {"total": 0, "offset": offset, "clips": []}
+        return await self._call(self._list, max(0, int(offset)), max(1, min(int(limit), 500)), app_name)
+
+    def _thumbnail_path(self, clip_id: int) -> Optional[str]:
+        row = self._db.execute("SELECT thumbnail FROM clips WHERE id = ?", (clip_id,)).fetchone()
+        return row[0] if row and row[0] else None
+
+    async def thumbnail(self, clip_id: int) -> Optional[str]:
+        return await self._call(self._thumbnail_path, int(clip_id)) if self.ready else None
+
+    def _prune(self, max_bytes: Optional[int], max_age: Optional[float], dry_run: bool) -> dict:
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM clips").fetchone()[0]
+        cutoff = time.time() - max_age if max_age is not None else None
+        victims = []
+        failed = []
+        remaining = total
+        rows = self._db.execute(f"SELECT {_COLUMNS} FROM clips ORDER BY created, id").fetchall()
+        for clip in (Clip(*row) for row in rows):
+            too_old = cutoff is not None and clip.created < cutoff
+            over_budget = max_bytes is not None and remaining > max_bytes
+            if not too_old and not over_budget:
+                break
+            if not dry_run and not files.remove(clip.path):
+                # Still on disk, so it keeps its row and its bytes, and the next clip goes instead
+                failed.append(clip.path)
+                continue
+            victims.append(clip)
+            remaining -= clip.size
+        if not dry_run:
+            for clip in victims:
+                if clip.thumbnail:
+                    files.remove(clip.thumbnail)
+            self._db.executemany("DELETE FROM clips WHERE id = ?", [(clip.id,) for clip in victims])
+            self._db.commit()
+        return {
+            "removed": [clip.path for clip in victims],
+            "failed": failed,
+            "bytes_freed": total - remaining,
+            "bytes_remaining": remaining,
+            "dry_run": dry_run,
+        }
+
+    async def prune(
+        self, max_bytes: Optional[int] = None, max_age_days: Optional[float] = None, dry_run: bool = False
+    ) -> dict:
+        """Deletes the oldest clips until they fit in `max_bytes` and none is
+        older than `max_age_days`."""
+        if not self.ready:
+            return {"removed": [], "failed": [], "bytes_freed": 0, "bytes_remaining": 0, "dry_run": dry_run}
+        max_age = max_age_days * 86400 if max_age_days is not None else None
+        result = await self._call(self._prune, max_bytes, max_age, dry_run)
+        if result["removed"]:
+            action = "Would prune" if dry_run else "Pruned"
+            logger.info(f"{action} {len(result['removed'])} clips, {result['bytes_freed']} bytes")
+        if result["failed"]:
+            logger.warning(f"Could not prune {len(result['failed'])} clips, they are kept in the catalog")
+        return result
@@ -0,0 +1,207 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+from typing import List, Optional, Tuple
+
+from decky_recorder import files, matroska, metrics, process
+from decky_recorder.exports import low_priority
+from decky_recorder.segment_index import Segment, SegmentIndex
+
+logger = logging.getLogger(__name__)
+
+CHUNKS_SUFFIX = ".chunks"
+MANIFEST = "recording.json"
+TEMP_SUFFIX = ".temp"
+
+
+def chunk_directory(output: str) -> str:
+    """Hidden folder next to `output` that holds its chunks."""
+    folder, name = os.path.split(output)
+    return os.path.join(folder, f".{name}{CHUNKS_SUFFIX}")
+
+
+def flush(path: str):
+    """Forces a finished chunk to disk and drops it from the page cache.
+
+    Done once per chunk, so dirty pages never pile up into a writeback burst
+    that stalls the encoder, and a crash loses at most the chunk in progress.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+class ChunkedRecording:
+    """A standalone recording written as fixed-length Matroska chunks.
+
+    A single muxer writing one file for the whole session leaves nothing
+    usable if it dies before EOS. Chunks are closed, flushed and indexed as
+    they go, and joined into the output once the recording stops. A manifest
+    in the chunk folder names the output, so a recording cut short by a crash
+    can be joined on the next start instead.
+    """
+
+    def __init__(self, output: str, fileformat: str):
+        self.output = output
+        self.fileformat = fileformat
+        self.directory = chunk_directory(output)
+        # Timeline of this recording alone, the replay buffer keeps its own
+        self.index = SegmentIndex()
+
+    def begin(self) -> str:
+        """Creates the chunk folder and returns the splitmuxsink location."""
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = os.path.join(self.directory, MANIFEST)
+        files.write_atomic(
+            manifest, json.dumps({"output": self.output, "format": self.fileformat, "started": time.time()})
+        )
+        return os.path.join(self.directory, "chunk%05d.mkv")
+
+    async def on_fragment_closed(self, segment: Segment):
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, flush, segment.path)
+        except OSError as e:
+            logger.warning(f"Could not flush {segment.path}: {e}")
+        metrics.inc("bytes_written_total", segment.size, {"kind": "recording"})
+
+    def segments(self) -> List[Segment]:
+        return [s for s in self.index if s.closed]
+
+    @property
+    def duration(self) -> float:
+        return self.index.status()["seconds"]
+
+
+def remove_chunks(directory: str):
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def find_orphans(folder: str) -> Tuple[List[str], List[str]]:
+    """Chunk folders and `.temp` files left behind by recordings that never
+    finished. Only meaningful while nothing is recording into `folder`."""
+    chunk_dirs, temps = [], []
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return chunk_dirs, temps
+    for entry in entries:
+        if entry.name.startswith(".") and entry.name.endswith(CHUNKS_SUFFIX) and entry.is_dir():
+            chunk_dirs.append(entry.path)
+        elif entry.name.endswith(TEMP_SUFFIX) and entry.is_file():
+            temps.append(entry.path)
+    return sorted(chunk_dirs), sorted(temps)
+
+
+def _unused(path: str) -> str:
+    """`path`, or a `-recovered` name next to it if something is already there."""
+    if not os.path.exists(path):
+        return path
+    stem, ext = os.path.splitext(path)
+    n = 1
+    candidate = f"{stem}-recovered{ext}"
+    while os.path.exists(candidate):
+        n += 1
+        candidate = f"{stem}-recovered-{n}{ext}"
+    return candidate
+
+
+def _chunk_duration(fragment: matroska.Fragment) -> int:
+    """Length of a chunk in nanoseconds. A chunk cut off by a crash has no
+    Duration, so it ends one frame after its last block."""
+    if fragment.duration:
+        return int(fragment.duration * fragment.timecode_scale)
+    video = fragment.video_track
+    timecodes = [c.timecode + b.timecode for c in fragment.clusters for b in c.blocks if b.track == video]
+    span = fragment.last_timecode - fragment.first_timecode
+    frame = span // (len(timecodes) - 1) if len(timecodes) > 1 else 0
+    return (span + frame) * fragment.timecode_scale
+
+
+def recover_chunks(directory: str) -> Tuple[Optional[str], List[Segment]]:
+    """Rebuilds the output path and segment list of an orphaned chunk folder
+    from its manifest and the chunks themselves. Chunks without a single
+    complete frame are left out."""
+    output = None
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            output = json.load(f)["output"]
+    except (OSError, ValueError, KeyError):
+        # The manifest is written first, but fall back to the folder name
+        name = os.path.basename(directory)[1 : -len(CHUNKS_SUFFIX)]
+        if name:
+            output = os.path.join(os.path.dirname(directory), name)
+    segments: List[Segment] = []
+    start = 0
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".mkv"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            fragment = matroska.read_fragment(path)
+        except (OSError, matroska.MatroskaError) as e:
+            logger.warning(f"Skipping chunk {path}: {e}")
+            continue
+        if not fragment.clusters:
+            continue
+        duration = _chunk_duration(fragment)
+        keyframes = [(k - fragment.first_timecode) * fragment.timecode_scale for k in fragment.keyframes()]
+        segments.append(
+            Segment(
+                seq=len(segments),
+                path=path,
+                start=start,
+                duration=duration,
+                size=os.path.getsize(path),
+                closed=True,
+                keyframes=keyframes or [0],
+            )
+        )
+        start += duration
+    return output, segments
+
+
+async def recover_temp(path: str) -> Optional[str]:
+    """Turns a `.temp` file left by a killed pipeline into a playable file.
+
+    Matroska written up to the kill is rejoined natively, which drops the cut
+    off tail and writes the Duration and Cues it never got. The ISO formats are
+    fragmented as they are written, so an ffmpeg remux drops the partial
+    fragment; without ffmpeg the file is kept as it is. Returns the recovered
+    path, or None if there was nothing to recover.
+    """
+    if os.path.getsize(path) == 0:
+        os.remove(path)
+        return None
+    output = _unused(path[: -len(TEMP_SUFFIX)])
+    if output.endswith(".mkv"):
+
+        def _join():
+            # Ends one frame after the last block, like a recovered chunk
+            matroska.concat([path], output, [_chunk_duration(matroska.read_fragment(path))])
+
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, _join)
+        except matroska.MatroskaError as e:
+            logger.warning(f"Cannot recover {path}: {e}")
+            return None
+        os.remove(path)
+        return output
+    if shutil.which("ffmpeg"):
+        argv = low_priority(["ffmpeg", "-nostdin", "-y", "-v", "error", "-i", path, "-map", "0", "-c", "copy", output])
+        result = await process.run(argv, timeout=None)
+        if result.ok:
+            os.remove(path)
+            return output
+        logger.warning(f"Remuxing {path} failed: {result.stderr.strip()[-300:]}")
+        try:
+            os.remove(output)
+        except OSError:
+            pass
+    os.replace(path, output)
+    return output
@@ -0,0 +1,470 @@
+"""Re-encodes saved clips to a smaller size in the background.
+
+Clips are stream copies of the live hardware encode, which is sized for speed.
+When enabled, finished clips are re-encoded with x264 at idle CPU and IO
+priority, pinned to one core per worker. A running encode is stopped with
+SIGSTOP while a game runs and continued when it exits. The re-encoded file
+replaces the original only after its duration has been checked, with an atomic
+rename.
+
+A clip is encoded in parts of `chunk_seconds`, each a Matroska file of its own,
+and the parts are joined once all are done. The queue and the finished parts
+of every job are kept in a journal, so a job interrupted by a reload only
+encodes again the part it was in the middle of.
+"""
+
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import os
+import shutil
+import signal
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from decky_recorder import files, matroska, metrics, process
+from decky_recorder.catalog import probe_duration
+from decky_recorder.exports import concat_quote, low_priority
+from decky_recorder.segment_index import NS_PER_SECOND
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+PAUSED = "paused"
+DONE = "done"
+# The re-encode was not smaller, the original is kept
+SKIPPED = "skipped"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+PENDING = (QUEUED, RUNNING, PAUSED)
+MAX_WORKERS = 2
+# Seconds per part, the most of an encode a reload throws away
+CHUNK_SECONDS = 60.0
+# A remainder shorter than this is not worth a part of its own
+MIN_PART_SECONDS = 0.1
+
+
+@dataclass(frozen=True)
+class CompressPreset:
+    name: str
+    label: str
+    crf: int
+    # x264 speed preset
+    speed: str
+
+    def as_dict(self) -> dict:
+        return {"name": self.name, "label": self.label, "crf": self.crf, "speed": self.speed}
+
+
+PRESETS = {
+    preset.name: preset
+    for preset in (
+        CompressPreset("light", "Light", crf=23, speed="veryfast"),
+        CompressPreset("balanced", "Balanced", crf=26, speed="faster"),
+        CompressPreset("small", "Smallest", crf=30, speed="medium"),
+    )
+}
+DEFAULT_PRESET = "balanced"
+
+
+@dataclass
+class CompressJob:
+    id: int
+    path: str
+    preset: str
+    state: str = QUEUED
+    progress: float = 0.0
+    original_size: int = 0
+    size: int = 0
+    error: str = ""
+    created: float = field(default_factory=time.time)
+    finished: float = 0.0
+    # Seconds of the clip in each finished part, kept across reloads
+    parts: List[float] = field(default_factory=list)
+
+    @property
+    def saved(self) -> int:
+        return self.original_size - self.size if self.state == DONE else 0
+
+    @property
+    def partial(self) -> str:
+        # Hidden and in the same folder, so the rename is atomic and the clip catalog skips it
+        folder, name = os.path.split(self.path)
+        stem, ext = os.path.splitext(name)
+        return os.path.join(folder, f".{stem}.compressing{ext}")
+
+    def part(self, n: int) -> str:
+        folder, name = os.path.split(self.path)
+        stem = os.path.splitext(name)[0]
+        return os.path.join(folder, f".{stem}.compressing.{n:03d}.mkv")
+
+    def as_dict(self) -> dict:
+        return {**asdict(self), "saved": self.saved}
+
+
+class CompressionPool:
+    def __init__(
+        self,
+        journal: str,
+        busy: Callable[[], bool] = lambda: False,
+        on_replaced: Callable[[str], None] = lambda path: None,
+        poll: float = 5.0,
+        history: int = 50,
+        wait_change: Optional[Callable[[], Awaitable[None]]] = None,
+        chunk_seconds: float = CHUNK_SECONDS,
+    ):
+        self._journal = journal
+        # True while a game runs, encodes are paused meanwhile
+        self._busy = busy
+        # Returns once `busy` may have changed, `busy` is polled every `poll` seconds without it
+        self._wait_change = wait_change
+        self._on_replaced = on_replaced
+        self._poll = poll
+        self._history = history
+        self._chunk_seconds = chunk_seconds
+        self._jobs: Dict[int, CompressJob] = {}
+        self._ids = itertools.count(1)
+        self._saved_total = 0
+        self._enabled: Optional[asyncio.Event] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._running: Dict[int, asyncio.subprocess.Process] = {}
+        self._save_lock: Optional[asyncio.Lock] = None
+        self.preset = DEFAULT_PRESET
+        self.workers = 1
+
+    # Journal
+
+    def _read(self) -> dict:
+        try:
+            with open(self._journal) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read the compression journal {self._journal}: {e}")
+            return {}
+
+    def _write(self, state: dict):
+        files.write_atomic(self._journal, json.dumps(state))
+
+    async def _save(self):
+        state = {"saved_total": self._saved_total, "jobs": [asdict(job) for job in self._jobs.values()]}
+        async with self._save_lock:
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self._write, state)
+            except OSError as e:
+                logger.error(f"Could not write the compression journal: {e}")
+
+    async def start(self, enabled: bool, preset: str = DEFAULT_PRESET, workers: int = 1):
+        self._save_lock = asyncio.Lock()
+        state = await asyncio.get_event_loop().run_in_executor(None, self._read)
+        self._saved_total = state.get("saved_total", 0)
+        for raw in state.get("jobs", []):
+            try:
+                job = CompressJob(**raw)
+            except TypeError:
+                continue
+            if job.state in (RUNNING, PAUSED):
+                # Interrupted by a reload, the encode continues after its last finished part
+                _remove_unfinished(job)
+                job.state = QUEUED
+            self._jobs[job.id] = job
+        self._ids = itertools.count(max(self._jobs, default=0) + 1)
+        self._enabled = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self.configure(enabled, preset, workers)
+        resumed = sum(1 for job in self._jobs.values() if job.state == QUEUED and job.parts)
+        if resumed:
+            logger.info(f"Resuming {resumed} compression jobs after their last finished part")
+
+    def configure(self, enabled: bool, preset: Optional[str] = None, workers: Optional[int] = None):
+        if preset is not None:
+            self.preset = preset if preset in PRESETS else DEFAULT_PRESET
+        if workers is not None:
+            self.workers = max(1, min(int(workers), MAX_WORKERS))
+        if enabled:
+            self._enabled.set()
+        else:
+            self._enabled.clear()
+        loop = asyncio.get_event_loop()
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(loop.create_task(self._worker(len(self._tasks))))
+        self._wakeup.set()
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled is not None and self._enabled.is_set()
+
+    async def close(self):
+        """Stops the workers. Running jobs go back to the queue for the next load."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self._save()
+
+    # Jobs
+
+    def submit(self, path: str) -> Optional[CompressJob]:
+        path = os.path.abspath(path)
+        for job in self._jobs.values():
+            if job.path == path and (job.state in PENDING or job.state in (DONE, SKIPPED)):
+                # Already compressed, or on its way
+                return job
+        job = CompressJob(next(self._ids), path, self.preset)
+        self._jobs[job.id] = job
+        self._trim_history()
+        asyncio.get_event_loop().create_task(self._save())
+        self._wakeup.set()
+        logger.info(f"Queued compression {job.id}: {path}")
+        return job
+
+    def cancel(self, job_id: int) -> bool:
+        job = self._jobs.get(job_id)
+        if job is None or job.state not in PENDING:
+            return False
+        proc = self._running.get(job_id)
+        if proc is not None:
+            _kill(proc)
+        job.state = CANCELLED
+        job.finished = time.time()
+        asyncio.get_event_loop().create_task(self._save())
+        return True
+
+    def status(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "preset": self.preset,
+            "workers": self.workers,
+            "paused": any(job.state == PAUSED for job in self._jobs.values()),
+            "saved_total": self._saved_total,
+            "jobs": [job.as_dict() for job in self._jobs.values()],
+        }
+
+    def _trim_history(self):
+        finished = [job for job in self._jobs.values() if job.state not in PENDING]
+        for job in finished[: max(0, len(self._jobs) - self._history)]:
+            del self._jobs[job.id]
+
+    def _next(self) -> Optional[CompressJob]:
+        for job in self._jobs.values():
+            if job.state == QUEUED:
+                return job
+        return None
+
+    async def _busy_changed(self):
+        if self._wait_change is not None:
+            await self._wait_change()
+        else:
+            await asyncio.sleep(self._poll)
+
+    async def _wait_idle(self):
+        while self._busy():
+            await self._busy_changed()
+
+    async def _worker(self, slot: int):
+        while True:
+            await self._enabled.wait()
+            if slot >= self.workers:
+                # The pool was made smaller
+                return
+            job = self._next()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            await self._wait_idle()
+            if job.state != QUEUED or not self.enabled:
+                continue
+            job.state = RUNNING
+            started = time.perf_counter()
+            try:
+                await self._run(job, slot)
+            except asyncio.CancelledError:
+                # Unload, the job is picked up again after the next load
+                _remove_unfinished(job)
+                job.state = QUEUED
+                raise
+            except Exception as e:
+                _remove_parts(job)
+                if job.state != CANCELLED:
+                    logger.exception(f"Compression {job.id} failed")
+                    job.state = FAILED
+                    job.error = str(e)
+                job.finished = time.time()
+            else:
+                metrics.observe("compress_seconds", time.perf_counter() - started)
+            finally:
+                self._running.pop(job.id, None)
+            metrics.inc("compress_jobs_total", labels={"state": job.state})
+            await self._save()
+
+    def _argv(self, job: CompressJob, slot: int, start: float, length: float) -> List[str]:
+        preset = PRESETS.get(job.preset, PRESETS[DEFAULT_PRESET])
+        # fmt: off
+        argv = [
+            "ffmpeg", "-nostdin", "-y", "-v", "error", "-nostats", "-progress", "pipe:1",
+            "-ss", f"{start:.3f}", "-t", f"{length:.3f}", "-i", job.path, "-map", "0",
+            "-c:v", "libx264", "-crf", str(preset.crf), "-preset", preset.speed, "-threads", "1",
+            "-c:a", "copy", "-c:s", "copy", job.part(len(job.parts)),
+        ]
+        # fmt: on
+        if shutil.which("taskset"):
+            # The last cores, away from the game's main threads when it comes back
+            core = max(0, (os.cpu_count() or 1) - 1 - slot)
+            argv = ["taskset", "-c", str(core)] + argv
+        return low_priority(argv)
+
+    async def _run(self, job: CompressJob, slot: int):
+        job.original_size = os.path.getsize(job.path)
+        duration = await probe_duration(job.path)
+        if duration is None:
+            raise RuntimeError("could not read the clip's duration")
+        while duration - sum(job.parts) >= MIN_PART_SECONDS:
+            if job.state == CANCELLED:
+                raise RuntimeError("cancelled")
+            start = sum(job.parts)
+            encoded = await self._encode(job, slot, start, min(self._chunk_seconds, duration - start), duration)
+            job.parts.append(encoded)
+            # A reload from here on keeps this part
+            await self._save()
+        await self._join(job)
+        await self._replace(job, duration)
+
+    async def _encode(self, job: CompressJob, slot: int, start: float, length: float, duration: float) -> float:
+        """Encodes `length` seconds from `start` into the next part. Returns the
+        seconds it holds, where the next part starts."""
+        part = job.part(len(job.parts))
+        total_us = max(int(duration * 1e6), 1)
+        proc = await process.spawn(self._argv(job, slot, start, length), stderr=process.PIPE)
+        self._running[job.id] = proc
+        stderr_task = asyncio.ensure_future(proc.stderr.read())
+        pause_task = asyncio.ensure_future(self._pause_while_busy(job, proc))
+        try:
+            async for line in proc.stdout:
+                if line.startswith(b"out_time_us="):
+                    try:
+                        job.progress = min(1.0, (start * 1e6 + int(line[12:])) / total_us)
+                    except ValueError:
+                        pass
+            returncode = await proc.wait()
+        except asyncio.CancelledError:
+            _kill(proc)
+            await proc.wait()
+            raise
+        finally:
+            pause_task.cancel()
+            stderr = await stderr_task
+        if job.state == CANCELLED:
+            raise RuntimeError("cancelled")
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with {returncode}: {stderr.decode(errors='replace')[-500:]}")
+        encoded = await probe_duration(part)
+        if not encoded:
+            raise RuntimeError(f"could not read the duration of {part}")
+        return encoded
+
+    async def _join(self, job: CompressJob):
+        """Joins the parts into the partial file, in the container of the original."""
+        parts = [job.part(n) for n in range(len(job.parts))]
+        if job.path.endswith(".mkv"):
+            durations = [int(seconds * NS_PER_SECOND) for seconds in job.parts]
+            try:
+                await asyncio.get_event_loop().run_in_executor(
+                    None, functools.partial(matroska.concat, parts, job.partial, durations)
+                )
+                return
+            except matroska.MatroskaError as e:
+                logger.warning(f"Native join of compression {job.id} not possible ({e}), using ffmpeg")
+        list_path = f"{job.partial}.txt"
+        with open(list_path, "w") as f:
+            f.writelines(f"file {concat_quote(part)}\n" for part in parts)
+        # fmt: off
+        argv = low_priority(
+            [
+                "ffmpeg", "-nostdin", "-y", "-v", "error",
+                "-f", "concat", "-safe", "0", "-i", list_path, "-map", "0", "-c", "copy", job.partial,
+            ]
+        )
+        # fmt: on
+        try:
+            result = await process.run(argv, timeout=None)
+        finally:
+            files.remove(list_path)
+        if not result.ok:
+            raise RuntimeError(f"could not join the parts: {result.stderr.strip()[-500:]}")
+
+    async def _pause_while_busy(self, job: CompressJob, proc: asyncio.subprocess.Process):
+        while proc.returncode is None:
+            busy = self._busy()
+            if busy and job.state == RUNNING:
+                logger.info(f"Game running, pausing compression {job.id}")
+                proc.send_signal(signal.SIGSTOP)
+                job.state = PAUSED
+            elif not busy and job.state == PAUSED:
+                logger.info(f"Resuming compression {job.id}")
+                proc.send_signal(signal.SIGCONT)
+                job.state = RUNNING
+            await self._busy_changed()
+
+    async def _replace(self, job: CompressJob, duration: Optional[float]):
+        """Swaps in the re-encoded file once it has the original's duration."""
+        encoded = await probe_duration(job.partial)
+        if duration is None or encoded is None or abs(encoded - duration) > max(1.0, duration * 0.02):
+            raise RuntimeError(f"verification failed: {encoded}s encoded, {duration}s original")
+        job.size = os.path.getsize(job.partial)
+        job.progress = 1.0
+        job.finished = time.time()
+        _remove_parts(job, keep_partial=True)
+        if job.size >= job.original_size:
+            files.remove(job.partial)
+            job.state = SKIPPED
+            logger.info(f"Compression {job.id} saved nothing, keeping the original")
+            return
+        if not os.path.exists(job.path):
+            raise RuntimeError("original was removed")
+
+        def _commit():
+            fd = os.open(job.partial, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(job.partial, job.path)
+
+        await asyncio.get_event_loop().run_in_executor(None, _commit)
+        job.state = DONE
+        self._saved_total += job.saved
+        metrics.inc("compress_bytes_saved_total", job.saved)
+        logger.info(f"Compressed {job.path}: {job.original_size} -> {job.size} bytes")
+        self._on_replaced(job.path)
+
+
+def _kill(proc: asyncio.subprocess.Process):
+    if proc.returncode is not None:
+        return
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        pass
+
+
+def _remove_unfinished(job: CompressJob):
+    """Deletes the part in progress, the finished ones are kept for the next run."""
+    files.remove(job.part(len(job.parts)))
+    files.remove(job.partial)
+
+
+def _remove_parts(job: CompressJob, keep_partial: bool = False):
+    for n in range(len(job.parts) + 1):
+        files.remove(job.part(n))
+    job.parts = []
+    if not keep_partial:
+        files.remove(job.partial)
@@ -0,0 +1,397 @@
+import asyncio
+import functools
+import itertools
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from decky_recorder import matroska, metrics, process
+from decky_recorder.segment_index import NS_PER_SECOND, Segment
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+def low_priority(argv: List[str]) -> List[str]:
+    """Prefixes argv so the child runs at idle CPU and IO priority where the tools exist."""
+    prefix = []
+    if shutil.which("nice"):
+        prefix += ["nice", "-n", "19"]
+    if shutil.which("ionice"):
+        prefix += ["ionice", "-c", "3"]
+    return prefix + list(argv)
+
+
+@dataclass
+class ExportJob:
+    id: int
+    segments: List[Segment]
+    output: str
+    requested: float
+    # Trim points on the buffer timeline, in nanoseconds. `start` is a keyframe.
+    start: int = 0
+    end: int = 0
+    state: str = QUEUED
+    progress: float = 0.0
+    error: str = ""
+    coalesced: int = 0
+    # Clip requests can be merged, a finished manual recording cannot
+    coalescable: bool = True
+    # Segments outside the replay buffer, e.g. recording chunks, are never overwritten
+    buffered: bool = True
+    # Set once the segments are handed to the exporter, until then a running job
+    # is only waiting for its last fragment and can still take in a new request
+    exporting: bool = False
+    created: float = field(default_factory=time.time)
+    finished: float = 0.0
+    # Seconds actually written, set once the export is done
+    exported: float = 0.0
+
+    @property
+    def duration_ns(self) -> int:
+        if not self.segments:
+            return 0
+        return (self.end or self.segments[-1].end) - (self.start or self.segments[0].start)
+
+    @property
+    def trim(self):
+        """Offsets into the first and last segment, in nanoseconds."""
+        start = max(0, self.start - self.segments[0].start) if self.start else 0
+        end = self.end - self.segments[-1].start if self.end else None
+        return start, end
+
+    @property
+    def duration(self) -> float:
+        return self.duration_ns / NS_PER_SECOND
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "state": self.state,
+            "progress": self.progress,
+            "output": self.output,
+            "requested": self.requested,
+            "duration": self.duration,
+            "segments": len(self.segments),
+            "coalesced": self.coalesced,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+            "exported": self.exported,
+        }
+
+
+Exporter = Callable[[ExportJob, str], Awaitable[None]]
+
+
+def concat_quote(path: str) -> str:
+    """Quotes `path` for an ffmpeg concat list, where a ' inside quotes is written '\\''."""
+    return "'" + path.replace("'", "'\\''") + "'"
+
+
+async def ffmpeg_concat(job: ExportJob, work_dir: str):
+    """Stream-copies the job's segments into its output with the ffmpeg concat demuxer."""
+    list_path = os.path.join(work_dir, f"decky-recorder-export-{job.id}.txt")
+    start, end = job.trim
+    with open(list_path, "w") as f:
+        for i, segment in enumerate(job.segments):
+            f.write(f"file {concat_quote(segment.path)}\n")
+            if i == 0 and start:
+                f.write(f"inpoint {start / NS_PER_SECOND:.6f}\n")
+            if i == len(job.segments) - 1 and end is not None:
+                f.write(f"outpoint {end / NS_PER_SECOND:.6f}\n")
+    # fmt: off
+    argv = low_priority(
+        [
+            "ffmpeg", "-y", "-nostats", "-progress", "pipe:1",
+            "-f", "concat", "-safe", "0", "-i", list_path,
+            # Every stream, so separate game and mic tracks both survive
+            "-map", "0", "-c", "copy", job.output,
+        ]
+    )
+    # fmt: on
+    proc = await process.spawn(argv, stderr=process.PIPE)
+    stderr_task = asyncio.ensure_future(proc.stderr.read())
+    total_us = max(job.duration_ns // 1000, 1)
+    out_us = 0
+    try:
+        async for line in proc.stdout:
+            # -progress prints key=value lines, out_time_us tracks the muxed position
+            if line.startswith(b"out_time_us="):
+                try:
+                    out_us = int(line[12:])
+                except ValueError:
+                    continue
+                job.progress = min(1.0, out_us / total_us)
+        returncode = await proc.wait()
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+    finally:
+        stderr = await stderr_task
+        os.remove(list_path)
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with {returncode}: {stderr.decode(errors='replace')[-500:]}")
+    job.exported = out_us / 1_000_000 if out_us else job.duration
+
+
+async def matroska_concat(job: ExportJob, work_dir: str):
+    """Joins Matroska segments in-process, falling back to ffmpeg when the
+    fragments cannot be stream-joined as they are."""
+    paths = [s.path for s in job.segments]
+    if not job.output.endswith(".mkv") or not all(p.endswith(".mkv") for p in paths):
+        return await ffmpeg_concat(job, work_dir)
+
+    cancelled = False
+
+    def _progress(value: float):
+        # The worker thread cannot be interrupted, so it stops at the next fragment
+        if cancelled:
+            raise matroska.MatroskaError("export cancelled")
+        job.progress = value
+
+    start, end = job.trim
+    try:
+        duration = await asyncio.get_event_loop().run_in_executor(
+            None,
+            functools.partial(
+                matroska.concat,
+                paths,
+                job.output,
+                [s.duration for s in job.segments],
+                _progress,
+                start=start,
+                end=end,
+            ),
+        )
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    except matroska.MatroskaError as e:
+        logger.warning(f"Native concat of export {job.id} not possible ({e}), using ffmpeg")
+        job.progress = 0.0
+        await ffmpeg_concat(job, work_dir)
+    except OSError as e:
+        # A full disk or a fragment that went away, which ffmpeg would run into as well
+        try:
+            os.remove(job.output + ".part")
+        except OSError:
+            pass
+        raise RuntimeError(f"could not join into {job.output}: {e}") from e
+    else:
+        job.exported = duration / NS_PER_SECOND
+
+
+class ExportQueue:
+    """Clip exports run in the background by a bounded pool of workers.
+
+    A request that arrives while an earlier one is still waiting within
+    `coalesce_window` seconds is merged into it instead of starting a second
+    export of almost the same footage.
+    """
+
+    def __init__(
+        self,
+        work_dir: str,
+        exporter: Exporter = matroska_concat,
+        workers: int = 1,
+        coalesce_window: float = 2.0,
+        history: int = 20,
+        is_current: Callable[[Segment], bool] = lambda segment: True,
+        close_timeout: float = 15.0,
+    ):
+        self._work_dir = work_dir
+        self._exporter = exporter
+        self._workers = workers
+        self._coalesce_window = coalesce_window
+        self._history = history
+        self._is_current = is_current
+        # How long a job waits for the fragment it ends in to be closed
+        self._close_timeout = close_timeout
+        self._closed: Optional[asyncio.Event] = None
+        self._ids = itertools.count(1)
+        self._jobs: Dict[int, ExportJob] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._running: Dict[int, asyncio.Task] = {}
+        self._listeners: List[Callable[[ExportJob], None]] = []
+        self._closing = False
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._closed = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self._workers)]
+
+    async def close(self):
+        """Stops the workers. Running exports are cancelled and queued ones dropped."""
+        self._closing = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._closing = False
+
+    def on_finished(self, callback: Callable[[ExportJob], None]):
+        self._listeners.append(callback)
+
+    def segment_closed(self):
+        """Wakes jobs that wait for the fragment they end in."""
+        if self._closed is not None:
+            self._closed.set()
+            self._closed = asyncio.Event()
+
+    def submit(
+        self,
+        segments: List[Segment],
+        output: str,
+        requested: float,
+        start: int = 0,
+        end: int = 0,
+        coalesce: bool = True,
+        buffered: bool = True,
+    ) -> ExportJob:
+        now = time.time()
+        for job in reversed(list(self._jobs.values()) if coalesce else []):
+            pending = job.state == QUEUED or (job.state == RUNNING and not job.exporting)
+            if pending and job.coalescable and now - job.created <= self._coalesce_window:
+                merged = {s.seq: s for s in job.segments}
+                merged.update((s.seq, s) for s in segments)
+                job.segments = sorted(merged.values(), key=lambda s: s.start)
+                job.start = min(job.start, start) if job.start and start else 0
+                job.end = max(job.end, end) if job.end and end else 0
+                job.requested = max(job.requested, requested)
+                job.output = output
+                job.coalesced += 1
+                logger.info(f"Coalesced clip request into export {job.id}")
+                return job
+        job = ExportJob(
+            next(self._ids), list(segments), output, requested, start, end, coalescable=coalesce, buffered=buffered
+        )
+        self._jobs[job.id] = job
+        self._trim_history()
+        self._queue.put_nowait(job)
+        logger.info(f"Queued export {job.id}: {len(segments)} segments -> {output}")
+        return job
+
+    def cancel(self, job_id: int) -> bool:
+        job = self._jobs.get(job_id)
+        if job is None or job.state not in (QUEUED, RUNNING):
+            return False
+        if job.state == RUNNING:
+            self._running[job_id].cancel()
+        else:
+            self._finish(job, CANCELLED)
+        return True
+
+    def in_use(self, path: str) -> bool:
+        """True while a pending or running export needs the file at `path`."""
+        return any(
+            s.path == path for job in self._jobs.values() if job.state in (QUEUED, RUNNING) for s in job.segments
+        )
+
+    def jobs(self) -> List[dict]:
+        return [job.as_dict() for job in self._jobs.values()]
+
+    def _trim_history(self):
+        finished = [j for j in self._jobs.values() if j.state in (DONE, FAILED, CANCELLED)]
+        for job in finished[: max(0, len(self._jobs) - self._history)]:
+            del self._jobs[job.id]
+
+    def _finish(self, job: ExportJob, state: str, error: str = ""):
+        job.state = state
+        job.error = error
+        job.finished = time.time()
+        metrics.inc("exports_total", labels={"state": state})
+        for listener in self._listeners:
+            try:
+                listener(job)
+            except Exception:
+                logger.exception("Export listener failed")
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            if job.state != QUEUED:
+                continue
+            # Running from here on, so the buffer leaves its fragments where they are
+            job.state = RUNNING
+            started = time.perf_counter()
+            task = asyncio.ensure_future(self._run(job))
+            self._running[job.id] = task
+            try:
+                await task
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    raise
+                self._discard_output(job)
+                self._finish(job, CANCELLED)
+                # Cancelling the worker cancels the export it awaits as well, so
+                # only the closing flag tells the two apart
+                if self._closing:
+                    raise
+            except Exception as e:
+                logger.exception(f"Export {job.id} failed")
+                self._discard_output(job)
+                self._finish(job, FAILED, str(e))
+            else:
+                job.progress = 1.0
+                elapsed = time.perf_counter() - started
+                self._finish(job, DONE)
+                metrics.observe("export_seconds", elapsed)
+                if metrics.REGISTRY.enabled and os.path.exists(job.output):
+                    metrics.inc("bytes_written_total", os.path.getsize(job.output), {"kind": "clip"})
+                logger.info(f"Export {job.id} finished in {elapsed:.2f}s: {job.output}")
+            finally:
+                self._running.pop(job.id, None)
+
+    async def _run(self, job: ExportJob):
+        await self._wait_closed(job)
+        stale = [s for s in job.segments if job.buffered and not self._is_current(s)]
+        if stale:
+            logger.warning(f"Export {job.id}: {len(stale)} segments were overwritten before export")
+            job.segments = [s for s in job.segments if self._is_current(s)]
+        if not job.segments:
+            raise RuntimeError("no segments left to export")
+        if job.start:
+            job.start = max(job.start, job.segments[0].start)
+        if job.end:
+            job.end = min(job.end, job.segments[-1].end)
+        job.exporting = True
+        await self._exporter(job, self._work_dir)
+
+    async def _wait_closed(self, job: ExportJob):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self._close_timeout
+        while any(not s.closed for s in job.segments):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self._closed.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        if any(not s.closed for s in job.segments):
+            # The pipeline stopped mid-fragment, end the clip where the footage ends
+            logger.warning(f"Export {job.id}: last fragment was never closed")
+            job.segments = [s for s in job.segments if s.closed]
+            if job.segments and job.end:
+                job.end = min(job.end, job.segments[-1].end)
+
+    @staticmethod
+    def _discard_output(job: ExportJob):
+        try:
+            os.remove(job.output)
+        except OSError:
+            pass
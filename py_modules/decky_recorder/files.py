@@ -0,0 +1,29 @@
+"""File helpers shared by the modules that keep state next to the clips or settings."""
+
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def remove(path: str) -> bool:
+    """Deletes `path`. Returns False if it is still there."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Could not remove {path}: {e}")
+        return False
+    return True
+
+
+def write_atomic(path: str, text: str):
+    """Replaces `path` with `text` through a synced temporary file and a rename,
+    so a crash or power loss leaves either the old file or the new one."""
+    partial = f"{path}.tmp"
+    with open(partial, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, path)
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import re
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from logging.handlers import RotatingFileHandler
+from typing import Callable, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+STATE_CHANGED = "state-changed"
+EOS = "eos"
+FREEING = "freeing"
+ERROR = "error"
+WARNING = "warning"
+FRAGMENT_OPENED = "fragment-opened"
+FRAGMENT_CLOSED = "fragment-closed"
+ELEMENT = "element"
+PROPERTY = "property"
+
+# Got message #42 from element "sink" (element): splitmuxsink-fragment-opened, location=(string)..., ...;
+_MESSAGE_RE = re.compile(r'^Got message #\d+ from \w+ "(?P<source>[^"]*)" \((?P<type>[\w-]+)\): (?P<body>.*)$')
+_FIELD_RE = re.compile(r'(?P<key>[\w-]+)=\((?P<type>[\w]+)\)(?P<value>"(?:[^"\\]|\\.)*"|[^,;]*)')
+# ERROR: from element /GstPipeline:pipeline0/GstPipeWireSrc:pipewiresrc0: message
+_PROBLEM_RE = re.compile(r"^(?P<level>ERROR|WARNING): from element (?P<source>\S+?): (?P<body>.*)$")
+_EOS_RE = re.compile(r'^Got EOS from element "(?P<source>[^"]*)"')
+# /GstPipeline:pipeline0/GstVideoRate:videorate0: drop = 12
+_PROPERTY_RE = re.compile(r"^(?P<source>/\S+?): (?P<name>[\w-]+) = (?P<value>.*)$")
+# \ followed by three octal digits for a byte, or by the character itself
+_ESCAPE_RE = re.compile(r"\\([0-7]{3}|.)", re.S)
+
+
+@dataclass
+class PipelineEvent:
+    kind: str
+    source: str = ""
+    fields: Dict[str, str] = field(default_factory=dict)
+    line: str = ""
+
+
+def unescape(value: str) -> str:
+    """Undoes GStreamer's string serialization: any character can be escaped
+    with a backslash, and bytes outside printable ASCII are written as three
+    octal digits. File names that are not valid UTF-8 come back the way
+    os.fsdecode would return them."""
+    if "\\" not in value:
+        return value
+    raw = bytearray()
+    pos = 0
+    for match in _ESCAPE_RE.finditer(value):
+        raw += value[pos : match.start()].encode("utf-8", "surrogateescape")
+        escaped = match.group(1)
+        raw += bytes([int(escaped, 8)]) if len(escaped) == 3 else escaped.encode("utf-8", "surrogateescape")
+        pos = match.end()
+    raw += value[pos:].encode("utf-8", "surrogateescape")
+    return raw.decode("utf-8", errors="surrogateescape")
+
+
+def parse_fields(body: str) -> Dict[str, str]:
+    fields = {}
+    for match in _FIELD_RE.finditer(body):
+        value = match.group("value")
+        if value.startswith('"'):
+            value = unescape(value[1:-1])
+        fields[match.group("key")] = value
+    return fields
+
+
+def parse_line(line: str) -> Optional[PipelineEvent]:
+    """Turns one line of gst-launch -m output into an event, or None for everything
+    else (caps dumps, progress chatter)."""
+    first = line[:1]
+    if first == "G":
+        match = _MESSAGE_RE.match(line)
+        if match is not None:
+            message_type = match.group("type")
+            body = match.group("body")
+            source = match.group("source")
+            if message_type == ELEMENT:
+                if body.startswith("splitmuxsink-fragment-opened"):
+                    return PipelineEvent(FRAGMENT_OPENED, source, parse_fields(body), line)
+                if body.startswith("splitmuxsink-fragment-closed"):
+                    return PipelineEvent(FRAGMENT_CLOSED, source, parse_fields(body), line)
+                return PipelineEvent(ELEMENT, source, parse_fields(body), line)
+            return PipelineEvent(message_type, source, parse_fields(body), line)
+        match = _EOS_RE.match(line)
+        if match is not None:
+            return PipelineEvent(EOS, match.group("source"), {}, line)
+    elif first == "F":
+        if line.startswith("Freeing pipeline"):
+            return PipelineEvent(FREEING, "", {}, line)
+    elif first == "E" or first == "W":
+        match = _PROBLEM_RE.match(line)
+        if match is not None:
+            kind = ERROR if match.group("level") == "ERROR" else WARNING
+            return PipelineEvent(kind, match.group("source"), {"message": match.group("body")}, line)
+    elif first == "/":
+        # Caps notifications make up most of -v output and nobody subscribes to them
+        if ": caps = " in line:
+            return None
+        match = _PROPERTY_RE.match(line)
+        if match is not None:
+            return PipelineEvent(PROPERTY, match.group("source"), {match.group("name"): match.group("value")}, line)
+    return None
+
+
+class LineRing:
+    """Most recent output lines, bounded by a fixed byte budget."""
+
+    def __init__(self, max_bytes: int = 256 * 1024, max_line: int = 2048):
+        self.max_bytes = max_bytes
+        self.max_line = max_line
+        self.bytes = 0
+        self._lines: Deque[str] = deque()
+
+    def append(self, line: str):
+        if len(line) > self.max_line:
+            line = line[: self.max_line]
+        self._lines.append(line)
+        self.bytes += len(line)
+        while self.bytes > self.max_bytes:
+            self.bytes -= len(self._lines.popleft())
+
+    def tail(self, count: int = 50) -> List[str]:
+        if count >= len(self._lines):
+            return list(self._lines)
+        return list(self._lines)[-count:]
+
+    def clear(self):
+        self._lines.clear()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._lines)
+
+
+class EventBus:
+    def __init__(self):
+        self._subscribers: Dict[str, List[Callable[[PipelineEvent], None]]] = defaultdict(list)
+
+    def subscribe(self, kind: str, callback: Callable[[PipelineEvent], None]):
+        self._subscribers[kind].append(callback)
+
+    def unsubscribe(self, kind: str, callback: Callable[[PipelineEvent], None]):
+        if callback in self._subscribers.get(kind, ()):
+            self._subscribers[kind].remove(callback)
+
+    def publish(self, event: PipelineEvent):
+        for callback in self._subscribers.get(event.kind, ()):
+            try:
+                callback(event)
+            except Exception:
+                logger.exception(f"Subscriber for {event.kind} failed")
+
+
+class GstOutput:
+    """Captures gst-launch stdout/stderr into a bounded ring and a size-capped
+    rotating log, and publishes the parsed pipeline events."""
+
+    def __init__(
+        self,
+        log_path: Optional[str] = None,
+        max_log_bytes: int = 2 * 1024 * 1024,
+        log_backups: int = 2,
+        ring: Optional[LineRing] = None,
+    ):
+        self.ring = ring or LineRing()
+        self.events = EventBus()
+        self._log: Optional[logging.Logger] = None
+        if log_path is not None:
+            handler = RotatingFileHandler(log_path, maxBytes=max_log_bytes, backupCount=log_backups, delay=True)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._log = logging.getLogger(f"{__name__}.pipeline")
+            self._log.propagate = False
+            self._log.setLevel(logging.INFO)
+            self._log.handlers.clear()
+            self._log.addHandler(handler)
+
+    def feed(self, line: str):
+        line = line.rstrip("\n")
+        self.ring.append(line)
+        if self._log is not None:
+            self._log.info(line)
+        event = parse_line(line)
+        if event is not None:
+            self.events.publish(event)
+
+    async def pump(self, stream: asyncio.StreamReader):
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # Line longer than the stream buffer limit, drop what is buffered
+                line = b"\n"
+            if not line:
+                return
+            self.feed(line.decode(errors="replace"))
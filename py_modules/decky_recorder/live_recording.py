@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+from typing import List, Optional
+
+from decky_recorder import matroska, metrics
+from decky_recorder.segment_index import NS_PER_SECOND, Segment
+
+logger = logging.getLogger(__name__)
+
+
+class LiveRecording:
+    """A manual recording cut from the replay buffer while it keeps running.
+
+    gst-launch cannot add a branch to a running pipeline, so instead of a
+    second muxer the recording is built from the fragments the buffer writes
+    anyway. Nothing is encoded twice and the buffer keeps its history.
+
+    Matroska fragments are appended to the output as soon as they close, so
+    stopping only waits for the fragment in progress. Other formats keep their
+    fragments out of the buffer's retention and are joined when the recording
+    stops.
+    """
+
+    def __init__(self, output: str, fileformat: str, start: int, close_timeout: float = 15.0):
+        self.output = output
+        # Buffer timeline, in nanoseconds. `start` moves back to a keyframe once
+        # the first fragment is indexed, `end` is set when the recording stops.
+        self.start = start
+        self.end: Optional[int] = None
+        self.segments: List[Segment] = []
+        self.native = fileformat == "mkv"
+        self._partial = output + ".temp"
+        self._writer: Optional[matroska.MatroskaConcatWriter] = None
+        self._busy: Optional[str] = None
+        self._written_end = start
+        self._close_timeout = close_timeout
+        self._lock = asyncio.Lock()
+        self._closed = asyncio.Event()
+
+    def in_use(self, path: str) -> bool:
+        return path == self._busy
+
+    def retains(self, path: str) -> bool:
+        """True for fragments the buffer must not delete yet."""
+        return not self.native and any(s.path == path for s in self.segments)
+
+    @property
+    def duration(self) -> float:
+        end = self.end if self.end is not None else (self.segments[-1].end if self.segments else self.start)
+        return max(0, end - self.start) / NS_PER_SECOND
+
+    def _wanted(self, segment: Segment) -> bool:
+        if segment.end <= self.start or any(s is segment for s in self.segments):
+            return False
+        return self.end is None or segment.start < self.end
+
+    async def on_fragment_closed(self, segment: Segment):
+        if not self._wanted(segment):
+            return
+        if not self.segments:
+            offsets = [k for k in segment.keyframes if segment.start + k <= self.start]
+            self.start = segment.start + (offsets[-1] if offsets else 0)
+        self.segments.append(segment)
+        if self.native:
+            async with self._lock:
+                await self._append(segment)
+        self._closed.set()
+        self._closed = asyncio.Event()
+
+    async def _append(self, segment: Segment):
+        start = max(0, self.start - segment.start)
+        end = self.end - segment.start if self.end is not None and self.end < segment.end else None
+
+        def _write():
+            fragment = matroska.read_fragment(segment.path)
+            if self._writer is None:
+                self._writer = matroska.MatroskaConcatWriter(self._partial, fragment)
+            matroska.append_trimmed(self._writer, fragment, segment.duration, start, end)
+
+        self._busy = segment.path
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, _write)
+            self._written_end = segment.end if end is None else self.end
+            metrics.inc("bytes_written_total", segment.size, {"kind": "recording"})
+        except (OSError, matroska.MatroskaError) as e:
+            # Keep the rest of the recording in the buffer and join it with ffmpeg on stop
+            logger.warning(f"Cannot append {segment.path} to {self.output} ({e}), joining on stop instead")
+            self.native = False
+            if self._writer is not None:
+                self._writer.abort()
+                self._writer = None
+            self.segments = [s for s in self.segments if s.end > self._written_end]
+            self.start = max(self.start, self._written_end)
+        finally:
+            self._busy = None
+
+    async def stop(self, end: int) -> bool:
+        """Ends the recording at `end` once the fragment holding it has closed.
+
+        Returns True if the output is complete. Otherwise the caller joins
+        `segments` between `start` and `end` itself, and when there are none
+        nothing was recorded at all."""
+        self.end = end
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self._close_timeout
+        while not any(s.end >= end for s in self.segments):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self._closed.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        if self.segments and self.segments[-1].end < end:
+            logger.warning(f"Recording {self.output} ends early, its last fragment never closed")
+            self.end = self.segments[-1].end
+        if not self.native:
+            return False
+        async with self._lock:
+            if self._writer is None:
+                # No fragment of the recording ever closed, so there is no file
+                return False
+            writer, self._writer = self._writer, None
+            await loop.run_in_executor(None, writer.close)
+            os.replace(self._partial, self.output)
+        return True
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer = None
@@ -0,0 +1,684 @@
+"""Minimal streaming Matroska reader/writer for stitching splitmuxsink fragments.
+
+Only the element headers are parsed; block payloads are never read into Python
+and are copied file to file by the kernel.
+"""
+
+import ctypes
+import logging
+import mmap
+import os
+import struct
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+DURATION = 0x4489
+MUXING_APP = 0x4D80
+WRITING_APP = 0x5741
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_TYPE = 0x83
+CODEC_ID = 0x86
+CODEC_PRIVATE = 0x63A2
+VIDEO = 0xE0
+AUDIO = 0xE1
+CLUSTER = 0x1F43B675
+TIMECODE = 0xE7
+SIMPLE_BLOCK = 0xA3
+BLOCK_GROUP = 0xA0
+BLOCK = 0xA1
+REFERENCE_BLOCK = 0xFB
+BLOCK_DURATION = 0x9B
+CUES = 0x1C53BB6B
+CUE_POINT = 0xBB
+CUE_TIME = 0xB3
+CUE_TRACK_POSITIONS = 0xB7
+CUE_TRACK = 0xF7
+CUE_CLUSTER_POSITION = 0xF1
+VOID = 0xEC
+
+TRACK_TYPE_VIDEO = 1
+TRACK_TYPE_AUDIO = 2
+
+LEVEL1_IDS = {SEEK_HEAD, INFO, TRACKS, CLUSTER, CUES, 0x1254C367, 0x1043A770, 0x1941A469}
+
+UNKNOWN_SIZE = None
+_UNKNOWN_SIZE_8 = b"\x01\xff\xff\xff\xff\xff\xff\xff"
+
+# fallocate(2) mode that reserves blocks past the end without growing the file
+_FALLOC_FL_KEEP_SIZE = 0x01
+_libc = None
+
+
+class MatroskaError(Exception):
+    pass
+
+
+class IncompatibleFragments(MatroskaError):
+    """The fragments do not share codec parameters and cannot be stream-joined."""
+
+
+# Reading
+
+
+def read_element_header(buf, pos: int, end: int) -> Tuple[int, Optional[int], int]:
+    """Returns (id, size, header length) of the element at `pos`. Size is None
+    for unknown-size elements."""
+    if pos >= end:
+        raise MatroskaError("element header past end of data")
+    first = buf[pos]
+    id_len = 8 - first.bit_length() + 1
+    if id_len > 4 or pos + id_len > end:
+        raise MatroskaError(f"bad element id at {pos}")
+    element_id = int.from_bytes(buf[pos : pos + id_len], "big")
+    size_pos = pos + id_len
+    if size_pos >= end:
+        raise MatroskaError("element size past end of data")
+    first = buf[size_pos]
+    if first == 0:
+        raise MatroskaError(f"bad element size at {size_pos}")
+    size_len = 8 - first.bit_length() + 1
+    if size_pos + size_len > end:
+        raise MatroskaError("element size past end of data")
+    size = first & ((1 << (8 - size_len)) - 1)
+    for i in range(1, size_len):
+        size = (size << 8) | buf[size_pos + i]
+    if size == (1 << (7 * size_len)) - 1:
+        size = UNKNOWN_SIZE
+    return element_id, size, id_len + size_len
+
+
+def read_uint(buf, pos: int, size: int) -> int:
+    return int.from_bytes(buf[pos : pos + size], "big")
+
+
+def read_float(buf, pos: int, size: int) -> float:
+    if size == 4:
+        return struct.unpack(">f", buf[pos : pos + 4])[0]
+    if size == 8:
+        return struct.unpack(">d", buf[pos : pos + 8])[0]
+    return 0.0
+
+
+def read_vint(buf, pos: int) -> Tuple[int, int]:
+    first = buf[pos]
+    length = 8 - first.bit_length() + 1
+    value = first & ((1 << (8 - length)) - 1)
+    for i in range(1, length):
+        value = (value << 8) | buf[pos + i]
+    return value, length
+
+
+@dataclass
+class Track:
+    number: int
+    type: int
+    codec_id: str
+    codec_private: bytes
+    video: bytes
+    audio: bytes
+
+    @property
+    def key(self):
+        return (self.number, self.type, self.codec_id, self.codec_private, self.video, self.audio)
+
+
+@dataclass
+class Block:
+    # Absolute offset and total length of the SimpleBlock/BlockGroup element
+    offset: int
+    length: int
+    track: int
+    # Relative to the cluster timecode, in timecode scale units
+    timecode: int
+    keyframe: bool
+    # Absolute offset of the 16 bit relative timecode inside the block header
+    timecode_offset: int = 0
+
+
+@dataclass
+class Cluster:
+    offset: int
+    timecode: int
+    blocks: List[Block] = field(default_factory=list)
+
+
+@dataclass
+class Fragment:
+    path: str
+    ebml_header: bytes
+    timecode_scale: int
+    # In timecode scale units, as written in Info
+    duration: Optional[float]
+    tracks_raw: bytes
+    tracks: List[Track]
+    clusters: List[Cluster]
+    truncated: bool = False
+
+    @property
+    def video_track(self) -> Optional[int]:
+        for track in self.tracks:
+            if track.type == TRACK_TYPE_VIDEO:
+                return track.number
+        return None
+
+    @property
+    def first_timecode(self) -> int:
+        return self.clusters[0].timecode if self.clusters else 0
+
+    @property
+    def last_timecode(self) -> int:
+        """Timecode of the last block, in timecode scale units."""
+        for cluster in reversed(self.clusters):
+            if cluster.blocks:
+                return cluster.timecode + max(b.timecode for b in cluster.blocks)
+        return self.first_timecode
+
+    def keyframes(self) -> List[int]:
+        """Absolute timecodes of the video keyframes."""
+        video = self.video_track
+        return [c.timecode + b.timecode for c in self.clusters for b in c.blocks if b.keyframe and b.track == video]
+
+
+def keyframe_offsets(path: str) -> List[int]:
+    """Nanosecond offsets of the video keyframes from the start of the fragment."""
+    fragment = read_fragment(path)
+    base = fragment.first_timecode
+    return [(timecode - base) * fragment.timecode_scale for timecode in fragment.keyframes()]
+
+
+def _parse_tracks(buf, pos: int, end: int) -> List[Track]:
+    tracks = []
+    while pos < end:
+        element_id, size, header = read_element_header(buf, pos, end)
+        data = pos + header
+        if element_id == TRACK_ENTRY:
+            number = track_type = 0
+            codec_id = ""
+            codec_private = video = audio = b""
+            child = data
+            while child < data + size:
+                child_id, child_size, child_header = read_element_header(buf, child, data + size)
+                value = child + child_header
+                if child_id == TRACK_NUMBER:
+                    number = read_uint(buf, value, child_size)
+                elif child_id == TRACK_TYPE:
+                    track_type = read_uint(buf, value, child_size)
+                elif child_id == CODEC_ID:
+                    codec_id = bytes(buf[value : value + child_size]).decode(errors="replace")
+                elif child_id == CODEC_PRIVATE:
+                    codec_private = bytes(buf[value : value + child_size])
+                elif child_id == VIDEO:
+                    video = bytes(buf[value : value + child_size])
+                elif child_id == AUDIO:
+                    audio = bytes(buf[value : value + child_size])
+                child = value + child_size
+            tracks.append(Track(number, track_type, codec_id, codec_private, video, audio))
+        pos = data + size
+    return tracks
+
+
+def _parse_block_header(buf, pos: int, end: int) -> Tuple[int, int, int, int]:
+    track, track_len = read_vint(buf, pos)
+    timecode = struct.unpack(">h", buf[pos + track_len : pos + track_len + 2])[0]
+    flags = buf[pos + track_len + 2] if pos + track_len + 2 < end else 0
+    return track, timecode, flags, pos + track_len
+
+
+def _parse_cluster(buf, offset: int, data: int, end: int) -> Tuple[Cluster, int, bool]:
+    """Parses one cluster. Returns it, the offset just past it, and whether it was
+    cut short by the end of the file."""
+    cluster = Cluster(offset, 0)
+    pos = data
+    while pos < end:
+        try:
+            child_id, child_size, header = read_element_header(buf, pos, end)
+        except MatroskaError:
+            return cluster, pos, True
+        if child_id in LEVEL1_IDS:
+            # Unknown-size cluster ends where the next level 1 element starts
+            return cluster, pos, False
+        if child_size is None or pos + header + child_size > end:
+            return cluster, pos, True
+        value = pos + header
+        if child_id == TIMECODE:
+            cluster.timecode = read_uint(buf, value, child_size)
+        elif child_id == SIMPLE_BLOCK:
+            track, timecode, flags, timecode_offset = _parse_block_header(buf, value, value + child_size)
+            cluster.blocks.append(Block(pos, header + child_size, track, timecode, bool(flags & 0x80), timecode_offset))
+        elif child_id == BLOCK_GROUP:
+            track = timecode = timecode_offset = 0
+            keyframe = True
+            child = value
+            while child < value + child_size:
+                gid, gsize, gheader = read_element_header(buf, child, value + child_size)
+                if gid == BLOCK:
+                    track, timecode, _, timecode_offset = _parse_block_header(
+                        buf, child + gheader, child + gheader + gsize
+                    )
+                elif gid == REFERENCE_BLOCK:
+                    keyframe = False
+                child += gheader + gsize
+            cluster.blocks.append(Block(pos, header + child_size, track, timecode, keyframe, timecode_offset))
+        pos = value + child_size
+    return cluster, pos, False
+
+
+def read_fragment(path: str) -> Fragment:
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size == 0:
+            raise MatroskaError(f"{path} is empty")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return _read_fragment(path, buf, file_size)
+
+
+def _read_fragment(path: str, buf, file_size: int) -> Fragment:
+    element_id, size, header = read_element_header(buf, 0, file_size)
+    if element_id != EBML:
+        raise MatroskaError(f"{path} is not an EBML file")
+    ebml_header = bytes(buf[0 : header + size])
+    pos = header + size
+    element_id, size, header = read_element_header(buf, pos, file_size)
+    if element_id != SEGMENT:
+        raise MatroskaError(f"{path} has no Segment")
+    pos += header
+    segment_end = file_size if size is None else min(file_size, pos + size)
+    truncated = size is not None and pos + size > file_size
+
+    timecode_scale = 1_000_000
+    duration = None
+    tracks_raw = b""
+    tracks: List[Track] = []
+    clusters: List[Cluster] = []
+    while pos < segment_end:
+        try:
+            element_id, size, header = read_element_header(buf, pos, segment_end)
+        except MatroskaError:
+            truncated = True
+            break
+        data = pos + header
+        if element_id == CLUSTER:
+            end = segment_end if size is None else min(segment_end, data + size)
+            cluster, pos, cut = _parse_cluster(buf, pos, data, end)
+            truncated = truncated or cut or (size is not None and data + size > segment_end)
+            if cluster.blocks:
+                clusters.append(cluster)
+            if cut:
+                break
+            continue
+        if size is None or data + size > segment_end:
+            truncated = True
+            break
+        if element_id == INFO:
+            child = data
+            while child < data + size:
+                child_id, child_size, child_header = read_element_header(buf, child, data + size)
+                if child_id == TIMECODE_SCALE:
+                    timecode_scale = read_uint(buf, child + child_header, child_size)
+                elif child_id == DURATION:
+                    duration = read_float(buf, child + child_header, child_size)
+                child += child_header + child_size
+        elif element_id == TRACKS:
+            tracks_raw = bytes(buf[pos : data + size])
+            tracks = _parse_tracks(buf, data, data + size)
+        pos = data + size
+
+    if not tracks:
+        raise MatroskaError(f"{path} has no Tracks")
+    return Fragment(path, ebml_header, timecode_scale, duration, tracks_raw, tracks, clusters, truncated)
+
+
+# Writing
+
+
+def encode_id(element_id: int) -> bytes:
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big")
+
+
+def encode_size(size: int, length: Optional[int] = None) -> bytes:
+    if length is None:
+        length = 1
+        while size >= (1 << (7 * length)) - 1:
+            length += 1
+    return ((1 << (7 * length)) | size).to_bytes(length, "big")
+
+
+def encode_uint(value: int, length: Optional[int] = None) -> bytes:
+    if length is None:
+        length = max(1, (value.bit_length() + 7) // 8)
+    return value.to_bytes(length, "big")
+
+
+def element(element_id: int, payload: bytes) -> bytes:
+    return encode_id(element_id) + encode_size(len(payload)) + payload
+
+
+def uint_element(element_id: int, value: int, length: Optional[int] = None) -> bytes:
+    return element(element_id, encode_uint(value, length))
+
+
+def float_element(element_id: int, value: float) -> bytes:
+    return element(element_id, struct.pack(">d", value))
+
+
+def copy_range(src_fd: int, dst_fd: int, offset: int, length: int):
+    """Copies file to file without passing the data through Python where the kernel allows it."""
+    remaining = length
+    try:
+        while remaining:
+            copied = os.copy_file_range(src_fd, dst_fd, remaining, offset)
+            if copied == 0:
+                raise MatroskaError("source ended early")
+            offset += copied
+            remaining -= copied
+        return
+    except (AttributeError, OSError):
+        # EXDEV across filesystems on some kernels, ENOSYS on old ones
+        pass
+    try:
+        while remaining:
+            copied = os.sendfile(dst_fd, src_fd, offset, remaining)
+            if copied == 0:
+                raise MatroskaError("source ended early")
+            offset += copied
+            remaining -= copied
+        return
+    except (AttributeError, OSError):
+        pass
+    while remaining:
+        chunk = os.pread(src_fd, min(remaining, 1 << 20), offset)
+        if not chunk:
+            raise MatroskaError("source ended early")
+        view = memoryview(chunk)
+        while view:
+            written = os.write(dst_fd, view)
+            view = view[written:]
+        offset += len(chunk)
+        remaining -= len(chunk)
+
+
+def preallocate(fd: int, size: int) -> bool:
+    """Reserves `size` bytes of disk for `fd` up front, so a long write gets
+    contiguous extents and cannot run out of space halfway through.
+
+    The file length is left alone, so a reader or a crash never sees a zeroed
+    tail. glibc's posix_fallocate writes zeros on filesystems without
+    fallocate support, so the syscall is used directly and False is returned
+    there instead.
+    """
+    global _libc
+    if size <= 0:
+        return False
+    try:
+        if _libc is None:
+            _libc = ctypes.CDLL(None, use_errno=True)
+            _libc.fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+        return _libc.fallocate(fd, _FALLOC_FL_KEEP_SIZE, 0, size) == 0
+    except (AttributeError, OSError):
+        return False
+
+
+BlockFilter = Callable[[int, Block], bool]
+
+
+class MatroskaConcatWriter:
+    """Writes fragments with identical codec parameters back to back into one file.
+
+    Cluster timecodes are rebased onto a continuous timeline, block payloads
+    are copied by the kernel, and Cues, Duration and the Segment size are
+    written when the file is closed. Until then the file is a valid
+    live-style Matroska stream with an unknown-size Segment.
+
+    `reserve` preallocates that many bytes when the final size is known
+    roughly; whatever is left unused is given back on close.
+    """
+
+    def __init__(self, path: str, template: Fragment, writing_app: str = "decky-recorder", reserve: int = 0):
+        self.path = path
+        self._template = template
+        self._track_keys = [t.key for t in template.tracks]
+        self._video_track = template.video_track
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._preallocated = preallocate(self._fd, reserve)
+        self._pos = 0
+        # Output timeline position where the next fragment starts, in timecode scale units
+        self._offset = 0
+        self._end = 0
+        self._cues: List[Tuple[int, int]] = []
+        self.bytes_written = 0
+
+        self._write(template.ebml_header)
+        self._write(encode_id(SEGMENT))
+        self._segment_size_pos = self._pos
+        self._write(_UNKNOWN_SIZE_8)
+        self._segment_data = self._pos
+
+        # SeekHead with fixed-width positions so they can be patched on close
+        seek_entries = []
+        for target in (INFO, TRACKS, CUES):
+            seek_entries.append(element(SEEK, element(SEEK_ID, encode_id(target)) + uint_element(SEEK_POSITION, 0, 8)))
+        self._seek_head_pos = self._pos
+        self._write(element(SEEK_HEAD, b"".join(seek_entries)))
+
+        self._info_pos = self._pos
+        info_head = uint_element(TIMECODE_SCALE, template.timecode_scale)
+        duration = float_element(DURATION, 0.0)
+        apps = element(MUXING_APP, writing_app.encode()) + element(WRITING_APP, writing_app.encode())
+        info_payload = info_head + duration + apps
+        info = element(INFO, info_payload)
+        self._duration_pos = self._pos + len(info) - len(info_payload) + len(info_head) + len(duration) - 8
+        self._write(info)
+
+        self._tracks_pos = self._pos
+        self._write(template.tracks_raw)
+
+    @property
+    def duration(self) -> int:
+        """Written duration in timecode scale units."""
+        return self._end
+
+    def _write(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            written = os.write(self._fd, view)
+            view = view[written:]
+        self._pos += len(data)
+        self.bytes_written += len(data)
+
+    def _pwrite(self, data: bytes, offset: int):
+        os.pwrite(self._fd, data, offset)
+
+    def check(self, fragment: Fragment):
+        if [t.key for t in fragment.tracks] != self._track_keys:
+            raise IncompatibleFragments(f"{fragment.path} has different codec parameters")
+        if fragment.timecode_scale != self._template.timecode_scale:
+            raise IncompatibleFragments(f"{fragment.path} has a different timecode scale")
+
+    def append(
+        self,
+        fragment: Fragment,
+        duration: Optional[int] = None,
+        keep: Optional[BlockFilter] = None,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+    ):
+        """Appends the fragment's clusters.
+
+        `duration` (timecode scale units) is how far the timeline advances
+        afterwards; it defaults to the fragment's own Duration. `keep`, given
+        the absolute source timecode and the block, can drop blocks. `start`
+        and `end` are source timecodes to trim to; `start` should be a video
+        keyframe.
+        """
+        self.check(fragment)
+        base = fragment.first_timecode if start is None else start
+        with open(fragment.path, "rb") as src:
+            src_fd = src.fileno()
+            for cluster in fragment.clusters:
+                blocks = [
+                    b
+                    for b in cluster.blocks
+                    if (start is None or cluster.timecode + b.timecode >= start)
+                    and (end is None or cluster.timecode + b.timecode < end)
+                    and (keep is None or keep(cluster.timecode + b.timecode, b))
+                ]
+                if not blocks:
+                    continue
+                # Contiguous runs of blocks are copied in one go
+                spans: List[List[int]] = []
+                for block in blocks:
+                    if spans and spans[-1][0] + spans[-1][1] == block.offset:
+                        spans[-1][1] += block.length
+                    else:
+                        spans.append([block.offset, block.length])
+                timecode = cluster.timecode - base + self._offset
+                # A cluster that starts before the trim point is moved up to it, and the
+                # relative timecodes of its blocks are rewritten to match
+                shift = min(0, cluster.timecode - base)
+                timecode -= shift
+                timecode_element = uint_element(TIMECODE, max(0, timecode))
+                size = len(timecode_element) + sum(length for _, length in spans)
+                cluster_pos = self._pos - self._segment_data
+                first = blocks[0]
+                if first.keyframe and first.track == self._video_track:
+                    self._cues.append((max(0, timecode + first.timecode + shift), cluster_pos))
+                self._write(encode_id(CLUSTER) + encode_size(size) + timecode_element)
+                if shift:
+                    for block in blocks:
+                        data = bytearray(os.pread(src_fd, block.length, block.offset))
+                        position = block.timecode_offset - block.offset
+                        data[position : position + 2] = struct.pack(">h", block.timecode + shift)
+                        self._write(data)
+                else:
+                    for offset, length in spans:
+                        copy_range(src_fd, self._fd, offset, length)
+                        self._pos += length
+                        self.bytes_written += length
+                last = max(b.timecode for b in blocks) + shift
+                self._end = max(self._end, timecode + last)
+        if duration is None:
+            if end is not None:
+                duration = end - base
+            elif fragment.duration:
+                duration = int(round(fragment.duration)) - (base - fragment.first_timecode)
+            else:
+                duration = fragment.last_timecode - base
+        self._offset += duration
+        self._end = max(self._end, self._offset)
+
+    def close(self) -> int:
+        """Writes Cues and patches the header. Returns the duration in nanoseconds."""
+        try:
+            cues_pos = self._pos - self._segment_data
+            points = []
+            for timecode, cluster_pos in self._cues:
+                positions = uint_element(CUE_TRACK, self._video_track) + uint_element(CUE_CLUSTER_POSITION, cluster_pos)
+                points.append(
+                    element(CUE_POINT, uint_element(CUE_TIME, timecode) + element(CUE_TRACK_POSITIONS, positions))
+                )
+            if points:
+                self._write(element(CUES, b"".join(points)))
+
+            self._pwrite(struct.pack(">d", float(self._end)), self._duration_pos)
+            self._pwrite(encode_size(self._pos - self._segment_data, 8), self._segment_size_pos)
+            # Each Seek entry ends with its 8 byte position
+            seek_positions = [self._info_pos, self._tracks_pos, self._segment_data + cues_pos if points else None]
+            # All three targets have 4 byte IDs, so the entries are the same size
+            entry_len = len(element(SEEK, element(SEEK_ID, encode_id(INFO)) + uint_element(SEEK_POSITION, 0, 8)))
+            pos = self._seek_head_pos + len(encode_id(SEEK_HEAD)) + 1
+            for absolute in seek_positions:
+                if absolute is not None:
+                    self._pwrite(encode_uint(absolute - self._segment_data, 8), pos + entry_len - 8)
+                else:
+                    # No Cues, turn the entry into padding
+                    self._pwrite(encode_id(VOID) + encode_size(entry_len - 2), pos)
+                pos += entry_len
+            if self._preallocated:
+                # Frees the reserved blocks past the end
+                os.ftruncate(self._fd, self._pos)
+            os.fsync(self._fd)
+        finally:
+            os.close(self._fd)
+        return self._end * self._template.timecode_scale
+
+    def abort(self):
+        os.close(self._fd)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def append_trimmed(
+    writer: MatroskaConcatWriter,
+    fragment: Fragment,
+    duration: Optional[int] = None,
+    start: int = 0,
+    end: Optional[int] = None,
+):
+    """Appends `fragment` cut to [start, end), in nanoseconds from its first
+    cluster. `duration` is its full length in nanoseconds, if known."""
+    scale = fragment.timecode_scale
+    trim_start = fragment.first_timecode + start // scale if start else None
+    trim_end = fragment.first_timecode + end // scale if end is not None else None
+    timeline = None
+    if duration is not None and trim_end is None:
+        timeline = int(round(duration / scale)) - start // scale
+    writer.append(fragment, timeline, start=trim_start, end=trim_end)
+
+
+def concat(
+    paths: Sequence[str],
+    output: str,
+    durations: Optional[Sequence[int]] = None,
+    progress: Optional[Callable[[float], None]] = None,
+    start: int = 0,
+    end: Optional[int] = None,
+) -> int:
+    """Joins Matroska fragments into `output`. `durations` are per-fragment
+    lengths in nanoseconds, e.g. the real running-time spans from the segment
+    index. `start` trims the first fragment and `end` cuts the last one, both
+    in nanoseconds from the start of that fragment. Returns the output duration
+    in nanoseconds.
+
+    Raises IncompatibleFragments if the codec parameters differ.
+    """
+    if not paths:
+        raise MatroskaError("nothing to concatenate")
+    fragments = [read_fragment(p) for p in paths]
+    template = fragments[0]
+    for fragment in fragments[1:]:
+        if [t.key for t in fragment.tracks] != [t.key for t in template.tracks]:
+            raise IncompatibleFragments(f"{fragment.path} has different codec parameters")
+    partial = output + ".part"
+    # The output is about as big as its fragments together
+    writer = MatroskaConcatWriter(partial, template, reserve=sum(os.path.getsize(p) for p in paths))
+    try:
+        for i, fragment in enumerate(fragments):
+            append_trimmed(
+                writer,
+                fragment,
+                durations[i] if durations is not None else None,
+                start if i == 0 else 0,
+                end if i == len(fragments) - 1 else None,
+            )
+            if progress is not None:
+                progress((i + 1) / len(fragments))
+    except BaseException:
+        writer.abort()
+        raise
+    duration = writer.close()
+    os.replace(partial, output)
+    return duration
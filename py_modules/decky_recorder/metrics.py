@@ -0,0 +1,225 @@
+"""In-process counters, gauges and latency histograms.
+
+Everything goes through one module-level Registry. While it is disabled every
+recording call returns after a single attribute check, so instrumented code
+costs next to nothing.
+"""
+
+import asyncio
+import bisect
+import functools
+import inspect
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from decky_recorder import files
+
+logger = logging.getLogger(__name__)
+
+# Seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Optional[Dict[str, object]]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items())) if labels else ()
+
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+        }
+
+
+class Registry:
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.started = time.time()
+
+    def reset(self):
+        self.counters.clear()
+        self.gauges.clear()
+        self.histograms.clear()
+        self.started = time.time()
+
+    def inc(self, name: str, value: float = 1, labels: Optional[Dict[str, object]] = None):
+        if not self.enabled:
+            return
+        series = self.counters.setdefault(name, {})
+        key = _labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, labels: Optional[Dict[str, object]] = None):
+        if not self.enabled:
+            return
+        self.gauges.setdefault(name, {})[_labels(labels)] = value
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, object]] = None):
+        if not self.enabled:
+            return
+        series = self.histograms.setdefault(name, {})
+        key = _labels(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def timed(self, name: str, labels: Optional[Dict[str, object]] = None):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, labels)
+
+    def snapshot(self) -> dict:
+        def series(values, render=lambda v: v):
+            return {name: [{"labels": dict(k), "value": render(v)} for k, v in s.items()] for name, s in values.items()}
+
+        return {
+            "enabled": self.enabled,
+            "uptime": time.time() - self.started,
+            "counters": series(self.counters),
+            "gauges": series(self.gauges),
+            "histograms": series(self.histograms, Histogram.as_dict),
+        }
+
+    def prometheus_text(self, prefix: str = "decky_recorder_") -> str:
+        def render_labels(labels: Labels, extra: Labels = ()) -> str:
+            pairs = labels + extra
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            lines.append(f"# TYPE {prefix}{name} counter")
+            lines += [f"{prefix}{name}{render_labels(k)} {v}" for k, v in series.items()]
+        for name, series in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {prefix}{name} gauge")
+            lines += [f"{prefix}{name}{render_labels(k)} {v}" for k, v in series.items()]
+        for name, series in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {prefix}{name} histogram")
+            for k, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{prefix}{name}_bucket{render_labels(k, (('le', le),))} {cumulative}")
+                lines.append(f"{prefix}{name}_sum{render_labels(k)} {histogram.sum}")
+                lines.append(f"{prefix}{name}_count{render_labels(k)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str):
+        """Writes the Prometheus text format to `path`, replacing it atomically."""
+        files.write_atomic(path, self.prometheus_text())
+
+
+REGISTRY = Registry()
+
+inc = REGISTRY.inc
+set_gauge = REGISTRY.set
+observe = REGISTRY.observe
+timed = REGISTRY.timed
+
+
+def instrument(fn, name: str = "rpc_latency_seconds"):
+    """Records the call latency of `fn` under its name, and counts failures."""
+    labels = {"method": fn.__name__}
+
+    if inspect.iscoroutinefunction(fn):
+
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            if not REGISTRY.enabled:
+                return await fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                REGISTRY.inc("rpc_errors_total", labels=labels)
+                raise
+            finally:
+                REGISTRY.observe(name, time.perf_counter() - started, labels)
+
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not REGISTRY.enabled:
+            return fn(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            REGISTRY.inc("rpc_errors_total", labels=labels)
+            raise
+        finally:
+            REGISTRY.observe(name, time.perf_counter() - started, labels)
+
+    return wrapper
+
+
+def instrument_class(cls, exclude: Iterable[str] = ()):
+    """Wraps the RPC methods of `cls` with `instrument`: its public coroutine
+    functions. Synchronous helpers and underscore methods are not RPCs."""
+    exclude = set(exclude)
+    for attr, value in list(vars(cls).items()):
+        if attr in exclude or attr.startswith("_") or not inspect.iscoroutinefunction(value):
+            continue
+        setattr(cls, attr, instrument(value))
+    return cls
+
+
+async def dump_periodically(path: str, interval: float = 15.0, collect: Optional[Callable[[], None]] = None):
+    while True:
+        await asyncio.sleep(interval)
+        if REGISTRY.enabled:
+            try:
+                if collect is not None:
+                    collect()
+                REGISTRY.dump(path)
+            except OSError as e:
+                logger.warning(f"Could not write metrics to {path}: {e}")
+            except Exception:
+                logger.exception("Could not collect metrics")
@@ -0,0 +1,367 @@
+"""Typed description of the capture pipelines, rendered to gst-launch argv.
+
+Elements, caps and pad references are plain values that are chained together
+and turned into argv tokens without a shell in between. Encoders are picked
+from what the installed GStreamer actually provides, and presets bound how
+much work the encoder gets.
+"""
+
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple, Union
+
+from decky_recorder import process
+
+logger = logging.getLogger(__name__)
+
+NS_PER_SECOND = 1_000_000_000
+
+
+@dataclass(frozen=True)
+class Fraction:
+    num: int
+    den: int = 1
+
+    def __str__(self):
+        return f"{self.num}/{self.den}"
+
+
+@dataclass(frozen=True)
+class Range:
+    low: Union[int, Fraction]
+    high: Union[int, Fraction]
+
+    def __str__(self):
+        return f"[{self.low},{self.high}]"
+
+
+def format_value(value) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+@dataclass
+class Element:
+    factory: str
+    props: Dict[str, object] = field(default_factory=dict)
+    name: Optional[str] = None
+
+    def tokens(self) -> List[str]:
+        tokens = [self.factory]
+        if self.name:
+            tokens.append(f"name={self.name}")
+        tokens += [f"{key}={format_value(value)}" for key, value in self.props.items() if value is not None]
+        return tokens
+
+
+@dataclass
+class Caps:
+    media: str
+    fields: Dict[str, object] = field(default_factory=dict)
+    features: Optional[str] = None
+
+    def tokens(self) -> List[str]:
+        head = f"{self.media}({self.features})" if self.features else self.media
+        return [",".join([head] + [f"{key}={format_value(value)}" for key, value in self.fields.items()])]
+
+
+@dataclass
+class Pad:
+    """Reference to a pad of a named element, e.g. `sink.audio_0`."""
+
+    element: str
+    pad: str = ""
+
+    def tokens(self) -> List[str]:
+        return [f"{self.element}.{self.pad}"]
+
+
+Link = Union[Element, Caps, Pad]
+
+
+class Pipeline:
+    def __init__(self):
+        self.chains: List[List[Link]] = []
+
+    def chain(self, *links: Link) -> "Pipeline":
+        self.chains.append(list(links))
+        return self
+
+    def element(self, name: str) -> Optional[Element]:
+        for chain in self.chains:
+            for link in chain:
+                if isinstance(link, Element) and link.name == name:
+                    return link
+        return None
+
+    def factories(self) -> List[str]:
+        return [link.factory for chain in self.chains for link in chain if isinstance(link, Element)]
+
+    def argv(self) -> List[str]:
+        argv = []
+        for chain in self.chains:
+            for i, link in enumerate(chain):
+                if i:
+                    argv.append("!")
+                argv += link.tokens()
+        return argv
+
+    def launch_argv(self, flags: Sequence[str] = ("-e", "-m", "-vvv")) -> List[str]:
+        return ["gst-launch-1.0", *flags] + self.argv()
+
+    def __str__(self):
+        return " ".join(self.argv())
+
+
+# Encoding
+
+
+@dataclass(frozen=True)
+class EncodingPreset:
+    name: str
+    bitrate: int
+    # cbr, vbr or cqp
+    rate_control: str
+    max_width: int
+    max_height: int
+    max_framerate: int
+    keyframe_interval: float = 1.0
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "bitrate": self.bitrate,
+            "rate_control": self.rate_control,
+            "max_width": self.max_width,
+            "max_height": self.max_height,
+            "max_framerate": self.max_framerate,
+            "keyframe_interval": self.keyframe_interval,
+        }
+
+
+# Bitrates in kbit/s. Capping the size also keeps a docked 4K output from being encoded at full size.
+PRESETS: Dict[str, EncodingPreset] = {
+    p.name: p
+    for p in (
+        EncodingPreset("performance", 6000, "cbr", 1280, 800, 30),
+        EncodingPreset("balanced", 12000, "vbr", 1920, 1200, 60),
+        EncodingPreset("quality", 24000, "vbr", 2560, 1600, 60),
+    )
+}
+DEFAULT_PRESET = "balanced"
+
+
+@dataclass(frozen=True)
+class VideoEncoder:
+    factory: str
+    hardware: bool
+    # Other elements the chain needs besides the encoder itself
+    requires: Tuple[str, ...] = ()
+
+
+ENCODERS: Tuple[VideoEncoder, ...] = (
+    VideoEncoder("vaapih264enc", True, ("vaapipostproc",)),
+    VideoEncoder("x264enc", False, ("videoconvert", "videoscale")),
+    VideoEncoder("openh264enc", False, ("videoconvert", "videoscale")),
+)
+
+
+def _size_caps(media_features: Optional[str], preset: EncodingPreset) -> Caps:
+    # Ranges let the scaler keep the source size when it already fits and
+    # pixel-aspect-ratio=1/1 keeps the aspect ratio when it has to shrink it
+    return Caps(
+        "video/x-raw",
+        {
+            "width": Range(16, preset.max_width),
+            "height": Range(16, preset.max_height),
+            "pixel-aspect-ratio": Fraction(1, 1),
+        },
+        media_features,
+    )
+
+
+def video_encode(encoder: VideoEncoder, preset: EncodingPreset) -> List[Link]:
+    """Rate limit, scale and encode raw video into H.264."""
+    keyframe_period = max(1, int(preset.max_framerate * preset.keyframe_interval))
+    # silent=false makes videorate notify its drop count, which -v prints
+    links: List[Link] = [
+        Element("videorate", {"max-rate": preset.max_framerate, "drop-only": True, "silent": False}, name="rate")
+    ]
+    if encoder.factory == "vaapih264enc":
+        links += [
+            Element("vaapipostproc"),
+            _size_caps("memory:VASurface", preset),
+            Element("queue"),
+            Element(
+                "vaapih264enc",
+                {"rate-control": preset.rate_control, "bitrate": preset.bitrate, "keyframe-period": keyframe_period},
+            ),
+        ]
+    elif encoder.factory == "x264enc":
+        links += [
+            Element("videoconvert"),
+            Element("videoscale"),
+            _size_caps(None, preset),
+            Element("queue"),
+            Element(
+                "x264enc",
+                {
+                    "pass": {"cbr": "cbr", "vbr": "qual", "cqp": "quant"}[preset.rate_control],
+                    "bitrate": preset.bitrate,
+                    "speed-preset": "superfast",
+                    "tune": "zerolatency",
+                    "key-int-max": keyframe_period,
+                },
+            ),
+        ]
+    elif encoder.factory == "openh264enc":
+        links += [
+            Element("videoconvert"),
+            Element("videoscale"),
+            _size_caps(None, preset),
+            Element("queue"),
+            Element(
+                "openh264enc",
+                {
+                    "rate-control": {"cbr": "bitrate", "vbr": "quality", "cqp": "off"}[preset.rate_control],
+                    # openh264enc takes bit/s
+                    "bitrate": preset.bitrate * 1000,
+                    "gop-size": keyframe_period,
+                    "complexity": "low",
+                },
+            ),
+        ]
+    else:
+        raise ValueError(f"Unknown encoder {encoder.factory}")
+    links.append(Element("h264parse"))
+    return links
+
+
+def audio_encode(bitrate: int, channels: int = 2) -> List[Link]:
+    return [
+        Caps("audio/x-raw", {"channels": channels}),
+        Element("audioconvert"),
+        Element("avenc_aac", {"bitrate": bitrate}),
+    ]
+
+
+# Name of the video source, which tells the plugin's capture pipelines apart
+# from any other gst-launch on the system
+MARKER = "deckyrecordersrc"
+
+
+def video_source(test: bool = False) -> List[Link]:
+    if test:
+        return [
+            Element("videotestsrc", {"is-live": True}, name=MARKER),
+            Caps("video/x-raw", {"framerate": Fraction(60)}),
+        ]
+    return [Element("pipewiresrc", {"do-timestamp": True}, name=MARKER)]
+
+
+def is_capture_process(name: Optional[str], cmdline: Optional[Sequence[str]]) -> bool:
+    """Whether a process is a capture pipeline started by the plugin. Exports,
+    compression and thumbnails are never one, whatever their file names."""
+    return name == "gst-launch-1.0" and f"name={MARKER}" in (cmdline or ())
+
+
+def audio_source(device: Optional[str] = None, test: bool = False) -> List[Link]:
+    if test:
+        return [Element("audiotestsrc", {"is-live": True})]
+    return [Element("pulsesrc", {"device": device})]
+
+
+# Output
+
+MUXERS = {"mp4": "mp4mux", "mkv": "matroskamux", "mov": "qtmux"}
+# Manual recordings are muxed straight into their final form. The ISO muxers are
+# fragmented so the file is playable as written and needs no finalizing remux.
+DIRECT_MUXER_PROPS: Dict[str, Dict[str, object]] = {
+    "mp4": {"fragment-duration": 1000},
+    "mov": {"fragment-duration": 1000},
+}
+
+
+def muxer_for(fileformat: str) -> str:
+    return MUXERS.get(fileformat, "matroskamux")
+
+
+def file_output(fileformat: str, location: str) -> List[Link]:
+    return [
+        Element(muxer_for(fileformat), dict(DIRECT_MUXER_PROPS.get(fileformat, {})), name="sink"),
+        Element("filesink", {"location": location}),
+    ]
+
+
+def split_output(fileformat: str, location: str, max_size_time: int, max_files: int, start_index: int = 0) -> Element:
+    return Element(
+        "splitmuxsink",
+        {
+            "muxer": muxer_for(fileformat),
+            "muxer-pad-map": "x-pad-map,audio=vid",
+            "location": location,
+            "max-size-time": max_size_time,
+            "max-files": max_files,
+            # Continues the file numbering of an earlier pipeline
+            "start-index": start_index or None,
+        },
+        name="sink",
+    )
+
+
+def recording_pipeline(
+    video: Sequence[Link], audio: Sequence[Sequence[Link]], output: Union[Sequence[Link], Element]
+) -> Pipeline:
+    """Joins an encoded video chain and one encoded audio chain per track with a
+    file or splitmuxsink output."""
+    pipeline = Pipeline()
+    if isinstance(output, Element):
+        # splitmuxsink takes its video on a request pad named "video"
+        pipeline.chain(*video, Pad(output.name, "video"))
+        pipeline.chain(output)
+    else:
+        pipeline.chain(*video, *output)
+    for track, chain in enumerate(audio):
+        pipeline.chain(*chain, Pad("sink", f"audio_{track}"))
+    return pipeline
+
+
+class EncoderProbe:
+    """Finds out once which encoders the installed GStreamer provides."""
+
+    def __init__(self, env: Optional[Mapping[str, str]] = None):
+        self._env = dict(env) if env is not None else None
+        self._factories: Dict[str, bool] = {}
+        self._lock = asyncio.Lock()
+
+    async def has(self, factory: str) -> bool:
+        if factory not in self._factories:
+            result = await process.run(["gst-inspect-1.0", "--exists", factory], timeout=10, env=self._env, log=False)
+            self._factories[factory] = result.ok
+        return self._factories[factory]
+
+    async def available(self) -> List[VideoEncoder]:
+        async with self._lock:
+            found = []
+            for encoder in ENCODERS:
+                if all([await self.has(f) for f in (encoder.factory, *encoder.requires)]):
+                    found.append(encoder)
+            return found
+
+    async def select(self, preferred: Optional[str] = None) -> VideoEncoder:
+        """The preferred encoder if it is available, otherwise the first one
+        that is, hardware first."""
+        available = await self.available()
+        if not available:
+            raise RuntimeError("No usable H.264 encoder found")
+        for encoder in available:
+            if encoder.factory == preferred:
+                return encoder
+        if preferred and preferred != available[0].factory:
+            logger.warning(f"Encoder {preferred} unavailable, using {available[0].factory}")
+        return available[0]
+
+    def status(self) -> dict:
+        return dict(self._factories)
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import os
+import signal
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+from decky_recorder import metrics
+
+logger = logging.getLogger(__name__)
+
+PIPE = asyncio.subprocess.PIPE
+DEVNULL = asyncio.subprocess.DEVNULL
+
+
+@dataclass
+class ProcessResult:
+    argv: List[str]
+    returncode: Optional[int]
+    stdout: str
+    stderr: str
+    timed_out: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0 and not self.timed_out
+
+
+def make_env(extra: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    env = dict(os.environ)
+    if extra:
+        env.update({k: str(v) for k, v in extra.items()})
+    return env
+
+
+async def spawn(
+    argv: Sequence[str],
+    env: Optional[Dict[str, str]] = None,
+    stdin=DEVNULL,
+    stdout=PIPE,
+    stderr=PIPE,
+    log: bool = True,
+) -> asyncio.subprocess.Process:
+    """Starts `argv` without a shell and returns the asyncio process handle."""
+    argv = [str(a) for a in argv]
+    if log:
+        logger.info(f"Spawn: {argv}")
+    metrics.inc("subprocess_spawns_total", labels={"program": os.path.basename(argv[0])})
+    return await asyncio.create_subprocess_exec(*argv, env=env, stdin=stdin, stdout=stdout, stderr=stderr)
+
+
+async def _reap(proc: asyncio.subprocess.Process):
+    if proc.returncode is not None:
+        return
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        pass
+    await proc.wait()
+
+
+async def run(
+    argv: Sequence[str],
+    timeout: Optional[float] = 30.0,
+    env: Optional[Dict[str, str]] = None,
+    log: bool = True,
+) -> ProcessResult:
+    """Runs `argv` to completion, capturing its output.
+
+    The child is killed if `timeout` expires or if the calling task is
+    cancelled, so no process outlives the coroutine that started it.
+    """
+    proc = await spawn(argv, env=env, log=log)
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Timed out after {timeout}s: {list(argv)}")
+        await _reap(proc)
+        return ProcessResult(list(argv), proc.returncode, "", "", timed_out=True)
+    except asyncio.CancelledError:
+        await asyncio.shield(_reap(proc))
+        raise
+    return ProcessResult(
+        list(argv),
+        proc.returncode,
+        stdout.decode(errors="replace") if stdout else "",
+        stderr.decode(errors="replace") if stderr else "",
+    )
+
+
+async def output(argv: Sequence[str], timeout: Optional[float] = 10.0, log: bool = True) -> str:
+    """Returns the stripped stdout of `argv`, or an empty string if it failed to run."""
+    try:
+        result = await run(argv, timeout=timeout, log=log)
+    except OSError:
+        logger.exception(f"Could not run {list(argv)}")
+        return ""
+    return result.stdout.strip()
+
+
+async def stop(proc: asyncio.subprocess.Process, sig=signal.SIGINT, timeout: float = 10.0) -> bool:
+    """Sends `sig` and waits for the process to exit.
+
+    Returns False if it did not exit within `timeout`; the caller decides
+    whether to escalate.
+    """
+    if proc.returncode is not None:
+        return True
+    try:
+        proc.send_signal(sig)
+    except ProcessLookupError:
+        return True
+    try:
+        await asyncio.wait_for(asyncio.shield(proc.wait()), timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
@@ -0,0 +1,200 @@
+import bisect
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+NS_PER_SECOND = 1_000_000_000
+
+
+@dataclass
+class Segment:
+    seq: int
+    path: str
+    # Start on the buffer timeline, in nanoseconds
+    start: int
+    duration: int = 0
+    size: int = 0
+    closed: bool = False
+    # Moved out of the RAM buffer into the disk tier
+    spilled: bool = False
+    # Video keyframes as offsets from `start`. splitmuxsink only splits on a
+    # keyframe, so every fragment has one at 0 even before it is indexed.
+    keyframes: List[int] = field(default_factory=lambda: [0])
+    # time.monotonic() when the fragment was opened
+    opened: float = 0.0
+
+    @property
+    def end(self) -> int:
+        return self.start + self.duration
+
+
+class SegmentIndex:
+    """In-memory index of the rolling buffer fragments, ordered by start time.
+
+    Kept up to date from the splitmuxsink fragment messages so that picking a
+    clip window never has to touch the filesystem.
+    """
+
+    def __init__(self):
+        self._segments: List[Segment] = []
+        self._starts: List[int] = []
+        self._by_path: Dict[str, Segment] = {}
+        # Taken off the timeline by a reset while an export still needed them, by path
+        self._detached: Dict[str, Segment] = {}
+        self._next_seq = 0
+        # Added to the pipeline's running time, which starts over with every pipeline
+        self._offset = 0
+        self._closed_count = 0
+        self._closed_duration = 0
+        self._closed_bytes = 0
+
+    def reset(self, keep: Optional[Callable[[Segment], bool]] = None):
+        """Starts a new timeline. Closed segments `keep` returns True for are
+        detached instead of forgotten: they are no longer part of any clip, but
+        stay current until their file name is reused or they are dropped."""
+        if keep is not None:
+            self._detached.update((s.path, s) for s in self._segments if s.closed and keep(s))
+        self._segments.clear()
+        self._starts.clear()
+        self._by_path.clear()
+        self._offset = 0
+        self._closed_count = 0
+        self._closed_duration = 0
+        self._closed_bytes = 0
+
+    def __len__(self):
+        return len(self._segments)
+
+    def __iter__(self):
+        return iter(list(self._segments))
+
+    def resume(self):
+        """Continues the timeline after the last closed fragment, so a new
+        pipeline's fragments follow the ones recorded before it."""
+        for segment in [s for s in self._segments if not s.closed]:
+            self._remove(segment)
+        last = self.latest_closed()
+        self._offset = last.end if last is not None else 0
+
+    def fragment_opened(self, path: str, running_time: int) -> Segment:
+        running_time += self._offset
+        # splitmuxsink reuses file names once max-files wraps around
+        previous = self._by_path.get(path)
+        if previous is not None:
+            self._remove(previous)
+        self._detached.pop(path, None)
+        segment = Segment(seq=self._next_seq, path=path, start=running_time, opened=time.monotonic())
+        self._next_seq += 1
+        if self._starts and running_time < self._starts[-1]:
+            position = bisect.bisect_right(self._starts, running_time)
+        else:
+            position = len(self._starts)
+        self._segments.insert(position, segment)
+        self._starts.insert(position, running_time)
+        self._by_path[path] = segment
+        return segment
+
+    def fragment_closed(self, path: str, running_time: int) -> Optional[Segment]:
+        segment = self._by_path.get(path)
+        if segment is None or segment.closed:
+            return None
+        segment.duration = max(0, running_time + self._offset - segment.start)
+        try:
+            segment.size = os.stat(path).st_size
+        except OSError:
+            segment.size = 0
+        segment.closed = True
+        self._closed_count += 1
+        self._closed_duration += segment.duration
+        self._closed_bytes += segment.size
+        return segment
+
+    def _remove(self, segment: Segment):
+        position = bisect.bisect_left(self._starts, segment.start)
+        while self._segments[position] is not segment:
+            position += 1
+        del self._segments[position]
+        del self._starts[position]
+        if self._by_path.get(segment.path) is segment:
+            del self._by_path[segment.path]
+        if segment.closed:
+            self._closed_count -= 1
+            self._closed_duration -= segment.duration
+            self._closed_bytes -= segment.size
+
+    def relocate(self, segment: Segment, path: str):
+        """Points `segment` at the copy of its file at `path`."""
+        if self._detached.get(segment.path) is segment:
+            del self._detached[segment.path]
+            segment.path = path
+            self._detached[path] = segment
+            return
+        if self._by_path.get(segment.path) is segment:
+            del self._by_path[segment.path]
+        segment.path = path
+        self._by_path[path] = segment
+
+    def drop(self, segment: Segment):
+        if self._detached.get(segment.path) is segment:
+            del self._detached[segment.path]
+        elif self.contains(segment):
+            self._remove(segment)
+
+    def contains(self, segment: Segment) -> bool:
+        """True while `segment` has not been overwritten or dropped."""
+        return self._by_path.get(segment.path) is segment or self._detached.get(segment.path) is segment
+
+    def is_detached(self, segment: Segment) -> bool:
+        return self._detached.get(segment.path) is segment
+
+    def detached(self) -> List[Segment]:
+        return list(self._detached.values())
+
+    def latest_closed(self) -> Optional[Segment]:
+        for segment in reversed(self._segments):
+            if segment.closed:
+                return segment
+        return None
+
+    def now(self) -> int:
+        """Current position on the buffer timeline, in nanoseconds. Inside the
+        open fragment it is extrapolated from when that fragment was opened."""
+        if not self._segments:
+            return 0
+        last = self._segments[-1]
+        if last.closed:
+            return last.end
+        return last.start + int((time.monotonic() - last.opened) * NS_PER_SECOND)
+
+    def clip(self, seconds: float, end: Optional[int] = None) -> Tuple[List[Segment], int, int]:
+        """Picks the segments for the `seconds` before `end` (default: now).
+
+        The start snaps back to the closest keyframe at or before the requested
+        start, so the clip is at most one GOP longer than asked. The segment
+        holding `end` may still be open. Returns the segments and the start and
+        end on the buffer timeline.
+        """
+        if not self._segments:
+            return [], 0, 0
+        end = self.now() if end is None else end
+        cutoff = max(end - int(seconds * NS_PER_SECOND), self._starts[0])
+        first = max(0, bisect.bisect_right(self._starts, cutoff) - 1)
+        stop = bisect.bisect_left(self._starts, end)
+        segments = self._segments[first:stop]
+        if not segments:
+            return [], 0, 0
+        head = segments[0]
+        offsets = [k for k in head.keyframes if head.start + k <= cutoff]
+        start = head.start + (offsets[-1] if offsets else 0)
+        return segments, start, end
+
+    def status(self) -> dict:
+        return {
+            "segments": self._closed_count,
+            "seconds": self._closed_duration / NS_PER_SECOND,
+            "bytes": self._closed_bytes,
+        }
@@ -0,0 +1,130 @@
+"""Settings kept in memory and written to disk in batches.
+
+Setters only update the cache and mark what changed. Changes made within
+`debounce` seconds of each other are written together, in one atomic
+replace of the JSON file done off the event loop, so dragging a slider costs
+one write rather than one per step.
+"""
+
+import asyncio
+import json
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Optional, Set
+
+from decky_recorder import files
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Setting:
+    # Plugin attribute the value lives in
+    attr: str
+    # Key in the settings file
+    key: str
+    type: type
+    default: Any
+
+    def coerce(self, value):
+        if self.type is bool:
+            if isinstance(value, str):
+                return value.lower() in ("1", "true", "yes", "on")
+            return bool(value)
+        return self.type(value)
+
+
+class SettingsStore:
+    def __init__(self, path: str, schema: Iterable[Setting], debounce: float = 0.5):
+        self.path = path
+        self.schema: Dict[str, Setting] = {s.attr: s for s in schema}
+        self._debounce = debounce
+        # Everything in the file, including keys outside the schema, which are kept as they are
+        self._raw: Dict[str, Any] = {}
+        self._values: Dict[str, Any] = {s.attr: s.default for s in self.schema.values()}
+        self._dirty: Set[str] = set()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self.writes = 0
+
+    def _read(self) -> Dict[str, Any]:
+        try:
+            with open(self.path) as f:
+                raw = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read settings from {self.path}: {e}")
+            return {}
+        return raw if isinstance(raw, dict) else {}
+
+    async def load(self):
+        self._raw = await asyncio.get_event_loop().run_in_executor(None, self._read)
+        for setting in self.schema.values():
+            if setting.key not in self._raw:
+                continue
+            try:
+                self._values[setting.attr] = setting.coerce(self._raw[setting.key])
+            except (TypeError, ValueError):
+                logger.warning(f"Ignoring invalid {setting.key}={self._raw[setting.key]!r}")
+        # Keys missing from the file are written with their defaults
+        self._dirty = {s.attr for s in self.schema.values() if s.key not in self._raw}
+        if self._dirty:
+            self._schedule()
+
+    def get(self, attr: str):
+        return self._values[attr]
+
+    def set(self, attr: str, value) -> bool:
+        """Updates the cached value. Returns True if it changed, which schedules a write."""
+        setting = self.schema[attr]
+        value = setting.coerce(value)
+        if self._values[attr] == value:
+            return False
+        self._values[attr] = value
+        self._dirty.add(attr)
+        self._schedule()
+        return True
+
+    def update(self, values: Dict[str, Any]):
+        for attr, value in values.items():
+            self.set(attr, value)
+
+    @property
+    def dirty(self) -> Set[str]:
+        return set(self._dirty)
+
+    def _schedule(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        loop = asyncio.get_event_loop()
+        self._flush_handle = loop.call_later(self._debounce, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.get_event_loop().create_task(self.flush())
+
+    def _write(self, raw: Dict[str, Any]):
+        files.write_atomic(self.path, json.dumps(raw, indent=4))
+
+    async def flush(self):
+        """Writes pending changes now."""
+        async with self._lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            for attr in dirty:
+                self._raw[self.schema[attr].key] = self._values[attr]
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self._write, dict(self._raw))
+                self.writes += 1
+            except OSError as e:
+                logger.error(f"Could not write settings to {self.path}: {e}")
+                self._dirty |= dirty
+
+    async def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        await self.flush()
@@ -0,0 +1,128 @@
+"""Suspend and resume notifications from logind.
+
+logind broadcasts PrepareForSleep(true) before the system suspends and
+PrepareForSleep(false) after it resumes. `gdbus monitor` relays the signals,
+the same way `pactl subscribe` relays audio server events, and a delay
+inhibitor lock held through `systemd-inhibit` gives the plugin time to finish
+the fragment in progress before the system actually sleeps.
+"""
+
+import asyncio
+import logging
+import re
+import shutil
+import time
+from typing import Awaitable, Callable, Optional
+
+from decky_recorder import process
+
+logger = logging.getLogger(__name__)
+
+# /org/freedesktop/login1: org.freedesktop.login1.Manager.PrepareForSleep (true,)
+_PREPARE_RE = re.compile(r"\.PrepareForSleep \((?P<start>true|false),?\)")
+
+Callback = Callable[[], Awaitable[None]]
+
+
+class SleepMonitor:
+    def __init__(self, on_suspend: Callback, on_resume: Callback, bus_address: Optional[str] = None):
+        self._on_suspend = on_suspend
+        self._on_resume = on_resume
+        # A private bus to listen on instead of the system bus
+        self._bus_address = bus_address
+        self._monitor: Optional[asyncio.subprocess.Process] = None
+        self._inhibitor: Optional[asyncio.subprocess.Process] = None
+        self._task: Optional[asyncio.Task] = None
+        self.suspended_at: Optional[float] = None
+        self.resumed_at: Optional[float] = None
+        self.suspends = 0
+        # How long the last on_suspend held up the suspend, in seconds
+        self.suspend_seconds: Optional[float] = None
+
+    @property
+    def active(self) -> bool:
+        return self._monitor is not None and self._monitor.returncode is None
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self._monitor.pid if self._monitor is not None else None
+
+    async def start(self) -> bool:
+        if not shutil.which("gdbus"):
+            logger.info("gdbus not found, suspend is detected from the wakeup count instead")
+            return False
+        bus = ["--address", self._bus_address] if self._bus_address else ["--system"]
+        argv = [
+            "gdbus",
+            "monitor",
+            *bus,
+            "--dest",
+            "org.freedesktop.login1",
+            "--object-path",
+            "/org/freedesktop/login1",
+        ]
+        try:
+            self._monitor = await process.spawn(argv, stderr=process.DEVNULL)
+        except OSError as e:
+            logger.warning(f"Could not monitor logind: {e}")
+            return False
+        await self._inhibit()
+        self._task = asyncio.get_event_loop().create_task(self._read())
+        return True
+
+    async def _read(self):
+        async for line in self._monitor.stdout:
+            match = _PREPARE_RE.search(line.decode(errors="replace"))
+            if match is None:
+                continue
+            try:
+                if match.group("start") == "true":
+                    self.suspended_at = time.monotonic()
+                    self.suspend_seconds = None
+                    logger.info("System is going to sleep")
+                    await self._on_suspend()
+                    await self._release()
+                    self.suspend_seconds = time.monotonic() - self.suspended_at
+                    self.suspends += 1
+                else:
+                    self.resumed_at = time.monotonic()
+                    logger.info("System resumed")
+                    await self._inhibit()
+                    await self._on_resume()
+            except Exception:
+                logger.exception("Sleep handler failed")
+        logger.warning("logind monitor exited")
+
+    async def _inhibit(self):
+        """Takes a delay lock, so logind waits for `on_suspend` before sleeping."""
+        if self._inhibitor is not None or not shutil.which("systemd-inhibit"):
+            return
+        argv = [
+            "systemd-inhibit",
+            "--what=sleep",
+            "--mode=delay",
+            "--who=Decky Recorder",
+            "--why=Finishing the replay buffer",
+            "sleep",
+            "infinity",
+        ]
+        try:
+            self._inhibitor = await process.spawn(argv, stdout=process.DEVNULL, stderr=process.DEVNULL, log=False)
+        except OSError as e:
+            logger.warning(f"Could not take a sleep inhibitor lock: {e}")
+
+    async def _release(self):
+        inhibitor, self._inhibitor = self._inhibitor, None
+        if inhibitor is not None and inhibitor.returncode is None:
+            inhibitor.terminate()
+            await inhibitor.wait()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._monitor is not None and self._monitor.returncode is None:
+            self._monitor.kill()
+            await self._monitor.wait()
+        self._monitor = None
+        await self._release()
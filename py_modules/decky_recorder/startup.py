@@ -0,0 +1,108 @@
+"""Waits for what a capture needs instead of sleeping for a fixed time.
+
+After a boot or plugin reload the audio server and gamescope's PipeWire
+screencast node come up in no particular order. Each probe is retried with
+exponential backoff until all pass or a deadline expires, and the sequencer
+records how long that took.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional
+
+from decky_recorder import process
+
+logger = logging.getLogger(__name__)
+
+Probe = Callable[[], Awaitable[bool]]
+
+PIPEWIRE_SOCKET = "pipewire-0"
+
+
+async def pipewire_video_source(runtime_dir: str) -> bool:
+    """True once PipeWire is up and, where pw-dump exists to tell, some node
+    offers video, which on the Deck is gamescope's screencast."""
+    if not os.path.exists(os.path.join(runtime_dir, PIPEWIRE_SOCKET)):
+        return False
+    if not shutil.which("pw-dump"):
+        return True
+    env = process.make_env({"XDG_RUNTIME_DIR": runtime_dir})
+    result = await process.run(["pw-dump", "Node"], timeout=5, env=env, log=False)
+    if not result.ok:
+        return False
+    try:
+        nodes = json.loads(result.stdout)
+    except ValueError:
+        return False
+    return any(((node.get("info") or {}).get("props") or {}).get("media.class") == "Video/Source" for node in nodes)
+
+
+@dataclass
+class StartupReport:
+    ready: bool = False
+    # Seconds since the sequencer started
+    ready_after: Optional[float] = None
+    first_segment_after: Optional[float] = None
+    attempts: Dict[str, int] = field(default_factory=dict)
+    waiting_on: Optional[str] = None
+
+    def as_dict(self) -> dict:
+        return {
+            "ready": self.ready,
+            "ready_after": self.ready_after,
+            "first_segment_after": self.first_segment_after,
+            "attempts": dict(self.attempts),
+            "waiting_on": self.waiting_on,
+        }
+
+
+class StartupSequencer:
+    def __init__(self, initial_delay: float = 0.1, max_delay: float = 2.0, deadline: float = 30.0):
+        self._initial_delay = initial_delay
+        self._max_delay = max_delay
+        self._deadline = deadline
+        self._started = time.monotonic()
+        self.report = StartupReport()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self._started
+
+    async def _wait_for(self, name: str, probe: Probe, deadline: float) -> bool:
+        delay = self._initial_delay
+        while True:
+            self.report.attempts[name] = self.report.attempts.get(name, 0) + 1
+            try:
+                if await probe():
+                    return True
+            except Exception as e:
+                logger.debug(f"Startup probe {name} failed: {e!r}")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, self._max_delay)
+
+    async def wait_ready(self, probes: Dict[str, Probe]) -> bool:
+        """Runs the probes in order, each retried until it passes. Returns False
+        if the deadline ran out; the caller starts anyway, as before."""
+        deadline = self._started + self._deadline
+        for name, probe in probes.items():
+            self.report.waiting_on = name
+            if not await self._wait_for(name, probe, deadline):
+                logger.warning(f"Gave up waiting for {name} after {self.elapsed():.1f}s")
+                return False
+        self.report.waiting_on = None
+        self.report.ready = True
+        self.report.ready_after = self.elapsed()
+        logger.info(f"Ready to capture after {self.report.ready_after:.2f}s ({self.report.attempts})")
+        return True
+
+    def first_segment(self):
+        if self.report.first_segment_after is None:
+            self.report.first_segment_after = self.elapsed()
+            logger.info(f"First replay buffer segment {self.report.first_segment_after:.2f}s after load")
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+WAKEUP_COUNT_PATH = "/sys/power/wakeup_count"
+
+
+def read_sysfs_int(path: str, default: int = 0) -> int:
+    try:
+        with open(path, "rb") as f:
+            return int(f.read().strip() or default)
+    except (OSError, ValueError):
+        return default
+
+
+def find_process(needle: str) -> Optional[int]:
+    """Full process table scan, only used until the process has been found once."""
+    import psutil
+
+    for child in psutil.process_iter(["cmdline"]):
+        try:
+            if needle in " ".join(child.info["cmdline"] or ()):
+                return child.pid
+        except psutil.NoSuchProcess:
+            pass
+    return None
+
+
+class PidWatch:
+    """Calls `on_exit` once when `pid` exits.
+
+    Uses a pidfd registered with the event loop where the kernel supports it,
+    otherwise `alive()` falls back to a cheap existence check.
+    """
+
+    def __init__(self, pid: int, on_exit: Callable[[], None]):
+        self.pid = pid
+        self._on_exit = on_exit
+        self._fd: Optional[int] = None
+        self._exited = False
+        try:
+            self._fd = os.pidfd_open(pid)
+            asyncio.get_event_loop().add_reader(self._fd, self._handle_exit)
+        except (AttributeError, OSError):
+            self._fd = None
+
+    def _handle_exit(self):
+        self._exited = True
+        self.close()
+        self._on_exit()
+
+    @property
+    def watching(self) -> bool:
+        """True while the exit is reported by the event loop, not only noticed by `alive()`."""
+        return self._fd is not None
+
+    def alive(self) -> bool:
+        if self._exited:
+            return False
+        if self._fd is None:
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                self._exited = True
+                self._on_exit()
+                return False
+            except PermissionError:
+                pass
+        return True
+
+    def close(self):
+        if self._fd is not None:
+            asyncio.get_event_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+
+class SessionTracker:
+    """Tracks the gamescope session by PID once it has been found.
+
+    While no session is known the process table is rescanned at most every
+    `rescan_interval` seconds, which is the only expensive operation here.
+    """
+
+    def __init__(self, needle: str = "gamescope-session", on_change: Callable[[], None] = None, rescan_interval=10.0):
+        self._needle = needle
+        self._on_change = on_change or (lambda: None)
+        self._rescan_interval = rescan_interval
+        self._watch: Optional[PidWatch] = None
+        self._last_scan = 0.0
+        self._exited: Optional[asyncio.Event] = None
+
+    def _lost(self):
+        logger.info(f"{self._needle} exited")
+        self._watch = None
+        self._last_scan = 0.0
+        self._on_change()
+        if self._exited is not None:
+            self._exited.set()
+            self._exited = None
+
+    async def wait_change(self):
+        """Returns when `active()` may give a different answer: as soon as the
+        tracked process exits, or after `rescan_interval` when nothing is
+        tracked or the exit can only be noticed by polling."""
+        if self._exited is None:
+            self._exited = asyncio.Event()
+        exited = self._exited
+        if self._watch is not None and self._watch.watching:
+            await exited.wait()
+            return
+        try:
+            await asyncio.wait_for(exited.wait(), self._rescan_interval)
+        except asyncio.TimeoutError:
+            pass
+
+    def active(self) -> bool:
+        if self._watch is not None and self._watch.alive():
+            return True
+        now = time.monotonic()
+        if now - self._last_scan < self._rescan_interval:
+            return False
+        self._last_scan = now
+        pid = find_process(self._needle)
+        if pid is None:
+            return False
+        logger.info(f"Tracking {self._needle} at pid {pid}")
+        self._watch = PidWatch(pid, self._lost)
+        return self._watch.alive()
+
+    def close(self):
+        if self._watch is not None:
+            self._watch.close()
+            self._watch = None
+
+
+class TickStats:
+    """Per-tick CPU and wall time of a periodic loop."""
+
+    def __init__(self):
+        self.ticks = 0
+        self.cpu_total = 0.0
+        self.cpu_max = 0.0
+        self.wall_total = 0.0
+        self._cpu_start = 0.0
+        self._wall_start = 0.0
+
+    def __enter__(self):
+        self._cpu_start = time.thread_time()
+        self._wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        cpu = time.thread_time() - self._cpu_start
+        self.ticks += 1
+        self.cpu_total += cpu
+        self.cpu_max = max(self.cpu_max, cpu)
+        self.wall_total += time.perf_counter() - self._wall_start
+        return False
+
+    def as_dict(self) -> dict:
+        ticks = max(self.ticks, 1)
+        return {
+            "ticks": self.ticks,
+            "cpu_avg_us": self.cpu_total / ticks * 1e6,
+            "cpu_max_us": self.cpu_max * 1e6,
+            "wall_avg_us": self.wall_total / ticks * 1e6,
+        }
@@ -44,11 +44,12 @@ class DeckyRecorderLogic
 
 	saveRollingRecording = async  (duration: number) => {
 		const res = await this.serverAPI.callPluginMethod('save_rolling_recording', { clip_duration: duration, app_name: Router.MainRunningApp?.display_name});
-		let r = (res.result as number)
-		if (r > 0) {
-			await this.notify("Saved clip");
+		// An export job was queued, or a status code
+		let r = (res.result as { job: number, duration: number } | number)
+		if (typeof r === "object" && r !== null) {
+			await this.notify(`Saving ${Math.round(r.duration)}s clip`);
 		} else if (r == 0) {
-			await this.notify("Too early to record another clip");
+			await this.notify("Too early to save a clip");
 		} else if (r == -1) {
 			await this.notify("Enabling replay mode", 1500, "Steam + Start to save last 30 seconds");
 		} else {
@@ -134,11 +135,14 @@ const DeckyRecorder: VFC<{ serverAPI: ServerAPI, logic: DeckyRecorderLogic }> =
 	// const [mode, setMode] = useState<string>("localFile");
 
 	const [isRolling, setRolling] = useState<boolean>(false);
+	const [isManualRecording, setManualRecording] = useState<boolean>(false);
 	const [microphoneEnabled, setMicrophone] = useState<boolean>(false);
 
 	const [buttonsEnabled, setButtonsEnabled] = useState<boolean>(true);
 
 	const [micGain, setMicGain] = useState<number>(10);
+	const [separateAudioTracks, setSeparateAudioTracks] = useState<boolean>(false);
+	const [chunkedRecording, setChunkedRecording] = useState<boolean>(false);
 	const [isEnhancedNoiseCancellation, setEnhancedNoiseCancellation] = useState<boolean>(false);
 	const [noiseReductionPercent, setNoiseReductionPercent] = useState<number>(50);
 
@@ -169,12 +173,21 @@ const DeckyRecorder: VFC<{ serverAPI: ServerAPI, logic: DeckyRecorderLogic }> =
 		const getIsRollingResponse = await serverAPI.callPluginMethod('is_rolling', {});
 		setRolling(getIsRollingResponse.result as boolean);
 
+		const getIsManualRecordingResponse = await serverAPI.callPluginMethod('is_manual_recording', {});
+		setManualRecording(getIsManualRecordingResponse.result as boolean);
+
 		const getMicEnabled = await serverAPI.callPluginMethod('is_mic_enabled', {});
 		setMicrophone(getMicEnabled.result as boolean);
 
 		const getMicGain = await serverAPI.callPluginMethod('get_mic_gain', {});
 		setMicGain(getMicGain.result as number);
 
+		const getSeparateAudioTracks = await serverAPI.callPluginMethod('get_separate_audio_tracks', {});
+		setSeparateAudioTracks(getSeparateAudioTracks.result as boolean);
+
+		const getChunkedRecording = await serverAPI.callPluginMethod('get_chunked_recording', {});
+		setChunkedRecording((getChunkedRecording.result as { enabled: boolean }).enabled);
+
 		const getEnhancedNoiseCancellation = await serverAPI.callPluginMethod('enhanced_noise_binary_exists', {});
 		setEnhancedNoiseCancellation(getEnhancedNoiseCancellation.result as boolean);
 
@@ -243,6 +256,18 @@ const DeckyRecorder: VFC<{ serverAPI: ServerAPI, logic: DeckyRecorderLogic }> =
 		}
 	}
 
+	// In replay mode the recording is cut from the running buffer, which keeps going
+	const manualRecordingButtonPress = async () => {
+		if (isManualRecording === false) {
+			setManualRecording(true);
+			await serverAPI.callPluginMethod('start_manual_recording', {app_name: Router.MainRunningApp?.display_name});
+			Router.CloseSideMenus();
+		} else {
+			setManualRecording(false);
+			await serverAPI.callPluginMethod('stop_manual_recording', {});
+		}
+	}
+
 	const pickFolder = async () => {
 		const filePickerResponse = await serverAPI.openFilePicker(localFilePath, false);
 		setLocalFilePath(filePickerResponse.path)
@@ -335,6 +360,15 @@ const DeckyRecorder: VFC<{ serverAPI: ServerAPI, logic: DeckyRecorderLogic }> =
 				{
 					(microphoneEnabled) ?
 					<div>
+						<ToggleField
+							label="Separate Microphone Track"
+							checked={separateAudioTracks}
+							onChange={(e) => {
+								setSeparateAudioTracks(e);
+								serverAPI.callPluginMethod('set_separate_audio_tracks', { separate: e });
+							}}
+						/>
+						<div>Record game audio and microphone as two audio tracks instead of one mix</div>
 						<SliderField
 							label="Microphone Gain (default 10db)"
 							value={micGain}
@@ -420,6 +454,23 @@ const DeckyRecorder: VFC<{ serverAPI: ServerAPI, logic: DeckyRecorderLogic }> =
 				/>
 			</PanelSectionRow>
 
+			{(!isRolling)
+				? <PanelSectionRow>
+					<ToggleField
+						label="Crash-Safe Long Recordings"
+						checked={chunkedRecording}
+						disabled={isCapturing}
+						onChange={(e) => {
+							setChunkedRecording(e);
+							serverAPI.callPluginMethod('set_chunked_recording', { enabled: e });
+						}}
+					/>
+					<div>Record in chunks that are joined on stop, so a crash or kill loses at most the last one</div>
+				</PanelSectionRow> : null}
+
+			{(isRolling)
+				? <PanelSectionRow><ButtonItem disabled={!isCapturing} onClick={() => { manualRecordingButtonPress() }}>{isManualRecording ? "Stop Recording" : "Start Recording"}</ButtonItem></PanelSectionRow> : null}
+
 			{(isRolling)
 				? <PanelSectionRow><ButtonItem disabled={!shouldButtonsBeEnabled()} onClick={() => { rollingRecordButtonPress(30) }}>30 sec</ButtonItem></PanelSectionRow> : null}
 
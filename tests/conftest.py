@@ -0,0 +1,82 @@
+import importlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKES = os.path.join(ROOT, "benchmarks", "fakes")
+
+# The backend modules are loaded from py_modules, as Decky does for the plugin
+sys.path.insert(0, os.path.join(ROOT, "py_modules"))
+
+
+@pytest.fixture
+def fakes(tmp_path, monkeypatch):
+    """Puts the stand-in tools of the benchmarks first on PATH, with their state in `tmp_path`."""
+    monkeypatch.setenv("PATH", FAKES + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_PACTL_STATE", str(tmp_path / "pactl.json"))
+    return FAKES
+
+
+@pytest.fixture
+def load_plugin(fakes, tmp_path, monkeypatch):
+    """Imports a fresh `main` the way Decky does, with a stand-in `decky_plugin`
+    and every folder under `tmp_path`.
+
+    Called with the saved settings to start from; returns the module and
+    `main.Plugin`, which Decky passes to its methods as `self`.
+    """
+    loaded = []
+
+    def load(settings: dict = None):
+        home = str(tmp_path / "home")
+        dirs = {name: os.path.join(home, name) for name in ("settings", "logs", "runtime", "Videos", "buffer")}
+        for path in dirs.values():
+            os.makedirs(path, exist_ok=True)
+        with open(os.path.join(dirs["settings"], "decky-loader-settings.json"), "w") as f:
+            json.dump({"output_folder": dirs["Videos"], **(settings or {})}, f)
+        open(os.path.join(dirs["runtime"], "pipewire-0"), "w").close()
+
+        decky_plugin = types.ModuleType("decky_plugin")
+        decky_plugin.HOME = home
+        decky_plugin.DECKY_HOME = home
+        decky_plugin.DECKY_PLUGIN_DIR = ROOT
+        decky_plugin.DECKY_PLUGIN_SETTINGS_DIR = dirs["settings"]
+        decky_plugin.DECKY_PLUGIN_RUNTIME_DIR = dirs["runtime"]
+        decky_plugin.DECKY_PLUGIN_LOG_DIR = dirs["logs"]
+        decky_plugin.logger = logging.getLogger("decky-recorder-test")
+        monkeypatch.setitem(sys.modules, "decky_plugin", decky_plugin)
+        # Keeps the audio server on the pactl path, which the fake answers
+        monkeypatch.setitem(sys.modules, "pulsectl", None)
+        monkeypatch.setenv("DECKY_PLUGIN_SETTINGS_DIR", dirs["settings"])
+        # start_capturing sets these for the pipeline in the plugin's own environment
+        for name in ("XDG_RUNTIME_DIR", "XDG_SESSION_TYPE", "HOME"):
+            monkeypatch.delenv(name, raising=False)
+        # main.py replaces sys.path on import, this puts it back afterwards
+        monkeypatch.syspath_prepend(ROOT)
+        monkeypatch.delitem(sys.modules, "main", raising=False)
+        main = importlib.import_module("main")
+        loaded.append(main)
+        plugin = main.Plugin
+        plugin._rollingRecordingFolder = dirs["buffer"]
+        plugin._runtimeDir = dirs["runtime"]
+        return main, plugin
+
+    yield load
+    for main in loaded:
+        main.package_logger.removeHandler(main.log_file_handler)
+        main.log_file_handler.close()
+
+
+@pytest.fixture
+def game_mode(fakes):
+    """Runs the fake gamescope-session, so the watchdog sees game mode."""
+    session = subprocess.Popen([os.path.join(FAKES, "gamescope-session")])
+    yield session
+    session.kill()
+    session.wait()
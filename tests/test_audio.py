@@ -0,0 +1,89 @@
+import asyncio
+import functools
+import sys
+import threading
+import types
+
+from decky_recorder.audio import AudioServer, PactlBackend
+from decky_recorder.startup import StartupSequencer
+
+
+class FakePulse:
+    """pulsectl.Pulse whose event connection is refused, so the probe fails halfway."""
+
+    opened = []
+
+    def __init__(self, client_name):
+        if client_name.endswith("-events"):
+            raise RuntimeError("connection refused")
+        self.closed = False
+        FakePulse.opened.append(self)
+
+    def close(self):
+        self.closed = True
+
+
+def pulse_threads():
+    return [t for t in threading.enumerate() if t.name.startswith("pulse")]
+
+
+def test_failed_pulsectl_probe_is_closed_and_pactl_is_used(fakes, monkeypatch):
+    monkeypatch.setitem(sys.modules, "pulsectl", types.SimpleNamespace(Pulse=FakePulse))
+    FakePulse.opened.clear()
+
+    async def scenario():
+        server = AudioServer()
+        await server.connect()
+        backend = server._backend
+        sinks = await server.sink_names()
+        await server.close()
+        for _ in range(100):
+            if not pulse_threads():
+                break
+            await asyncio.sleep(0.01)
+        return backend, sinks
+
+    backend, sinks = asyncio.run(scenario())
+    assert isinstance(backend, PactlBackend)
+    assert sinks == ["alsa_output.pci-0000_04_00.5-platform-acp5x_mach.0.HiFi__hw_acp5x_1__sink"]
+    assert [pulse.closed for pulse in FakePulse.opened] == [True]
+    assert pulse_threads() == []
+
+
+def test_close_ends_the_pactl_subscription(fakes):
+    async def scenario():
+        server = AudioServer()
+        await server.connect()
+        subscriber = server._backend._subscriber
+        index = await server.load_module("module-null-sink", ["sink_name=Decky-Recording-Sink"])
+        assert "Decky-Recording-Sink" in await server.sink_names()
+        await server.unload_module(index)
+        await server.close()
+        return subscriber, server.connected
+
+    subscriber, connected = asyncio.run(scenario())
+    assert subscriber.returncode is not None
+    assert not connected
+
+
+def test_audio_server_connects_on_first_use_when_the_startup_probe_timed_out(load_plugin, game_mode, monkeypatch):
+    main, plugin = load_plugin()
+    monkeypatch.setattr(main.startup, "StartupSequencer", functools.partial(StartupSequencer, deadline=0.5))
+    # Not up for the whole startup probe
+    monkeypatch.setenv("FAKE_PACTL_DOWN", "1")
+
+    async def scenario():
+        await plugin._main(plugin)
+        connected_at_startup = plugin._audio.connected
+        monkeypatch.delenv("FAKE_PACTL_DOWN")
+        await plugin.start_capturing(plugin, "game")
+        capturing = await plugin.is_capturing(plugin)
+        sinks = await plugin._audio.sink_names()
+        await plugin.stop_capturing(plugin)
+        await plugin._unload(plugin)
+        return connected_at_startup, capturing, sinks
+
+    connected_at_startup, capturing, sinks = asyncio.run(scenario())
+    assert not connected_at_startup
+    assert capturing
+    assert "Decky-Recording-Sink" in sinks
@@ -0,0 +1,106 @@
+import asyncio
+
+from decky_recorder.audio import Module
+from decky_recorder.audio_graph import AudioGraph, AudioGraphReconciler, recording_graph
+
+MARKERS = ("Decky-Recording-Sink", "Echo-Cancelled-Mic", "Echo-Cancelled-Audio")
+DEFAULT_SINK = "alsa_output.pci-0000_04_00.5-platform-acp5x_mach.0.HiFi__hw_acp5x_1__sink"
+PLUGIN = "/home/deck/homebrew/data/decky-recorder/librnnoise_ladspa.so"
+
+
+class FakeAudioServer:
+    """Records the calls the reconciler makes, with a module list that follows them."""
+
+    def __init__(self):
+        self.loaded = {}
+        self.calls = []
+        self._next = 100
+
+    async def modules(self):
+        return [Module(index, name, " ".join(args)) for index, (name, args) in self.loaded.items()]
+
+    async def load_module(self, name, args):
+        index = self._next
+        self._next += 1
+        self.loaded[index] = (name, tuple(args))
+        self.calls.append(("load", name, tuple(args)))
+        return index
+
+    async def unload_module(self, index):
+        name, _ = self.loaded.pop(index)
+        self.calls.append(("unload", name, index))
+
+    async def set_source_volume_db(self, source, db):
+        self.calls.append(("volume", source, db))
+
+
+def mic_graph(percent: int) -> AudioGraph:
+    return recording_graph(
+        "Decky-Recording-Sink",
+        DEFAULT_SINK,
+        mic_enabled=True,
+        mic_source="alsa_input.pci-0000_04_00.6.HiFi__hw_acp6x__source",
+        mic_gain=13.0,
+        denoise_plugin=PLUGIN,
+        noise_reduction_percent=percent,
+    )
+
+
+def test_noise_reduction_change_only_reloads_the_ladspa_chain():
+    async def scenario():
+        server = FakeAudioServer()
+        reconciler = AudioGraphReconciler(server, MARKERS)
+        await reconciler.apply(mic_graph(50))
+        first = list(server.calls)
+        server.calls.clear()
+        result = await reconciler.apply(mic_graph(80))
+        return first, server.calls, result
+
+    first, calls, result = asyncio.run(scenario())
+    assert [call[:2] for call in first] == [
+        ("load", "module-null-sink"),
+        ("load", "module-loopback"),
+        ("load", "module-null-sink"),
+        ("load", "module-ladspa-sink"),
+        ("load", "module-loopback"),
+        ("load", "module-loopback"),
+        ("volume", "Echo-Cancelled-Mic.monitor"),
+    ]
+    # The mic input loopback feeds the LADSPA sink, so it goes and comes back with it
+    mic_input = (
+        "source=alsa_input.pci-0000_04_00.6.HiFi__hw_acp6x__source",
+        "sink=Echo-Cancelled-Mic_raw_in",
+        "channels=1",
+        "source_dont_move=true",
+        "sink_dont_move=true",
+    )
+    assert calls == [
+        ("unload", "module-loopback", 104),
+        ("unload", "module-ladspa-sink", 103),
+        (
+            "load",
+            "module-ladspa-sink",
+            (
+                "sink_name=Echo-Cancelled-Mic_raw_in",
+                "sink_master=Echo-Cancelled-Mic",
+                "label=noise_suppressor_mono",
+                f"plugin={PLUGIN}",
+                "control=80,20,0,0,0",
+            ),
+        ),
+        ("load", "module-loopback", mic_input),
+    ]
+    assert result.loaded == ["mic-denoise", "mic-input"] and result.unloaded == [104, 103]
+
+
+def test_unchanged_graph_makes_no_calls():
+    async def scenario():
+        server = FakeAudioServer()
+        reconciler = AudioGraphReconciler(server, MARKERS)
+        await reconciler.apply(mic_graph(50))
+        server.calls.clear()
+        result = await reconciler.apply(mic_graph(50))
+        return server.calls, result
+
+    calls, result = asyncio.run(scenario())
+    assert calls == [] and not result.changed
@@ -0,0 +1,94 @@
+import asyncio
+import os
+
+from decky_recorder.buffer import BufferManager
+from decky_recorder.exports import DONE, ExportQueue
+from decky_recorder.segment_index import NS_PER_SECOND, SegmentIndex
+
+PREFIX = "Decky-Recorder-Rolling"
+
+
+def record(index: SegmentIndex, folder: str, count: int, first: int = 0):
+    for n in range(first, first + count):
+        path = os.path.join(folder, f"{PREFIX}_{n:05d}.mkv")
+        with open(path, "wb") as f:
+            f.write(b"\0" * 1024)
+        index.fragment_opened(path, (n - first) * NS_PER_SECOND)
+        index.fragment_closed(path, (n - first + 1) * NS_PER_SECOND)
+
+
+def test_restart_keeps_fragments_of_a_queued_export(tmp_path):
+    async def scenario():
+        index = SegmentIndex()
+        queue = None
+        buffer = BufferManager(index, str(tmp_path), PREFIX, in_use=lambda path: queue.in_use(path))
+        exported = []
+        release = asyncio.Event()
+
+        async def exporter(job, work_dir):
+            await release.wait()
+            exported.extend(os.path.exists(s.path) for s in job.segments)
+
+        queue = ExportQueue(str(tmp_path), exporter, is_current=index.contains)
+        queue.on_finished(lambda job: buffer.release(job.segments))
+        queue.start()
+        buffer.begin()
+        record(index, str(tmp_path), 5)
+        segments, start, end = index.clip(5)
+        job = queue.submit(segments, str(tmp_path / "clip.mkv"), 5, start, end)
+        await asyncio.sleep(0)
+
+        # The pipeline restarts while the save is still waiting
+        buffer.begin()
+        assert len(index) == 0
+        # Its file names come after the ones the export holds
+        assert buffer.next_file_index() == 5
+        record(index, str(tmp_path), 2, first=buffer.next_file_index())
+        release.set()
+        while job.state != DONE:
+            assert job.state in ("queued", "running"), job.error
+            await asyncio.sleep(0.01)
+        await queue.close()
+        return job, exported, segments
+
+    job, exported, segments = asyncio.run(scenario())
+    assert len(job.segments) == 5
+    assert exported == [True] * 5
+    # Released once the export is done, the fragments of the new pipeline stay
+    assert not any(os.path.exists(s.path) for s in segments)
+    assert sorted(os.listdir(tmp_path)) == [f"{PREFIX}_00005.mkv", f"{PREFIX}_00006.mkv"]
+
+
+def test_reused_file_name_makes_a_detached_fragment_stale(tmp_path):
+    index = SegmentIndex()
+    record(index, str(tmp_path), 3)
+    held = list(index)[0]
+    index.reset(keep=lambda segment: segment is held)
+    assert index.contains(held) and index.is_detached(held)
+    index.fragment_opened(held.path, 0)
+    assert not index.contains(held)
+
+
+def test_discard_clears_both_tiers_but_keeps_what_an_export_holds(tmp_path):
+    ram, disk = tmp_path / "ram", tmp_path / "disk"
+    ram.mkdir()
+    index = SegmentIndex()
+    held = set()
+    buffer = BufferManager(
+        index, str(ram), PREFIX, disk_folder=str(disk), ram_budget=0, disk_reserve=0, in_use=held.__contains__
+    )
+    buffer.begin()
+    record(index, str(ram), 6)
+    asyncio.run(buffer.enforce())
+    spilled = [s for s in index if s.spilled]
+    assert spilled and all(os.path.dirname(s.path) == str(disk) for s in spilled)
+    held.add(spilled[0].path)
+
+    buffer.discard()
+
+    assert len(index) == 0
+    assert os.listdir(str(ram)) == []
+    assert os.listdir(str(disk)) == [os.path.basename(spilled[0].path)]
+    held.clear()
+    buffer.release([spilled[0]])
+    assert os.listdir(str(disk)) == []
@@ -0,0 +1,128 @@
+import asyncio
+import os
+import time
+
+from decky_recorder import catalog
+from decky_recorder.catalog import ClipCatalog
+from test_matroska import FRAGMENT_MS, h264_fragment
+
+DAY = 86400
+
+
+def clip(folder, name: str, days_old: float = 0) -> str:
+    path = os.path.join(str(folder), name)
+    h264_fragment(path)
+    created = time.time() - days_old * DAY
+    os.utime(path, (created, created))
+    return path
+
+
+async def open_catalog(tmp_path) -> ClipCatalog:
+    clips = ClipCatalog(str(tmp_path / "settings" / "clips.sqlite3"), str(tmp_path / "settings" / "thumbnails"))
+    assert await clips.open()
+    return clips
+
+
+def paths(listing: dict):
+    return sorted(c["name"] for c in listing["clips"])
+
+
+def test_reconcile_only_probes_new_and_changed_files(fakes, tmp_path):
+    videos = tmp_path / "Videos"
+    videos.mkdir()
+    for n in range(3):
+        clip(videos, f"Hades-30.0s-2026-10-0{n + 1}_12-00-00.mkv")
+
+    async def scenario():
+        clips = await open_catalog(tmp_path)
+        try:
+            cold = await clips.reconcile(str(videos))
+            warm = await clips.reconcile(str(videos))
+
+            # Renamed: same inode, mtime and size, so its row and metadata are kept
+            os.rename(videos / "Hades-30.0s-2026-10-01_12-00-00.mkv", videos / "Celeste_2026-10-01_12-00-00.mkv")
+            # Rewritten in place: a new mtime and size
+            changed = str(videos / "Hades-30.0s-2026-10-02_12-00-00.mkv")
+            with open(changed, "ab") as f:
+                f.write(b"\0" * 16)
+            # Written before the delete, so it cannot reuse the deleted file's inode
+            clip(videos, "Hades_2026-10-04_12-00-00.mkv")
+            os.remove(videos / "Hades-30.0s-2026-10-03_12-00-00.mkv")
+            after = await clips.reconcile(str(videos))
+            return cold, warm, after, await clips.list_clips()
+        finally:
+            await clips.close()
+
+    cold, warm, after, listing = asyncio.run(scenario())
+    assert (cold["probed"], cold["unchanged"]) == (3, 0)
+    assert (warm["probed"], warm["unchanged"]) == (0, 3)
+    assert (after["renamed"], after["removed"], after["probed"], after["unchanged"]) == (1, 1, 2, 0)
+    assert paths(listing) == [
+        "Celeste_2026-10-01_12-00-00.mkv",
+        "Hades-30.0s-2026-10-02_12-00-00.mkv",
+        "Hades_2026-10-04_12-00-00.mkv",
+    ]
+    renamed = next(c for c in listing["clips"] if c["name"].startswith("Celeste"))
+    assert renamed["app_name"] == "Celeste"
+    assert renamed["duration"] == FRAGMENT_MS / 1000
+
+
+def test_prune_by_age_and_size_with_a_dry_run_first(fakes, tmp_path):
+    videos = tmp_path / "Videos"
+    videos.mkdir()
+    # Oldest first
+    made = [clip(videos, f"Hades_2026-10-0{n + 1}_12-00-00.mkv", days_old=10 - 2 * n) for n in range(5)]
+    size = os.path.getsize(made[0])
+
+    async def scenario():
+        clips = await open_catalog(tmp_path)
+        try:
+            await clips.reconcile(str(videos))
+            plan = await clips.prune(max_bytes=2 * size, dry_run=True)
+            kept_after_plan = (await clips.list_clips())["total"], all(os.path.exists(p) for p in made)
+            by_age = await clips.prune(max_age_days=7)
+            by_size = await clips.prune(max_bytes=2 * size)
+            return plan, kept_after_plan, by_age, by_size, await clips.list_clips()
+        finally:
+            await clips.close()
+
+    plan, kept_after_plan, by_age, by_size, listing = asyncio.run(scenario())
+    assert plan["removed"] == made[:3] and plan["bytes_freed"] == 3 * size and plan["dry_run"]
+    assert kept_after_plan == (5, True)
+    # 10 and 8 days old
+    assert by_age["removed"] == made[:2] and by_age["bytes_remaining"] == 3 * size
+    assert by_size["removed"] == made[2:3] and by_size["bytes_remaining"] == 2 * size
+    assert [os.path.exists(p) for p in made] == [False, False, False, True, True]
+    assert listing["total"] == 2
+
+
+def test_prune_keeps_clips_it_could_not_delete(fakes, tmp_path, monkeypatch):
+    videos = tmp_path / "Videos"
+    videos.mkdir()
+    made = [clip(videos, f"Hades_2026-10-0{n + 1}_12-00-00.mkv", days_old=5 - n) for n in range(4)]
+    size = os.path.getsize(made[0])
+    remove = os.remove
+
+    def stuck_remove(path):
+        if path == made[0]:
+            raise PermissionError(13, "Permission denied", path)
+        remove(path)
+
+    monkeypatch.setattr(catalog.os, "remove", stuck_remove)
+
+    async def scenario():
+        clips = await open_catalog(tmp_path)
+        try:
+            await clips.reconcile(str(videos))
+            result = await clips.prune(max_bytes=2 * size)
+            return result, await clips.list_clips()
+        finally:
+            await clips.close()
+
+    result, listing = asyncio.run(scenario())
+    assert result["failed"] == [made[0]]
+    # The clip after it went instead, only real deletions count as freed
+    assert result["removed"] == made[1:3]
+    assert result["bytes_freed"] == 2 * size and result["bytes_remaining"] == 2 * size
+    assert os.path.exists(made[0])
+    assert paths(listing) == sorted(os.path.basename(p) for p in (made[0], made[3]))
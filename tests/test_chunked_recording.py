@@ -0,0 +1,83 @@
+import asyncio
+import os
+import signal
+import subprocess
+import time
+
+from decky_recorder import matroska, pipeline
+from decky_recorder.chunked_recording import ChunkedRecording, find_orphans, recover_chunks, recover_temp
+from decky_recorder.segment_index import NS_PER_SECOND
+
+# Quotes, spaces and non-ASCII, as game names have them
+NAME = "Baldur's Gate 3 – Édition_2026-10-17_12-00-00.mkv"
+# Media seconds the fake pipeline records per wall second
+SPEED = 20
+
+
+def launch(output, env) -> subprocess.Popen:
+    video = pipeline.video_source(test=True) + pipeline.video_encode(pipeline.ENCODERS[1], pipeline.PRESETS["balanced"])
+    audio = [pipeline.audio_source(test=True) + pipeline.audio_encode(128000)]
+    argv = pipeline.recording_pipeline(video, audio, output).launch_argv()
+    return subprocess.Popen(argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_for(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "the fake pipeline did not get that far"
+        time.sleep(0.01)
+
+
+def fake_env(monkeypatch):
+    monkeypatch.setenv("FAKE_GST_SPEED", str(SPEED))
+    monkeypatch.setenv("FAKE_GST_NOISE_LINES", "0")
+    return dict(os.environ)
+
+
+def test_sigkilled_chunked_recording_is_recovered(fakes, tmp_path, monkeypatch):
+    output = str(tmp_path / NAME)
+    recording = ChunkedRecording(output, "mkv")
+    location = recording.begin()
+    proc = launch(pipeline.split_output("mkv", location, 10 * NS_PER_SECOND, 0), fake_env(monkeypatch))
+    try:
+        third = os.path.join(recording.directory, "chunk00002.mkv")
+        wait_for(lambda: os.path.exists(third))
+        # A few clusters into the third chunk
+        time.sleep(3 / SPEED)
+    finally:
+        proc.send_signal(signal.SIGKILL)
+        proc.wait()
+
+    chunk_dirs, temps = find_orphans(str(tmp_path))
+    assert chunk_dirs == [recording.directory] and temps == []
+    recovered, segments = recover_chunks(recording.directory)
+    assert recovered == output
+    assert [os.path.basename(s.path) for s in segments][:3] == ["chunk00000.mkv", "chunk00001.mkv", "chunk00002.mkv"]
+    assert [s.duration for s in segments[:2]] == [10 * NS_PER_SECOND] * 2
+    # The chunks follow each other on one timeline
+    assert all(b.start == a.end for a, b in zip(segments, segments[1:]))
+
+    duration = matroska.concat([s.path for s in segments], output, [s.duration for s in segments])
+    assert duration == sum(s.duration for s in segments) > 20 * NS_PER_SECOND
+    fragment = matroska.read_fragment(output)
+    assert fragment.duration * fragment.timecode_scale == duration
+    assert fragment.keyframes()[0] == fragment.first_timecode
+
+
+def test_sigkilled_single_file_recording_is_recovered(fakes, tmp_path, monkeypatch):
+    output = str(tmp_path / NAME)
+    proc = launch(pipeline.file_output("mkv", output + ".temp"), fake_env(monkeypatch))
+    try:
+        wait_for(lambda: os.path.exists(output + ".temp") and os.path.getsize(output + ".temp") > 64 * 1024)
+        time.sleep(5 / SPEED)
+    finally:
+        proc.send_signal(signal.SIGKILL)
+        proc.wait()
+
+    assert find_orphans(str(tmp_path)) == ([], [output + ".temp"])
+    assert asyncio.run(recover_temp(output + ".temp")) == output
+    assert not os.path.exists(output + ".temp")
+    fragment = matroska.read_fragment(output)
+    # Every whole second written before the kill, with the Duration the pipeline never wrote
+    seconds = fragment.duration * fragment.timecode_scale / NS_PER_SECOND
+    assert len(fragment.clusters) >= 5 and abs(seconds - len(fragment.clusters)) < 0.002
@@ -0,0 +1,141 @@
+import asyncio
+import json
+import os
+import time
+
+import psutil
+
+from decky_recorder import matroska, process
+from decky_recorder.catalog import probe_duration
+from decky_recorder.compress import DONE, PAUSED, QUEUED, RUNNING, CompressionPool
+from test_matroska import FRAGMENT_MS, MS, h264_fragment
+
+# Media seconds the fake encoder gets through per wall second
+SPEED = 2
+
+
+def clip(folder, fragments: int = 2) -> str:
+    parts = []
+    for n in range(fragments):
+        parts.append(str(folder / f"fragment_{n}.mkv"))
+        h264_fragment(parts[-1])
+    path = str(folder / "Hades_2026-10-01_12-00-00.mkv")
+    matroska.concat(parts, path, [FRAGMENT_MS * MS] * fragments)
+    for part in parts:
+        os.remove(part)
+    return path
+
+
+async def wait_until(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "the compression did not get that far"
+        await asyncio.sleep(0.005)
+
+
+def record_spawns(monkeypatch) -> list:
+    launched = []
+    spawn = process.spawn
+
+    async def recording_spawn(argv, *args, **kwargs):
+        launched.append(list(argv))
+        return await spawn(argv, *args, **kwargs)
+
+    monkeypatch.setattr(process, "spawn", recording_spawn)
+    return launched
+
+
+def encode_starts(launched: list) -> list:
+    return [float(argv[argv.index("-ss") + 1]) for argv in launched if "-crf" in argv]
+
+
+def test_encode_is_stopped_while_a_game_runs(fakes, tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_FFMPEG_ENCODE_SPEED", str(SPEED))
+    path = clip(tmp_path)
+    original = os.path.getsize(path)
+
+    async def scenario():
+        game = [False]
+        changed = asyncio.Event()
+
+        async def wait_change():
+            await changed.wait()
+            changed.clear()
+
+        def set_game(running: bool):
+            game[0] = running
+            changed.set()
+
+        replaced = []
+        pool = CompressionPool(
+            str(tmp_path / "compress-jobs.json"),
+            busy=lambda: game[0],
+            on_replaced=replaced.append,
+            wait_change=wait_change,
+        )
+        await pool.start(True)
+        try:
+            job = pool.submit(path)
+            await wait_until(lambda: job.state == RUNNING and job.id in pool._running)
+            ffmpeg = psutil.Process(pool._running[job.id].pid)
+            set_game(True)
+            await wait_until(lambda: job.state == PAUSED)
+            await wait_until(lambda: ffmpeg.status() == psutil.STATUS_STOPPED)
+            progress = job.progress
+            await asyncio.sleep(0.5)
+            frozen = job.progress == progress
+            set_game(False)
+            await wait_until(lambda: job.state == RUNNING)
+            await wait_until(lambda: job.state not in (QUEUED, RUNNING, PAUSED))
+            return job, frozen, replaced
+        finally:
+            await pool.close()
+
+    job, frozen, replaced = asyncio.run(scenario())
+    assert frozen
+    assert job.state == DONE and replaced == [path]
+    assert job.size == os.path.getsize(path) < original
+    assert sorted(os.listdir(tmp_path)) == ["Hades_2026-10-01_12-00-00.mkv", "compress-jobs.json"]
+
+
+def test_reload_continues_after_the_last_finished_part(fakes, tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_FFMPEG_ENCODE_SPEED", str(SPEED))
+    path = clip(tmp_path)
+    journal = str(tmp_path / "compress-jobs.json")
+    launched = record_spawns(monkeypatch)
+
+    async def scenario():
+        pool = CompressionPool(journal, chunk_seconds=1)
+        await pool.start(True)
+        job = pool.submit(path)
+        await wait_until(lambda: job.parts and job.id in pool._running and pool._running[job.id].returncode is None)
+        finished = list(job.parts)
+        await pool.close()
+        with open(journal) as f:
+            journaled = next(j for j in json.load(f)["jobs"] if j["id"] == job.id)
+        left = sorted(os.listdir(tmp_path))
+
+        before_reload = len(launched)
+        pool = CompressionPool(journal, chunk_seconds=1)
+        await pool.start(True)
+        try:
+            resumed = pool._jobs[job.id]
+            await wait_until(lambda: resumed.state not in (QUEUED, RUNNING, PAUSED))
+            return finished, journaled, left, launched[before_reload:], resumed
+        finally:
+            await pool.close()
+
+    finished, journaled, left, relaunched, job = asyncio.run(scenario())
+    # Back in the queue, with the parts it finished
+    assert journaled["state"] == QUEUED and journaled["parts"] == finished
+    # Only the finished parts outlive the unload
+    assert left == sorted(
+        [".Hades_2026-10-01_12-00-00.compressing.%03d.mkv" % n for n in range(len(finished))]
+        + ["Hades_2026-10-01_12-00-00.mkv", "compress-jobs.json"]
+    )
+    # The first encode after the reload starts where the finished parts end
+    assert encode_starts(relaunched)[0] == round(sum(finished), 3)
+    assert 0.0 not in encode_starts(relaunched)
+    assert job.state == DONE
+    assert asyncio.run(probe_duration(path)) == 2 * FRAGMENT_MS / 1000
+    assert sorted(os.listdir(tmp_path)) == ["Hades_2026-10-01_12-00-00.mkv", "compress-jobs.json"]
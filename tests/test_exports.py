@@ -0,0 +1,190 @@
+import asyncio
+import os
+
+from decky_recorder.exports import DONE, RUNNING, ExportQueue
+from decky_recorder.segment_index import NS_PER_SECOND, SegmentIndex
+
+
+def fragment(index: SegmentIndex, folder, n: int, close: bool = True):
+    path = os.path.join(str(folder), f"fragment_{n:05d}.mkv")
+    with open(path, "wb") as f:
+        f.write(b"\0" * 1024)
+    index.fragment_opened(path, n * NS_PER_SECOND)
+    if close:
+        index.fragment_closed(path, (n + 1) * NS_PER_SECOND)
+    return path
+
+
+def test_back_to_back_saves_coalesce_while_the_first_waits_for_its_fragment(tmp_path):
+    async def scenario():
+        index = SegmentIndex()
+        exports = []
+
+        async def exporter(job, work_dir):
+            exports.append(job)
+
+        queue = ExportQueue(str(tmp_path), exporter, is_current=index.contains)
+        queue.start()
+        for n in range(4):
+            fragment(index, tmp_path, n)
+        last = fragment(index, tmp_path, 4, close=False)
+
+        segments, start, end = index.clip(2)
+        first = queue.submit(segments, str(tmp_path / "a.mkv"), 2, start, end)
+        await asyncio.sleep(0.01)
+        # Picked up by the idle worker, which now waits for the open fragment
+        assert first.state == RUNNING
+        segments, start, end = index.clip(4)
+        second = queue.submit(segments, str(tmp_path / "b.mkv"), 4, start, end)
+        assert second is first and first.coalesced == 1
+
+        index.fragment_closed(last, 5 * NS_PER_SECOND)
+        queue.segment_closed()
+        while first.state != DONE:
+            await asyncio.sleep(0.01)
+        await queue.close()
+        return exports, first
+
+    exports, job = asyncio.run(scenario())
+    assert exports == [job]
+    assert job.output.endswith("b.mkv") and job.requested == 4
+    assert len(job.segments) == 5
+
+
+def test_request_after_export_started_is_not_merged(tmp_path):
+    async def scenario():
+        index = SegmentIndex()
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def exporter(job, work_dir):
+            started.set()
+            await release.wait()
+
+        queue = ExportQueue(str(tmp_path), exporter, is_current=index.contains)
+        queue.start()
+        for n in range(3):
+            fragment(index, tmp_path, n)
+        segments, start, end = index.clip(2)
+        first = queue.submit(segments, str(tmp_path / "a.mkv"), 2, start, end)
+        await started.wait()
+        segments, start, end = index.clip(3)
+        second = queue.submit(segments, str(tmp_path / "b.mkv"), 3, start, end)
+        release.set()
+        while second.state != DONE:
+            await asyncio.sleep(0.01)
+        await queue.close()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first is not second
+
+
+def test_close_cancels_a_running_export(tmp_path):
+    async def scenario():
+        index = SegmentIndex()
+
+        async def exporter(job, work_dir):
+            with open(job.output, "wb") as f:
+                f.write(b"partial")
+            await asyncio.sleep(60)
+
+        queue = ExportQueue(str(tmp_path), exporter, is_current=index.contains)
+        queue.start()
+        fragment(index, tmp_path, 0)
+        segments, start, end = index.clip(1)
+        job = queue.submit(segments, str(tmp_path / "clip.mkv"), 1, start, end)
+        while not job.exporting:
+            await asyncio.sleep(0.01)
+        await asyncio.wait_for(queue.close(), 3)
+        return job
+
+    job = asyncio.run(scenario())
+    assert job.state == "cancelled"
+    assert not os.path.exists(job.output)
+
+
+def test_cancelling_a_job_keeps_the_worker(tmp_path):
+    async def scenario():
+        index = SegmentIndex()
+        exported = []
+
+        async def exporter(job, work_dir):
+            if not exported:
+                exported.append(None)
+                await asyncio.sleep(60)
+            exported.append(job.id)
+
+        queue = ExportQueue(str(tmp_path), exporter, is_current=index.contains, coalesce_window=0)
+        queue.start()
+        fragment(index, tmp_path, 0)
+        segments, start, end = index.clip(1)
+        first = queue.submit(segments, str(tmp_path / "a.mkv"), 1, start, end)
+        while not first.exporting:
+            await asyncio.sleep(0.01)
+        second = queue.submit(segments, str(tmp_path / "b.mkv"), 1, start, end)
+        assert queue.cancel(first.id)
+        while second.state != DONE:
+            await asyncio.sleep(0.01)
+        await asyncio.wait_for(queue.close(), 3)
+        return first, second, exported
+
+    first, second, exported = asyncio.run(scenario())
+    assert first.state == "cancelled"
+    assert exported == [None, second.id]
+
+
+def test_concat_list_quotes_apostrophes():
+    import shlex
+
+    from decky_recorder.exports import concat_quote
+
+    path = "/home/deck/Videos/.Baldur's Gate 3_2026.mkv.chunks/chunk00000.mkv"
+    assert concat_quote(path) == "'/home/deck/Videos/.Baldur'\\''s Gate 3_2026.mkv.chunks/chunk00000.mkv'"
+    # The concat demuxer tokenizes like a POSIX shell
+    assert shlex.split("file " + concat_quote(path)) == ["file", path]
+
+
+def test_native_join_fails_cleanly_when_a_fragment_is_gone(tmp_path):
+    import pytest
+
+    from decky_recorder.exports import ExportJob, matroska_concat
+
+    index = SegmentIndex()
+    path = fragment(index, tmp_path, 0)
+    os.remove(path)
+    output = str(tmp_path / "clip.mkv")
+    job = ExportJob(id=1, segments=index.clip(1)[0], output=output, requested=1)
+    with pytest.raises(RuntimeError, match="could not join"):
+        asyncio.run(matroska_concat(job, str(tmp_path)))
+    assert not os.path.exists(output) and not os.path.exists(output + ".part")
+
+
+def test_save_returns_the_job_and_the_job_reports_what_was_written(load_plugin, game_mode, monkeypatch):
+    monkeypatch.setenv("FAKE_GST_SPEED", "50")
+    monkeypatch.setenv("FAKE_GST_NOISE_LINES", "0")
+    _, plugin = load_plugin({"rolling": True})
+
+    async def scenario():
+        await plugin._main(plugin)
+        try:
+            # The buffer has nothing closed yet
+            too_early = await plugin.save_rolling_recording(plugin, 5)
+            while sum(s.duration for s in plugin._segment_index if s.closed) < 6 * NS_PER_SECOND:
+                await asyncio.sleep(0.01)
+            saved = await plugin.save_rolling_recording(plugin, 5)
+            while True:
+                job = next(j for j in await plugin.get_export_jobs(plugin) if j["id"] == saved["job"])
+                if job["state"] not in ("queued", "running"):
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await plugin._unload(plugin)
+        return too_early, saved, job
+
+    too_early, saved, job = asyncio.run(scenario())
+    assert too_early == 0
+    assert saved["duration"] >= 5
+    assert job["state"] == DONE
+    # Written at the millisecond resolution of the Matroska timecodes
+    assert job["exported"] >= 5 and abs(job["exported"] - job["duration"]) < 0.001
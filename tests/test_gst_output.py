@@ -0,0 +1,33 @@
+from decky_recorder import gst_output
+
+
+def fragment_line(location: str) -> str:
+    return (
+        'Got message #12 from element "sink" (element): splitmuxsink-fragment-opened, '
+        f"location=(string){location}, running-time=(guint64)5000000000;"
+    )
+
+
+def test_plain_location_is_kept_as_is():
+    event = gst_output.parse_line(fragment_line("/dev/shm/Decky-Recorder-Rolling_00003.mkv"))
+    assert event.kind == gst_output.FRAGMENT_OPENED
+    assert event.fields == {"location": "/dev/shm/Decky-Recorder-Rolling_00003.mkv", "running-time": "5000000000"}
+
+
+def test_escaped_spaces_quotes_and_octal_bytes_are_undone():
+    # How gst_value_serialize writes ".Baldur's Gate 3 – Édition_….mkv.chunks/chunk00000.mkv"
+    serialized = (
+        "\"/home/deck/Videos/.Baldur\\'s\\ Gate\\ 3\\ \\342\\200\\223\\ \\303\\211dition_2026.mkv.chunks/"
+        'chunk00000.mkv"'
+    )
+    event = gst_output.parse_line(fragment_line(serialized))
+    assert event.fields["location"] == "/home/deck/Videos/.Baldur's Gate 3 – Édition_2026.mkv.chunks/chunk00000.mkv"
+    assert event.fields["running-time"] == "5000000000"
+
+
+def test_invalid_utf8_round_trips_like_fsdecode():
+    assert gst_output.unescape("\\377name") == "\udcffname"
+
+
+def test_escaped_backslash_and_quote():
+    assert gst_output.unescape('a\\\\b\\"c') == 'a\\b"c'
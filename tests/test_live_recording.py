@@ -0,0 +1,71 @@
+import asyncio
+import os
+
+from decky_recorder import matroska as mkv
+from decky_recorder.live_recording import LiveRecording
+from decky_recorder.segment_index import SegmentIndex
+from test_matroska import FRAGMENT_MS, MS, h264_fragment
+
+
+def fragments(tmp_path, count: int):
+    index = SegmentIndex()
+    segments = []
+    for n in range(count):
+        path = str(tmp_path / f"Decky-Recorder-Rolling_{n:05d}.mkv")
+        h264_fragment(path, base_ms=n * FRAGMENT_MS)
+        index.fragment_opened(path, n * FRAGMENT_MS * MS)
+        segment = index.fragment_closed(path, (n + 1) * FRAGMENT_MS * MS)
+        segment.keyframes = mkv.keyframe_offsets(path)
+        segments.append(segment)
+    return segments
+
+
+def duration_ns(path: str) -> int:
+    fragment = mkv.read_fragment(path)
+    return int(fragment.duration * fragment.timecode_scale)
+
+
+def test_stop_writes_the_recording_from_the_keyframe_before_its_start(tmp_path):
+    segments = fragments(tmp_path, 3)
+    output = str(tmp_path / "recording.mkv")
+    # Between the keyframes at 1.0s and 1.333s
+    live = LiveRecording(output, "mkv", 1100 * MS)
+
+    async def scenario():
+        for segment in segments[:2]:
+            await live.on_fragment_closed(segment)
+        # Stopped at 5s, while the last fragment is still being written
+        stop = asyncio.ensure_future(live.stop(5000 * MS))
+        await asyncio.sleep(0.01)
+        await live.on_fragment_closed(segments[2])
+        return await stop
+
+    assert asyncio.run(scenario())
+    assert live.start == 1000 * MS and live.end == 5000 * MS
+    assert duration_ns(output) == 4000 * MS
+    assert not os.path.exists(output + ".temp")
+
+
+def test_stop_before_any_fragment_closed_reports_nothing_saved(tmp_path):
+    output = str(tmp_path / "recording.mkv")
+    live = LiveRecording(output, "mkv", 1100 * MS, close_timeout=0.05)
+
+    assert not asyncio.run(live.stop(1500 * MS))
+    assert live.segments == []
+    assert not os.path.exists(output) and not os.path.exists(output + ".temp")
+
+
+def test_stop_ends_early_when_the_last_fragment_never_closes(tmp_path):
+    first, second = fragments(tmp_path, 2)
+    output = str(tmp_path / "recording.mkv")
+    # Between the keyframes at 0.333s and 0.666s
+    live = LiveRecording(output, "mkv", 500 * MS, close_timeout=0.05)
+
+    async def scenario():
+        await live.on_fragment_closed(first)
+        # The pipeline dies before `second` closes
+        return await live.stop(second.start + 1000 * MS)
+
+    assert asyncio.run(scenario())
+    assert live.start == 333 * MS and live.end == first.end
+    assert duration_ns(output) == first.end - live.start
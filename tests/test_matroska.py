@@ -0,0 +1,103 @@
+import os
+import struct
+
+from decky_recorder import matroska as mkv
+from decky_recorder.exports import ExportJob
+from decky_recorder.segment_index import NS_PER_SECOND, SegmentIndex
+
+FPS = 30
+# Frames per GOP, a keyframe every third of a second
+GOP = 10
+FRAGMENT_MS = 2000
+MS = 1_000_000
+
+
+def h264_fragment(path: str, base_ms: int = 0):
+    """A splitmuxsink-like fragment: H.264 video and AAC audio, one cluster per GOP."""
+    tracks = mkv.element(
+        mkv.TRACK_ENTRY,
+        mkv.uint_element(mkv.TRACK_NUMBER, 1)
+        + mkv.uint_element(mkv.TRACK_TYPE, mkv.TRACK_TYPE_VIDEO)
+        + mkv.element(mkv.CODEC_ID, b"V_MPEG4/ISO/AVC")
+        + mkv.element(mkv.CODEC_PRIVATE, b"\x01\x64\x00\x28"),
+    ) + mkv.element(
+        mkv.TRACK_ENTRY,
+        mkv.uint_element(mkv.TRACK_NUMBER, 2)
+        + mkv.uint_element(mkv.TRACK_TYPE, mkv.TRACK_TYPE_AUDIO)
+        + mkv.element(mkv.CODEC_ID, b"A_AAC"),
+    )
+    info = mkv.uint_element(mkv.TIMECODE_SCALE, MS) + mkv.float_element(mkv.DURATION, float(FRAGMENT_MS))
+    clusters = []
+    frames = FRAGMENT_MS * FPS // 1000
+    for first in range(0, frames, GOP):
+        cluster_ms = base_ms + first * 1000 // FPS
+        body = [mkv.uint_element(mkv.TIMECODE, cluster_ms)]
+        for frame in range(first, first + GOP):
+            offset = struct.pack(">h", base_ms + frame * 1000 // FPS - cluster_ms)
+            flags = b"\x80" if frame == first else b"\x00"
+            body.append(mkv.element(mkv.SIMPLE_BLOCK, b"\x81" + offset + flags + bytes([frame]) * 64))
+            body.append(mkv.element(mkv.SIMPLE_BLOCK, b"\x82" + offset + b"\x80" + b"\xaa" * 8))
+        clusters.append(mkv.element(mkv.CLUSTER, b"".join(body)))
+    header = mkv.element(mkv.EBML, mkv.element(0x4282, b"matroska"))
+    segment = mkv.element(mkv.INFO, info) + mkv.element(mkv.TRACKS, tracks) + b"".join(clusters)
+    with open(path, "wb") as f:
+        f.write(header + mkv.element(mkv.SEGMENT, segment))
+
+
+def video_blocks(path: str):
+    """(timecode, keyframe, frame number) of every video block in a file."""
+    fragment = mkv.read_fragment(path)
+    blocks = []
+    with open(path, "rb") as f:
+        for cluster in fragment.clusters:
+            for block in cluster.blocks:
+                if block.track == fragment.video_track:
+                    f.seek(block.offset + block.length - 1)
+                    blocks.append((cluster.timecode + block.timecode, block.keyframe, f.read(1)[0]))
+    return fragment, blocks
+
+
+def test_append_trimmed_starts_on_the_keyframe_and_cuts_the_tail(tmp_path):
+    source = str(tmp_path / "fragment.mkv")
+    h264_fragment(source, base_ms=4000)
+    output = str(tmp_path / "clip.mkv")
+    writer = mkv.MatroskaConcatWriter(output, mkv.read_fragment(source))
+    # Frame 20 is a keyframe, frame 45 is the first one past the end
+    mkv.append_trimmed(writer, mkv.read_fragment(source), FRAGMENT_MS * MS, start=666 * MS, end=1500 * MS)
+    assert writer.close() == 834 * MS
+
+    fragment, blocks = video_blocks(output)
+    assert fragment.duration == 834.0
+    assert blocks[0] == (0, True, 20)
+    assert [frame for _, _, frame in blocks] == list(range(20, 45))
+    assert [timecode for timecode, keyframe, _ in blocks if keyframe] == [0, 334, 667]
+
+
+def test_clip_snaps_back_to_a_keyframe_and_exports_that_length(tmp_path):
+    index = SegmentIndex()
+    for n in range(3):
+        path = str(tmp_path / f"Decky-Recorder-Rolling_{n:05d}.mkv")
+        h264_fragment(path, base_ms=n * FRAGMENT_MS)
+        index.fragment_opened(path, n * FRAGMENT_MS * MS)
+        segment = index.fragment_closed(path, (n + 1) * FRAGMENT_MS * MS)
+        segment.keyframes = mkv.keyframe_offsets(path)
+
+    # 3.1s on the timeline falls between the keyframes at 3.0s and 3.333s
+    segments, start, end = index.clip(2.9)
+    assert [os.path.basename(s.path)[-9:-4] for s in segments] == ["00001", "00002"]
+    assert start == 3000 * MS and end == 6000 * MS
+    # Never shorter than asked, and at most one GOP longer
+    assert 2.9 * NS_PER_SECOND <= end - start < 2.9 * NS_PER_SECOND + GOP * NS_PER_SECOND // FPS
+
+    job = ExportJob(id=1, segments=segments, output=str(tmp_path / "clip.mkv"), requested=2.9, start=start, end=end)
+    trim_start, trim_end = job.trim
+    duration = mkv.concat(
+        [s.path for s in segments], job.output, [s.duration for s in segments], start=trim_start, end=trim_end
+    )
+    assert duration == end - start
+
+    fragment, blocks = video_blocks(job.output)
+    assert fragment.duration * fragment.timecode_scale == end - start
+    assert blocks[0][:2] == (0, True)
+    # The second half of the middle fragment, then all of the last one
+    assert [frame for _, _, frame in blocks] == list(range(30, 60)) + list(range(60))
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from decky_recorder import metrics
+
+
+class Service:
+    async def get_status(self):
+        return "ok"
+
+    async def fail(self):
+        raise ValueError("no")
+
+    async def watch(self):
+        return None
+
+    async def _main(self):
+        return None
+
+    def helper(self):
+        return "sync"
+
+
+def test_histogram_quantiles_and_prometheus_text():
+    registry = metrics.Registry(enabled=True)
+    registry.inc("exports_total", labels={"state": "done"})
+    registry.inc("exports_total", 2, labels={"state": "done"})
+    registry.set("buffer_bytes", 4096)
+    for value in (0.002, 0.002, 0.02, 3.0):
+        registry.observe("export_seconds", value)
+
+    histogram = registry.histograms["export_seconds"][()]
+    assert histogram.count == 4 and histogram.max == 3.0
+    assert histogram.quantile(0.5) == 0.005
+    assert histogram.quantile(0.95) == 5.0
+    text = registry.prometheus_text()
+    assert 'decky_recorder_exports_total{state="done"} 3' in text
+    assert "decky_recorder_buffer_bytes 4096" in text
+    assert 'decky_recorder_export_seconds_bucket{le="0.005"} 2' in text
+    assert 'decky_recorder_export_seconds_bucket{le="+Inf"} 4' in text
+    assert "decky_recorder_export_seconds_count 4" in text
+
+
+def test_disabled_registry_records_nothing():
+    registry = metrics.Registry()
+    registry.inc("exports_total")
+    registry.observe("export_seconds", 1.0)
+    with registry.timed("watchdog_seconds"):
+        pass
+    assert registry.counters == {} and registry.histograms == {}
+
+
+def test_instrument_class_only_wraps_public_coroutines(monkeypatch):
+    registry = metrics.Registry(enabled=True)
+    monkeypatch.setattr(metrics, "REGISTRY", registry)
+    helper, main = Service.helper, Service._main
+    metrics.instrument_class(Service, exclude=("watch",))
+
+    assert Service.helper is helper and Service._main is main
+    assert not hasattr(Service.watch, "__wrapped__")
+    assert hasattr(Service.get_status, "__wrapped__")
+
+    async def scenario():
+        await Service.get_status(Service)
+        with pytest.raises(ValueError):
+            await Service.fail(Service)
+
+    asyncio.run(scenario())
+    latency = registry.histograms["rpc_latency_seconds"]
+    assert set(latency) == {(("method", "get_status"),), (("method", "fail"),)}
+    assert registry.counters["rpc_errors_total"] == {(("method", "fail"),): 1}
+
+
+def test_plugin_instruments_rpcs_but_not_its_helpers(load_plugin):
+    _, plugin = load_plugin()
+    for rpc in ("save_rolling_recording", "get_export_jobs", "start_capturing"):
+        assert hasattr(vars(plugin)[rpc], "__wrapped__"), rpc
+    for helper in ("clip_saved", "export_finished", "pipeline_alive", "setup_pipeline_events", "watchdog", "_main"):
+        assert not hasattr(vars(plugin)[helper], "__wrapped__"), helper
@@ -0,0 +1,19 @@
+from decky_recorder import pipeline
+from decky_recorder.exports import low_priority
+
+
+def test_only_capture_pipelines_count_as_capture_processes():
+    video = pipeline.video_source() + pipeline.video_encode(pipeline.ENCODERS[1], pipeline.PRESETS["balanced"])
+    audio = [pipeline.audio_source("Decky-Recorder-sink.monitor") + pipeline.audio_encode(128000)]
+    output = pipeline.file_output("mkv", "/home/deck/Videos/Decky-Recorder_2026-10-17.mkv")
+    argv = pipeline.recording_pipeline(video, audio, output).launch_argv()
+    assert pipeline.is_capture_process("gst-launch-1.0", argv)
+
+    clip = "/home/deck/Videos/Decky-Recorder_2026-10-17.mkv"
+    export = low_priority(["ffmpeg", "-i", clip, "-c", "copy", clip + ".part"])
+    assert not pipeline.is_capture_process("ffmpeg", export)
+    assert not pipeline.is_capture_process("nice", export)
+    assert not pipeline.is_capture_process("taskset", ["taskset", "-c", "3"] + argv)
+    # Someone else's pipeline writing into the same folder
+    assert not pipeline.is_capture_process("gst-launch-1.0", ["gst-launch-1.0", "filesrc", f"location={clip}"])
+    assert not pipeline.is_capture_process("gst-launch-1.0", None)
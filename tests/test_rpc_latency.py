@@ -0,0 +1,45 @@
+import asyncio
+import time
+
+from decky_recorder.exports import ExportJob, ffmpeg_concat
+from decky_recorder.segment_index import NS_PER_SECOND, Segment
+
+KiB = 1024
+
+
+async def loop_lag(done: asyncio.Event, interval: float = 0.005):
+    """How late each wakeup of a timer is, as an RPC handler would see it."""
+    lags = []
+    while not done.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+    return lags
+
+
+def test_event_loop_stays_responsive_during_a_long_ffmpeg_export(fakes, tmp_path, monkeypatch):
+    # Four 64 KiB segments at 256 KiB/s keep the fake ffmpeg busy for about a second
+    monkeypatch.setenv("FAKE_FFMPEG_BYTES_PER_SECOND", str(256 * KiB))
+    segments = []
+    for n in range(4):
+        path = str(tmp_path / f"segment {n}.mkv")
+        with open(path, "wb") as f:
+            f.write(bytes([n]) * 64 * KiB)
+        segments.append(Segment(n, path, n * NS_PER_SECOND, NS_PER_SECOND, 64 * KiB, True))
+    job = ExportJob(id=1, segments=segments, output=str(tmp_path / "clip.mkv"), requested=4)
+
+    async def scenario():
+        done = asyncio.Event()
+        lag = asyncio.ensure_future(loop_lag(done))
+        started = time.perf_counter()
+        await ffmpeg_concat(job, str(tmp_path))
+        elapsed = time.perf_counter() - started
+        done.set()
+        return elapsed, await lag
+
+    elapsed, lags = asyncio.run(scenario())
+    assert elapsed > 0.5
+    assert len(lags) > 50 and max(lags) < 0.1
+    assert job.progress == 1.0
+    with open(job.output, "rb") as f:
+        assert f.read() == b"".join(bytes([n]) * 64 * KiB for n in range(4))
@@ -0,0 +1,83 @@
+import os
+
+from decky_recorder.segment_index import NS_PER_SECOND, SegmentIndex
+
+HALF = NS_PER_SECOND // 2
+
+
+def record(index: SegmentIndex, folder, count: int, first: int = 0, max_files: int = 0):
+    """One-second fragments with a keyframe every half second. With
+    `max_files` the file names wrap around the way splitmuxsink reuses them."""
+    for n in range(first, first + count):
+        path = os.path.join(str(folder), f"fragment_{n % max_files if max_files else n:05d}.mkv")
+        with open(path, "wb") as f:
+            f.write(b"\0" * 1024)
+        segment = index.fragment_opened(path, n * NS_PER_SECOND)
+        segment.keyframes = [0, HALF]
+        index.fragment_closed(path, (n + 1) * NS_PER_SECOND)
+
+
+def starts(segments) -> list:
+    return [s.start // HALF for s in segments]
+
+
+def test_empty_index_has_no_clip():
+    index = SegmentIndex()
+    assert index.clip(30) == ([], 0, 0)
+    assert index.clip(30, end=5 * NS_PER_SECOND) == ([], 0, 0)
+
+
+def test_clip_longer_than_the_buffer_is_the_whole_buffer(tmp_path):
+    index = SegmentIndex()
+    record(index, tmp_path, 3)
+    segments, start, end = index.clip(30, end=3 * NS_PER_SECOND)
+    assert segments == list(index)
+    assert (start, end) == (0, 3 * NS_PER_SECOND)
+
+
+def test_end_before_the_buffer_has_no_clip(tmp_path):
+    index = SegmentIndex()
+    record(index, tmp_path, 3)
+    assert index.clip(1, end=0) == ([], 0, 0)
+
+
+def test_start_between_keyframes_snaps_back_to_the_earlier_one(tmp_path):
+    index = SegmentIndex()
+    record(index, tmp_path, 3)
+    # Asked from 1.8s: the keyframe at 1.5s
+    segments, start, end = index.clip(1.2, end=3 * NS_PER_SECOND)
+    assert starts(segments) == [2, 4]
+    assert (start, end) == (3 * HALF, 3 * NS_PER_SECOND)
+    # Asked from 1.2s: the keyframe the fragment starts on
+    segments, start, _ = index.clip(1.8, end=3 * NS_PER_SECOND)
+    assert starts(segments) == [2, 4] and start == NS_PER_SECOND
+    # Exactly on a keyframe, nothing is added
+    _, start, _ = index.clip(1.5, end=3 * NS_PER_SECOND)
+    assert start == 3 * HALF
+
+
+def test_end_inside_a_fragment_includes_it_and_on_its_start_does_not(tmp_path):
+    index = SegmentIndex()
+    record(index, tmp_path, 3)
+    segments, _, end = index.clip(1, end=5 * HALF)
+    assert starts(segments) == [2, 4] and end == 5 * HALF
+    segments, _, _ = index.clip(1, end=2 * NS_PER_SECOND)
+    assert starts(segments) == [2]
+
+
+def test_expired_fragments_leave_the_clip(tmp_path):
+    index = SegmentIndex()
+    record(index, tmp_path, 3, max_files=3)
+    expired = list(index)[:2]
+    # splitmuxsink with max-files=3 reuses the names of the first two fragments
+    record(index, tmp_path, 2, first=3, max_files=3)
+    segments, start, _ = index.clip(30, end=5 * NS_PER_SECOND)
+    assert starts(segments) == [4, 6, 8] and start == 2 * NS_PER_SECOND
+    assert index.status()["segments"] == 3 and index.status()["seconds"] == 3
+    assert not any(index.contains(s) for s in expired)
+
+    # Dropped by the buffer, the next fragment is where clips start now
+    index.drop(segments[0])
+    segments, start, _ = index.clip(30, end=5 * NS_PER_SECOND)
+    assert starts(segments) == [6, 8] and start == 3 * NS_PER_SECOND
+    assert index.status()["segments"] == 2
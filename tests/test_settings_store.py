@@ -0,0 +1,47 @@
+import asyncio
+import json
+
+from decky_recorder.settings_store import Setting, SettingsStore
+
+SCHEMA = (
+    Setting("_micGain", "mic_gain", float, 13.0),
+    Setting("_micEnabled", "mic_enabled", bool, False),
+)
+
+
+def test_slider_drag_is_written_once(tmp_path):
+    path = str(tmp_path / "decky-loader-settings.json")
+    with open(path, "w") as f:
+        json.dump({"mic_gain": 13.0, "mic_enabled": True, "unknown": "kept"}, f)
+
+    async def scenario():
+        store = SettingsStore(path, SCHEMA, debounce=0.1)
+        await store.load()
+        # One update per frame for a second, as the frontend sends them while dragging
+        for step in range(60):
+            store.set("_micGain", 5.0 + step * 0.25)
+            await asyncio.sleep(1 / 60)
+        during = store.writes
+        await asyncio.sleep(0.3)
+        return during, store.writes
+
+    during, after = asyncio.run(scenario())
+    assert during == 0 and after == 1
+    with open(path) as f:
+        assert json.load(f) == {"mic_gain": 19.75, "mic_enabled": True, "unknown": "kept"}
+
+
+def test_close_writes_what_is_still_pending(tmp_path):
+    path = str(tmp_path / "decky-loader-settings.json")
+
+    async def scenario():
+        store = SettingsStore(path, SCHEMA, debounce=60)
+        await store.load()
+        store.set("_micEnabled", "true")
+        assert not store.set("_micEnabled", True)
+        await store.close()
+        return store.writes
+
+    assert asyncio.run(scenario()) == 1
+    with open(path) as f:
+        assert json.load(f) == {"mic_gain": 13.0, "mic_enabled": True}
@@ -0,0 +1,75 @@
+import asyncio
+import os
+import signal
+import time
+
+# Media seconds the fake pipeline records per wall second
+SPEED = 50
+
+
+async def wait_until(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "the plugin did not get that far"
+        await asyncio.sleep(0.005)
+
+
+def closed_segments(plugin) -> int:
+    return sum(1 for s in plugin._segment_index if s.closed)
+
+
+def test_replay_buffer_stops_before_suspend_and_continues_after_resume(load_plugin, game_mode, monkeypatch):
+    monkeypatch.setenv("FAKE_GST_SPEED", str(SPEED))
+    monkeypatch.setenv("FAKE_GST_NOISE_LINES", "0")
+    _, plugin = load_plugin({"rolling": True})
+
+    async def scenario():
+        await plugin._main(plugin)
+        reconciled = []
+        apply = plugin._audio_reconciler.apply
+
+        async def recording_apply(graph):
+            reconciled.append(graph)
+            return await apply(graph)
+
+        plugin._audio_reconciler.apply = recording_apply
+        monitor = plugin._sleep_monitor
+        try:
+            await wait_until(lambda: closed_segments(plugin) >= 2)
+
+            # gdbus relays PrepareForSleep(true)
+            os.kill(monitor.pid, signal.SIGUSR1)
+            await wait_until(lambda: monitor.suspends == 1)
+            suspended = {
+                "capturing": await plugin.is_capturing(plugin, verbose=False),
+                "sleeping": plugin._sleeping,
+                "last": plugin._segment_index.latest_closed(),
+                "segments": closed_segments(plugin),
+            }
+            reconciled_before = len(reconciled)
+
+            # PrepareForSleep(false)
+            os.kill(monitor.pid, signal.SIGUSR2)
+            await wait_until(lambda: closed_segments(plugin) > suspended["segments"])
+            resumed = {
+                "capturing": await plugin.is_capturing(plugin, verbose=False),
+                "sleeping": plugin._sleeping,
+                "segments": list(plugin._segment_index),
+                "reconciled": reconciled[reconciled_before:],
+                "status": await plugin.get_sleep_status(plugin),
+            }
+        finally:
+            await plugin._unload(plugin)
+        return suspended, resumed
+
+    suspended, resumed = asyncio.run(scenario())
+    assert not suspended["capturing"] and suspended["sleeping"]
+    assert resumed["capturing"] and not resumed["sleeping"]
+    # The buffer continues on the same timeline instead of starting over
+    last = suspended["last"]
+    assert last in resumed["segments"]
+    after = resumed["segments"][resumed["segments"].index(last) + 1]
+    assert after.start == last.end
+    # The audio graph was brought back in line before the capture restarted
+    assert len(resumed["reconciled"]) == 1
+    assert resumed["status"]["suspends"] == 1 and resumed["status"]["resume_to_capture_seconds"] is not None
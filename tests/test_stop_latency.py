@@ -0,0 +1,50 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from decky_recorder import process
+
+# Media seconds the fake pipeline records per wall second
+SPEED = 20
+
+
+@pytest.mark.parametrize("fileformat", ["mp4", "mkv", "mov"])
+def test_stop_leaves_the_finished_file_without_a_remux(load_plugin, game_mode, monkeypatch, fileformat):
+    monkeypatch.setenv("FAKE_GST_SPEED", str(SPEED))
+    monkeypatch.setenv("FAKE_GST_NOISE_LINES", "0")
+    _, plugin = load_plugin({"format": fileformat})
+    launched = []
+    spawn = process.spawn
+
+    async def recording_spawn(argv, *args, **kwargs):
+        launched.append(list(argv))
+        return await spawn(argv, *args, **kwargs)
+
+    monkeypatch.setattr(process, "spawn", recording_spawn)
+
+    async def scenario():
+        await plugin._main(plugin)
+        try:
+            await plugin.start_capturing(plugin, "game")
+            partial = f"{plugin._filepath}.temp"
+            deadline = time.monotonic() + 10
+            while not os.path.exists(partial) or os.path.getsize(partial) < 4096:
+                assert time.monotonic() < deadline, "the fake pipeline wrote nothing"
+                await asyncio.sleep(0.01)
+            started = time.perf_counter()
+            await plugin.stop_capturing(plugin)
+            return plugin._filepath, time.perf_counter() - started
+        finally:
+            await plugin._unload(plugin)
+            # Lets the pipes of the thumbnail ffmpeg the unload cancelled close before the loop does
+            await asyncio.sleep(0.1)
+
+    path, stop_seconds = asyncio.run(scenario())
+    assert path.endswith(f".{fileformat}")
+    assert os.path.getsize(path) > 4096
+    assert not os.path.exists(f"{path}.temp")
+    # The muxer finalized the file on EOS, nothing wrote it a second time
+    assert not any("ffmpeg" in argv and argv[-1] == path for argv in launched)
+    assert stop_seconds < 2
@@ -0,0 +1,46 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from decky_recorder.supervisor import SessionTracker
+
+
+def test_wait_change_returns_when_the_tracked_process_exits():
+    # An AppId of its own, so no other fake game on the machine is picked up instead
+    app = f"AppId={os.getpid()}"
+    game = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)", "SteamLaunch", app])
+
+    async def scenario():
+        tracker = SessionTracker(f"SteamLaunch {app}", rescan_interval=60)
+        assert tracker.active()
+        waiter = asyncio.ensure_future(tracker.wait_change())
+        await asyncio.sleep(0.1)
+        # No polling while the game runs
+        assert not waiter.done()
+        started = time.perf_counter()
+        game.kill()
+        await asyncio.wait_for(waiter, 5)
+        elapsed = time.perf_counter() - started
+        active = tracker.active()
+        tracker.close()
+        return elapsed, active
+
+    try:
+        elapsed, active = asyncio.run(scenario())
+    finally:
+        game.kill()
+        game.wait()
+    assert elapsed < 1 and not active
+
+
+def test_wait_change_rescans_on_the_interval_while_nothing_is_tracked():
+    async def scenario():
+        tracker = SessionTracker("no-such-process-decky-recorder-test", rescan_interval=0.2)
+        assert not tracker.active()
+        started = time.perf_counter()
+        await tracker.wait_change()
+        return time.perf_counter() - started
+
+    assert 0.15 < asyncio.run(scenario()) < 2